@@ -84,7 +84,69 @@ DEFAULT_CFG = {
             "code": "5",
             "display": "Services",
         },
-    ]
+    ],
+    # Insuree import: sheets are split in chunks of at least this many rows,
+    # processed by at most this many parallel Celery tasks (1 = serial import)
+    "insuree_import_chunk_size": 1000,
+    "insuree_import_max_parallel_chunks": 1,
+    # Import progress is written to the batch every N rows or T seconds,
+    # and optionally mirrored in the Django cache for status polls
+    "insuree_import_progress_every_rows": 100,
+    "insuree_import_progress_every_seconds": 5,
+    "insuree_import_progress_cache": False,
+    "insuree_import_progress_cache_timeout": 86400,
+    # Longest time (seconds) a progress stream or long poll holds its request,
+    # and how often it reads the cached progress meanwhile
+    "insuree_import_progress_stream_timeout": 10,
+    "insuree_import_progress_stream_interval": 1,
+    # Side effects of imported rows (notifications, emails, DMS, workflow, ABIS)
+    # go through an outbox drained by Celery workers, retried with a backoff
+    # starting at retry_delay seconds, at most `concurrency[target]` workers per target
+    "insuree_import_outbox_enabled": True,
+    "insuree_import_outbox_batch_size": 50,
+    "insuree_import_outbox_max_attempts": 5,
+    "insuree_import_outbox_retry_delay": 60,
+    "insuree_import_outbox_concurrency": {
+        "NOTIFICATION": 4,
+        "EMAIL": 2,
+        "DMS_FOLDER": 2,
+        "WORKFLOW": 2,
+        "ABIS": 1,
+    },
+    # Temporary CAMU numbers of new insurees are reserved by blocks of this size
+    # per region and enrolment category (1 = one number at a time). Only raise it
+    # once every generator of the instance reads the reservations
+    "insuree_import_chf_id_block_size": 1,
+    # Imports still processing without progress for this many seconds are resumed
+    # from their last checkpoint, at most insuree_import_max_resumes times
+    "insuree_import_stale_after": 3600,
+    "insuree_import_max_resumes": 3,
+    # A file identical to one already imported for the policyholder gets the
+    # report of that import, unless the upload asks to reimport it
+    "insuree_import_reuse_completed_reports": True,
+    # Rows identical to the last import of the same insuree for the policyholder
+    # are reported as "Aucun changement" without being imported again
+    "insuree_import_skip_unchanged_rows": True,
+    # Where uploaded import files and reports are stored: "s3" (the bucket) or
+    # "local" (insuree_import_local_storage_dir, default MEDIA_ROOT/policyholder_storage)
+    "insuree_import_storage_backend": "s3",
+    "insuree_import_local_storage_dir": "",
+    # Uploads up to this size (bytes) are handed to the import worker in the task message
+    "insuree_import_inline_max_bytes": 262144,
+    # Directory shared by the API and the workers, larger uploads are handed over
+    # through it instead of the storage (empty: read from the storage)
+    "insuree_import_shared_dir": "",
+    # Imports of files from this size (bytes) go to the large lane, at most
+    # insuree_import_max_active_large of them run at once (0: no limit)
+    "insuree_import_large_file_min_bytes": 1048576,
+    "insuree_import_max_active_large": 2,
+    # Celery queues of the small and large import lanes (empty: default queue)
+    "insuree_import_small_queue": "",
+    "insuree_import_large_queue": "",
+    # Files of more rows sent to the synchronous import endpoint are imported asynchronously
+    "insuree_import_sync_max_rows": 500,
+    # Rows imported per transaction, each row in its own savepoint (0: autocommit)
+    "insuree_import_transaction_rows": 500,
 }
 
 
@@ -133,6 +195,35 @@ class PolicyholderConfig(AppConfig):
     policyholder_legal_form = []
     policyholder_activity = []
 
+    insuree_import_chunk_size = 1000
+    insuree_import_max_parallel_chunks = 1
+    insuree_import_progress_every_rows = 100
+    insuree_import_progress_every_seconds = 5
+    insuree_import_progress_cache = False
+    insuree_import_progress_cache_timeout = 86400
+    insuree_import_progress_stream_timeout = 10
+    insuree_import_progress_stream_interval = 1
+    insuree_import_outbox_enabled = True
+    insuree_import_outbox_batch_size = 50
+    insuree_import_outbox_max_attempts = 5
+    insuree_import_outbox_retry_delay = 60
+    insuree_import_outbox_concurrency = {}
+    insuree_import_chf_id_block_size = 1
+    insuree_import_stale_after = 3600
+    insuree_import_max_resumes = 3
+    insuree_import_reuse_completed_reports = True
+    insuree_import_skip_unchanged_rows = True
+    insuree_import_storage_backend = "s3"
+    insuree_import_local_storage_dir = ""
+    insuree_import_inline_max_bytes = 262144
+    insuree_import_shared_dir = ""
+    insuree_import_large_file_min_bytes = 1048576
+    insuree_import_max_active_large = 2
+    insuree_import_small_queue = ""
+    insuree_import_large_queue = ""
+    insuree_import_sync_max_rows = 500
+    insuree_import_transaction_rows = 500
+
     def _configure_permissions(self, cfg):
         PolicyholderConfig.gql_query_policyholder_perms = cfg[
             "gql_query_policyholder_perms"]
@@ -214,8 +305,39 @@ class PolicyholderConfig(AppConfig):
         PolicyholderConfig.policyholder_legal_form = cfg["policyholder_legal_form"]
         PolicyholderConfig.policyholder_activity = cfg["policyholder_activity"]
 
+    def _configure_imports(self, cfg):
+        PolicyholderConfig.insuree_import_chunk_size = cfg["insuree_import_chunk_size"]
+        PolicyholderConfig.insuree_import_max_parallel_chunks = cfg["insuree_import_max_parallel_chunks"]
+        PolicyholderConfig.insuree_import_progress_every_rows = cfg["insuree_import_progress_every_rows"]
+        PolicyholderConfig.insuree_import_progress_every_seconds = cfg["insuree_import_progress_every_seconds"]
+        PolicyholderConfig.insuree_import_progress_cache = cfg["insuree_import_progress_cache"]
+        PolicyholderConfig.insuree_import_progress_cache_timeout = cfg["insuree_import_progress_cache_timeout"]
+        PolicyholderConfig.insuree_import_progress_stream_timeout = cfg["insuree_import_progress_stream_timeout"]
+        PolicyholderConfig.insuree_import_progress_stream_interval = cfg["insuree_import_progress_stream_interval"]
+        PolicyholderConfig.insuree_import_outbox_enabled = cfg["insuree_import_outbox_enabled"]
+        PolicyholderConfig.insuree_import_outbox_batch_size = cfg["insuree_import_outbox_batch_size"]
+        PolicyholderConfig.insuree_import_outbox_max_attempts = cfg["insuree_import_outbox_max_attempts"]
+        PolicyholderConfig.insuree_import_outbox_retry_delay = cfg["insuree_import_outbox_retry_delay"]
+        PolicyholderConfig.insuree_import_outbox_concurrency = cfg["insuree_import_outbox_concurrency"]
+        PolicyholderConfig.insuree_import_chf_id_block_size = cfg["insuree_import_chf_id_block_size"]
+        PolicyholderConfig.insuree_import_stale_after = cfg["insuree_import_stale_after"]
+        PolicyholderConfig.insuree_import_max_resumes = cfg["insuree_import_max_resumes"]
+        PolicyholderConfig.insuree_import_reuse_completed_reports = cfg["insuree_import_reuse_completed_reports"]
+        PolicyholderConfig.insuree_import_skip_unchanged_rows = cfg["insuree_import_skip_unchanged_rows"]
+        PolicyholderConfig.insuree_import_storage_backend = cfg["insuree_import_storage_backend"]
+        PolicyholderConfig.insuree_import_local_storage_dir = cfg["insuree_import_local_storage_dir"]
+        PolicyholderConfig.insuree_import_inline_max_bytes = cfg["insuree_import_inline_max_bytes"]
+        PolicyholderConfig.insuree_import_shared_dir = cfg["insuree_import_shared_dir"]
+        PolicyholderConfig.insuree_import_large_file_min_bytes = cfg["insuree_import_large_file_min_bytes"]
+        PolicyholderConfig.insuree_import_max_active_large = cfg["insuree_import_max_active_large"]
+        PolicyholderConfig.insuree_import_small_queue = cfg["insuree_import_small_queue"]
+        PolicyholderConfig.insuree_import_large_queue = cfg["insuree_import_large_queue"]
+        PolicyholderConfig.insuree_import_sync_max_rows = cfg["insuree_import_sync_max_rows"]
+        PolicyholderConfig.insuree_import_transaction_rows = cfg["insuree_import_transaction_rows"]
+
     def ready(self):
         from core.models import ModuleConfiguration
         cfg = ModuleConfiguration.get_or_default(MODULE_NAME, DEFAULT_CFG)
         self._configure_permissions(cfg)
         self._configure_coding(cfg)
+        self._configure_imports(cfg)
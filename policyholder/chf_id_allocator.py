@@ -0,0 +1,165 @@
+"""
+Block reservation of temporary CAMU numbers (chf_id) for bulk enrolment.
+
+Instead of calling temp_generate_employee_camu_registration_number() for every
+new insuree, the allocator asks it once for the next number of a
+(region code, enrolment category), reserves a block of numbers from there in
+PolicyHolderInsureeChfIdReservation under a row lock and hands them out from
+memory. Parallel import workers serialize on that row only once per block and
+always get disjoint ranges. The unused end of a block is given back when the
+import ends, if nobody reserved after it; otherwise it is logged and left as a
+gap, numbers are never handed out twice.
+
+Inside the transaction of an import chunk the reservation row stays locked
+until the chunk commits, the import commits right after a reservation
+(uncommitted_keys) and drops the blocks whose reservation was rolled back.
+
+Numbers generated outside of the imports (reserve_chf_id()) go through the
+same row, one at a time, so they never fall in a block an import hands out.
+"""
+import logging
+import re
+
+from django.db import transaction
+
+from insuree.gql_mutations import temp_generate_employee_camu_registration_number
+
+from policyholder.apps import PolicyholderConfig
+from policyholder.models import PolicyHolderInsureeChfIdReservation
+
+logger = logging.getLogger(__name__)
+
+CHF_ID_COUNTER_PATTERN = re.compile(r"^(.*?)(\d+)$")
+
+
+def split_chf_id(chf_id):
+    """Split a temporary CAMU number in (prefix, counter, counter width), None without trailing digits."""
+    match = CHF_ID_COUNTER_PATTERN.match(str(chf_id or ""))
+    if not match:
+        return None
+    prefix, digits = match.groups()
+    return prefix, int(digits), len(digits)
+
+
+def format_chf_id(prefix, value, width):
+    return f"{prefix}{str(value).zfill(width)}"
+
+
+class ChfIdBlock:
+    def __init__(self, prefix, width, start, end):
+        self.prefix = prefix
+        self.width = width
+        self.next_value = start
+        self.end = end
+
+    @property
+    def exhausted(self):
+        return self.next_value >= self.end
+
+    def take(self):
+        value = self.next_value
+        self.next_value += 1
+        return format_chf_id(self.prefix, value, self.width)
+
+
+class ChfIdBlockAllocator:
+    """
+    Hands out temporary CAMU numbers reserved ``block_size`` at a time, to be
+    used for the duration of an import chunk and then release()d.
+    """
+
+    def __init__(self, block_size=None):
+        self.block_size = block_size or PolicyholderConfig.insuree_import_chf_id_block_size
+        self._blocks = {}
+        # reservations made in a transaction still open
+        self.uncommitted_keys = set()
+
+    def allocate(self, region_code, enrolment_category, generator_data):
+        """
+        Next number for the region and category, ``generator_data`` is what
+        temp_generate_employee_camu_registration_number() expects.
+        """
+        key = (region_code, enrolment_category)
+        block = self._blocks.get(key)
+        if block is None or block.exhausted:
+            block = self._reserve(key, generator_data)
+            if block is None:
+                return temp_generate_employee_camu_registration_number(None, generator_data)
+            self._blocks[key] = block
+        return block.take()
+
+    def _reserve(self, key, generator_data):
+        region_code, enrolment_category = key
+        PolicyHolderInsureeChfIdReservation.objects.get_or_create(
+            region_code=region_code,
+            enrolment_category=enrolment_category,
+            defaults={"prefix": "", "counter_width": 0, "next_value": 0},
+        )
+        with transaction.atomic():
+            reservation = PolicyHolderInsureeChfIdReservation.objects.select_for_update().get(
+                region_code=region_code, enrolment_category=enrolment_category
+            )
+            # numbers created outside the imports move the start forward
+            seed = split_chf_id(temp_generate_employee_camu_registration_number(None, generator_data))
+            if seed is None:
+                logger.warning(f"Temporary CAMU numbers of {key} have no counter, reserving them one by one")
+                return None
+
+            prefix, start, width = seed
+            if reservation.prefix == prefix and reservation.counter_width == width:
+                start = max(start, reservation.next_value)
+            end = min(start + self.block_size, 10 ** width)
+            if start >= end:
+                logger.warning(f"Temporary CAMU numbers of {key} exhausted their {width} digits")
+                return None
+
+            reservation.prefix = prefix
+            reservation.counter_width = width
+            reservation.next_value = end
+            reservation.save(update_fields=["prefix", "counter_width", "next_value", "updated_at"])
+
+        if transaction.get_connection().in_atomic_block:
+            self.uncommitted_keys.add(key)
+        return ChfIdBlock(prefix, width, start, end)
+
+    def mark_committed(self):
+        self.uncommitted_keys = set()
+
+    def discard_uncommitted(self):
+        """Forget the blocks whose reservation was rolled back, their numbers may be reserved again."""
+        for key in self.uncommitted_keys:
+            self._blocks.pop(key, None)
+        self.uncommitted_keys = set()
+
+    def release(self):
+        """Give back the unused end of the blocks nobody reserved after."""
+        for (region_code, enrolment_category), block in self._blocks.items():
+            if block.exhausted:
+                continue
+            released = PolicyHolderInsureeChfIdReservation.objects.filter(
+                region_code=region_code,
+                enrolment_category=enrolment_category,
+                prefix=block.prefix,
+                counter_width=block.width,
+                next_value=block.end,
+            ).update(next_value=block.next_value)
+            if not released:
+                logger.info(
+                    f"Temporary CAMU numbers {format_chf_id(block.prefix, block.next_value, block.width)} to "
+                    f"{format_chf_id(block.prefix, block.end - 1, block.width)} left unused"
+                )
+        self._blocks = {}
+
+
+def reserve_chf_id(region_code, enrolment_category, generator_data):
+    """A single temporary CAMU number, reserved like the blocks of the imports."""
+    return ChfIdBlockAllocator(block_size=1).allocate(region_code, enrolment_category, generator_data)
+
+
+def get_chf_id_allocator():
+    """
+    A new allocator for an import. With a block size of 1 every number is
+    reserved on its own, the import still commits right after each reservation
+    so that the reservation row is not locked for a whole chunk.
+    """
+    return ChfIdBlockAllocator()
@@ -348,14 +348,16 @@ def documents_check_after_cat_change(temp_camu):
     return False
 
 
-def validate_enrolment_type(line, new_enrolment_type):
-    from policyholder.views import HEADER_INSUREE_ID, HEADER_INSUREE_CAMU_NO
+def validate_enrolment_type(line, new_enrolment_type, context=None):
+    from policyholder.import_utils import HEADER_INSUREE_ID, HEADER_INSUREE_CAMU_NO
     insuree_id = line.get(HEADER_INSUREE_ID, '')
     camu_num = line.get(HEADER_INSUREE_CAMU_NO, '')
     insuree = None
     logger.debug(
         f"Input: Insuree ID - {insuree_id}, CAMU Number - {camu_num}, New Enrolment Type - {new_enrolment_type}")
-    if insuree_id:
+    if context is not None:
+        insuree = context.get_insuree(line, camu_fallback=False)
+    elif insuree_id:
         insuree = Insuree.objects.filter(validity_to__isnull=True, chf_id=insuree_id).first()
     elif camu_num:
         insuree = Insuree.objects.filter(validity_to__isnull=True, camu_number=camu_num).first()
@@ -263,7 +263,7 @@ class CreatePolicyHolderInsureeMutation(
             id=contribution_plan_bundle_id, name="Etudiants"
         ).first()
 
-        from policyholder.views import MINIMUM_AGE_LIMIT, MINIMUM_AGE_LIMIT_FOR_STUDENTS
+        from policyholder.import_utils import MINIMUM_AGE_LIMIT, MINIMUM_AGE_LIMIT_FOR_STUDENTS
 
         if is_insuree:
             raise ValidationError(message="Already Exists")
@@ -0,0 +1,243 @@
+"""
+Synthetic benchmark of the policyholder insuree import, see the
+benchmark_insuree_import management command.
+
+A workbook with the French headers of the import template is generated and
+run through import_policyholder_insurees_async end to end, in the current
+process, report rendering included. S3, the DMS, ABIS, the workflow and the emails are replaced by local
+stand-ins; the database work is real. Each run reports rows/sec, queries per
+row, the peak RSS of the process and the time and queries of every stage.
+"""
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+import uuid
+from collections import Counter
+from contextlib import ExitStack
+from datetime import date, timedelta
+from unittest import mock
+
+import openpyxl
+from django.db import transaction
+from django.utils import timezone
+
+from insuree.models import Insuree
+from location.models import Location
+
+from policyholder.apps import PolicyholderConfig
+from policyholder.import_outbox import OUTBOX_HANDLERS, drain_outbox_target
+from policyholder.import_storage import get_import_file_storage
+from policyholder.import_timing import ImportStageTimer, merge_stage_timings
+from policyholder.import_utils import IMPORT_COLUMN_MAPPING
+from policyholder.models import (
+    PolicyHolderInsureeBatchUpload,
+    PolicyHolderInsureeImportOutbox,
+    PolicyHolderInsureeUploadedFile,
+)
+
+LAST_NAMES = [
+    "MAKOSSO", "NGOUABI", "MASSAMBA", "LOUBAKI", "MOUKOKO", "BOUANGA", "NKOUKA",
+    "MABIALA", "MIALOUNDAMA", "OKEMBA", "NGOMA", "MOUANDA", "ITOUA", "ONDONGO",
+]
+FIRST_NAMES = [
+    "Jean", "Marie", "Pierre", "Grâce", "Chancel", "Merveille", "Prince",
+    "Divine", "Exaucé", "Bénédicte", "Rodrigue", "Espérance", "Hervé", "Élodie",
+]
+CIVILITIES = ["Marié", "Célibataire", "Divorcé", "Veuf/veuve"]
+
+BENCHMARK_SIZES = (1000, 10000, 100000)
+
+
+class BenchmarkRollback(Exception):
+    pass
+
+
+def get_benchmark_village_codes(limit=50):
+    """Codes of villages having a region, as the temporary CAMU number needs one."""
+    return list(
+        Location.objects.filter(
+            type="V", validity_to__isnull=True, parent__parent__parent__isnull=False
+        ).order_by("id").values_list("code", flat=True)[:limit]
+    )
+
+
+def get_benchmark_existing_chf_ids(limit):
+    return list(
+        Insuree.objects.filter(validity_to__isnull=True, chf_id__isnull=False)
+        .order_by("-id").values_list("chf_id", flat=True)[:limit]
+    )
+
+
+def generate_import_workbook(
+    path, rows, village_codes, existing_chf_ids=(), existing_ratio=0.1, invalid_ratio=0.02, seed=0
+):
+    """
+    Write a workbook of ``rows`` insurees under the import template headers.
+    About ``existing_ratio`` of the rows reference ``existing_chf_ids`` and
+    ``invalid_ratio`` of them carry an unknown village or a bad date of birth.
+    """
+    rng = random.Random(seed)
+    existing_chf_ids = list(existing_chf_ids)
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    headers = list(IMPORT_COLUMN_MAPPING)
+    sheet.append(headers)
+
+    for index in range(rows):
+        dob = date(1950, 1, 1) + timedelta(days=rng.randrange(0, 365 * 55))
+        village = rng.choice(village_codes)
+        values = {
+            "Nom": rng.choice(LAST_NAMES),
+            # unique names, so rows are not rejected as name/date of birth duplicates
+            "Prénom": f"{rng.choice(FIRST_NAMES)} {index:06d}",
+            "Date de naissance": dob if rng.random() < 0.5 else dob.strftime("%d/%m/%Y"),
+            "Lieu de naissance": village,
+            "Sexe": rng.choice(["M", "F"]),
+            "Civilité": rng.choice(CIVILITIES),
+            "Téléphone": f"06{rng.randrange(10 ** 7):07d}",
+            "Adresse": f"{rng.randrange(1, 300)} rue {rng.choice(LAST_NAMES).title()}",
+            "Village": village,
+            "Email": f"assure{index}@example.org" if rng.random() < 0.3 else None,
+        }
+        draw = rng.random()
+        if existing_chf_ids and draw < existing_ratio:
+            values["Numéro CAMU temporaire"] = rng.choice(existing_chf_ids)
+        elif draw > 1 - invalid_ratio:
+            if rng.random() < 0.5:
+                values["Village"] = "INCONNU"
+            else:
+                values["Date de naissance"] = "31/02/1990"
+        sheet.append([values.get(header) for header in headers])
+
+    workbook.save(path)
+    return path
+
+
+class LocalStandIns:
+    """
+    Local replacements of S3 (the local import file storage in ``storage_dir``)
+    and of the external systems called by imports.
+    Every external call sleeps ``latency`` seconds and is counted.
+    """
+
+    def __init__(self, storage_dir, latency=0.0):
+        self.storage_dir = storage_dir
+        self.latency = latency
+        self.calls = Counter()
+
+    def external_call(self, name):
+        def call(*args, **kwargs):
+            self.calls[name] += 1
+            if self.latency:
+                time.sleep(self.latency)
+        return call
+
+    def patches(self):
+        return [
+            mock.patch.object(PolicyholderConfig, "insuree_import_storage_backend", "local"),
+            mock.patch.object(PolicyholderConfig, "insuree_import_local_storage_dir", self.storage_dir),
+            mock.patch.dict(OUTBOX_HANDLERS, {target: self.external_call(target) for target in OUTBOX_HANDLERS}),
+            mock.patch("policyholder.import_utils.create_folder_for_cat_chnage_req", self.external_call("DMS_CATEGORY_CHANGE")),
+            mock.patch("policyholder.import_utils.send_notification_to_head", self.external_call("EMAIL_HEAD")),
+            # the benchmark drains the outbox itself
+            mock.patch("policyholder.tasks.dispatch_import_outbox_on_commit", lambda: None),
+            # chords need a broker, chunks are benchmarked serially
+            mock.patch.object(PolicyholderConfig, "insuree_import_max_parallel_chunks", 1),
+        ]
+
+
+def peak_rss_mb():
+    """Peak resident set size of the process so far (ru_maxrss is in KB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if os.uname().sysname == "Darwin" else 1024), 1)
+
+
+def run_import_benchmark(rows, policy_holder, user, village_codes, latency=0.0, rollback=False, seed=0):
+    """
+    Generate and import a workbook of ``rows`` rows, returns the measures of the run.
+    With ``rollback`` the run is wrapped in a transaction rolled back at the end,
+    otherwise the import commits like in production (use a disposable database).
+    """
+    from policyholder.tasks import import_policyholder_insurees_async
+
+    work_dir = tempfile.mkdtemp(prefix="insuree_import_benchmark_")
+    path = os.path.join(work_dir, f"benchmark_{rows}.xlsx")
+    generate_started = time.perf_counter()
+    generate_import_workbook(
+        path, rows, village_codes, get_benchmark_existing_chf_ids(max(1, rows // 10)), seed=seed
+    )
+    generate_seconds = time.perf_counter() - generate_started
+
+    stand_ins = LocalStandIns(os.path.join(work_dir, "storage"), latency=latency)
+    timer = ImportStageTimer()
+    report = {"rows": rows, "generate_seconds": round(generate_seconds, 3)}
+
+    try:
+        with ExitStack() as stack:
+            if rollback:
+                stack.enter_context(transaction.atomic())
+            for patch in stand_ins.patches():
+                stack.enter_context(patch)
+
+            object_key = f"benchmark/{uuid.uuid4()}/{os.path.basename(path)}"
+            get_import_file_storage().save(path, object_key)
+            uploaded_file = PolicyHolderInsureeUploadedFile.objects.create(
+                policy_holder=policy_holder, file_name_hash=uuid.uuid4().hex, file_path=object_key
+            )
+            batch_upload = PolicyHolderInsureeBatchUpload.objects.create(
+                policy_holder=policy_holder,
+                input_file_name=os.path.basename(path),
+                created_by=user,
+                uploaded_file=uploaded_file,
+                celery_task_id=str(uuid.uuid4()),
+                # run right away, not through the import queue
+                dispatched_at=timezone.now(),
+            )
+
+            with timer:
+                started = time.perf_counter()
+                result = import_policyholder_insurees_async.apply(
+                    kwargs={
+                        "user_id": user.id,
+                        "policyholder_code": policy_holder.code,
+                        "batch_upload_id": str(batch_upload.id),
+                        "uploaded_file_record_id": str(uploaded_file.id),
+                    },
+                    task_id=batch_upload.celery_task_id,
+                )
+                import_seconds = time.perf_counter() - started
+
+                with timer.stage("outbox_delivery"):
+                    for target in OUTBOX_HANDLERS:
+                        drain_outbox_target(target)
+
+            batch_upload.refresh_from_db()
+            report.update({
+                "status": batch_upload.status,
+                "error": batch_upload.error_message or (str(result.result) if result.failed() else None),
+                "success_count": batch_upload.success_count,
+                "error_count": batch_upload.error_count,
+                "import_seconds": round(import_seconds, 3),
+                "rows_per_second": round(rows / import_seconds, 1) if import_seconds else None,
+                "outbox_entries": PolicyHolderInsureeImportOutbox.objects.filter(
+                    created_at__gte=batch_upload.created_at
+                ).count(),
+                "external_calls": dict(stand_ins.calls),
+                # stages recorded by the import itself, plus the outbox drain
+                "stages": merge_stage_timings(batch_upload.stage_timings, timer.as_dict()),
+            })
+            report["queries"] = timer.queries
+            report["queries_per_row"] = round(timer.queries / rows, 2) if rows else None
+
+            if rollback:
+                raise BenchmarkRollback()
+    except BenchmarkRollback:
+        pass
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report["peak_rss_mb"] = peak_rss_mb()
+    return report
@@ -0,0 +1,81 @@
+"""
+Checkpoints of policyholder insuree imports.
+
+Every batch of rows ends with a PolicyHolderInsureeImportResultChunk covering
+the rows processed since the previous checkpoint, written with their results
+in the transaction that saves their PolicyHolderInsuree links and queues their
+side effects. A run interrupted by a worker crash or a timeout is resumed with
+the rows no chunk covers, the completed rows are neither processed nor
+notified twice.
+"""
+from policyholder.import_engine import ImportResultSink
+from policyholder.import_results import save_import_results
+from policyholder.models import PolicyHolderInsureeImportResultChunk
+
+
+class ImportCheckpointer(ImportResultSink):
+    """
+    Result sink of a batch upload: writes the checkpoints of one contiguous run
+    of rows starting at ``start_row``, with the results of the rows done since
+    the previous one.
+    """
+
+    def __init__(self, batch_upload, start_row):
+        self.batch_upload = batch_upload
+        self.start_row = start_row
+        self._saved_results = 0
+        self._success_count = 0
+        self._error_count = 0
+
+    def checkpoint(self, end_row, results_data, success_count, error_count):
+        if end_row <= self.start_row:
+            return
+        save_import_results(self.batch_upload, results_data[self._saved_results:])
+        PolicyHolderInsureeImportResultChunk.objects.create(
+            batch_upload=self.batch_upload,
+            start_row=self.start_row,
+            end_row=end_row,
+            success_count=success_count - self._success_count,
+            error_count=error_count - self._error_count,
+        )
+        self.start_row = end_row
+        self._saved_results = len(results_data)
+        self._success_count = success_count
+        self._error_count = error_count
+
+
+def get_checkpointed_ranges(batch_upload):
+    """Merged [start, end) row ranges already covered by checkpoints."""
+    ranges = []
+    for start, end in batch_upload.result_chunks.order_by("start_row").values_list("start_row", "end_row"):
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], end))
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+def get_pending_row_ranges(batch_upload, total_rows):
+    """[start, end) row ranges of the sheet still to be processed."""
+    pending = []
+    position = 0
+    for start, end in get_checkpointed_ranges(batch_upload):
+        if start > position:
+            pending.append((position, min(start, total_rows)))
+        position = max(position, end)
+    if position < total_rows:
+        pending.append((position, total_rows))
+    return [(start, end) for start, end in pending if start < end]
+
+
+def get_checkpointed_counters(batch_upload):
+    """(processed_rows, success_count, error_count) of the checkpointed rows."""
+    processed_rows = success_count = error_count = 0
+    for start, end, success, error in batch_upload.result_chunks.values_list(
+        "start_row", "end_row", "success_count", "error_count"
+    ):
+        processed_rows += end - start
+        success_count += success
+        error_count += error
+    return processed_rows, success_count, error_count
+
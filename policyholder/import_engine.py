@@ -0,0 +1,637 @@
+"""
+Row pipeline of policyholder insuree imports, shared by the synchronous
+endpoint (views.import_phi) and the import tasks.
+
+process_insuree_import_rows() reads (index, row) pairs from a row source,
+iter_import_rows() over a whole sheet or a slice of it, and hands every result
+to a sink:
+
+* ImportCheckpointer (import_checkpoint) stores the results and checkpoints of
+  a batch upload, in the transaction saving the links of each batch of rows;
+* InlineXlsxReportSink keeps the rows of a small file for the xlsx report the
+  synchronous endpoint answers with.
+
+Writes are committed insuree_import_transaction_rows rows at a time, and at
+least at the end of every batch of rows (ImportTransactionChunks), together with
+their checkpoint. A failing row rolls back to its own savepoint and is reported
+as an error.
+"""
+import io
+import logging
+from contextlib import nullcontext
+
+import pandas as pd
+import xlsxwriter
+from django.db import transaction
+
+from policyholder.apps import PolicyholderConfig
+from policyholder.chf_id_allocator import get_chf_id_allocator
+from policyholder.dms_utils import validate_enrolment_type
+from policyholder.import_fingerprint import (
+    forget_row_fingerprints,
+    get_import_row_fingerprints,
+    save_row_fingerprints,
+)
+from policyholder.import_outbox import enqueue_attached_insuree_side_effects
+from policyholder.import_timing import ImportStageTimer
+from policyholder.import_utils import (
+    HEADER_DELETE,
+    HEADER_FAMILY_LOCATION_CODE,
+    HEADER_INSUREE_CAMU_NO,
+    HEADER_INSUREE_ID,
+    HEADER_INSUREE_LAST_NAME,
+    HEADER_INSUREE_OTHER_NAMES,
+    ImportFamilyBuilder,
+    check_for_category_change_request,
+    clean_line,
+    get_import_minimum_age,
+    get_or_create_insuree_from_line,
+    get_village_from_line,
+    is_delete_flagged,
+    iter_rows_with_context,
+    name_dob_key,
+    soft_delete_insurees,
+    validating_insuree_on_name_dob,
+)
+from policyholder.models import PolicyHolderContributionPlan, PolicyHolderInsuree
+
+logger = logging.getLogger(__name__)
+
+# remarks of the rows a dry run would import or delete
+DRY_RUN_VALID = "Ligne valide"
+DRY_RUN_DELETE = "Sera supprimé"
+
+INLINE_REPORT_SUCCESS = "Réussite"
+INLINE_REPORT_FAILURE = "Échec"
+INLINE_REPORT_ATTACHED = "L'assuré a été bien rattaché au souscripteur"
+
+
+class ImportResultSink:
+    """
+    Destination of the results of process_insuree_import_rows(). add() receives
+    each row with its result entry (build_result_entry()) once the row is
+    processed. checkpoint() runs in the transaction saving the links of the
+    rows before ``end_row``, the entries of a batch whose links could not be
+    saved are already turned into errors by then.
+    """
+
+    def add(self, index, row, result_entry):
+        pass
+
+    def checkpoint(self, end_row, results_data, success_count, error_count):
+        pass
+
+
+class InlineXlsxReportSink(ImportResultSink):
+    """
+    Report of the synchronous import: the uploaded columns of every row followed
+    by its Status and Reason. Rows are kept in memory, for small files only.
+    """
+
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self.rows = []
+
+    def add(self, index, row, result_entry):
+        # the entry is read when rendering, a failed link save still shows
+        self.rows.append((list(row.values()), result_entry))
+
+    def get_status_code(self):
+        """HTTP status of the legacy endpoint: 417 for unknown villages, 422 for invalid rows."""
+        remarks = [entry["remarque"] for _, entry in self.rows if entry["Etat"] == "KO"]
+        if any(remark.startswith("Village inconnu") for remark in remarks):
+            return 417
+        if any(
+            remark.startswith(("Format de date invalide", "L'assuré doit être âgé", "Champs obligatoires"))
+            for remark in remarks
+        ):
+            return 422
+        return 200
+
+    def render(self):
+        output = io.BytesIO()
+        workbook = xlsxwriter.Workbook(output, {"in_memory": True})
+        sheet = workbook.add_worksheet("Processed Data")
+        sheet.write_row(0, 0, self.columns + ["Status", "Reason"])
+        for row_number, (values, entry) in enumerate(self.rows, start=1):
+            if entry["Etat"] != "OK":
+                status, reason = INLINE_REPORT_FAILURE, entry["remarque"]
+            elif entry["remarque"] == "-":
+                status, reason = INLINE_REPORT_SUCCESS, INLINE_REPORT_ATTACHED
+            else:
+                status, reason = INLINE_REPORT_SUCCESS, entry["remarque"]
+            sheet.write_row(row_number, 0, ["" if value is None else value for value in values] + [status, reason])
+        workbook.close()
+        return output.getvalue()
+
+
+class ImportTransactionChunks:
+    """
+    Transactions of process_insuree_import_rows(): rows are committed ``size``
+    at a time, each row in a savepoint of its own (savepoint()), and every
+    transaction ends with the checkpoint of its rows. A ``size`` of 0 sets no
+    row limit, the transaction then only ends with the batch of rows. With a
+    ``size`` of None every write commits on its own, as without a transaction.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.rows = 0
+        self._atomic = None
+
+    @property
+    def active(self):
+        return self._atomic is not None
+
+    @property
+    def full(self):
+        return bool(self.size) and self.rows >= self.size
+
+    def begin(self):
+        """Count the next row, in the open transaction or in a new one."""
+        if self._atomic is None and self.size is not None:
+            self._atomic = transaction.atomic()
+            self._atomic.__enter__()
+            self.rows = 0
+        self.rows += 1
+
+    def commit(self):
+        """Commit the open transaction, returns whether there was one."""
+        if self._atomic is None:
+            return False
+        atomic, self._atomic = self._atomic, None
+        atomic.__exit__(None, None, None)
+        return True
+
+    def savepoint(self):
+        return transaction.atomic() if self.active else nullcontext()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # the last transaction commits, or rolls back with the exception
+        if self._atomic is not None:
+            atomic, self._atomic = self._atomic, None
+            atomic.__exit__(exc_type, exc_value, traceback)
+        return False
+
+
+def build_result_entry(line, index, chf_id, status, nom="", prenom=""):
+    """
+    Build a result entry in the format: ligne, numero_camu, nom, prenom, Etat, remarque
+    """
+    etat = "OK" if status in ["Succès", "Aucun changement", DRY_RUN_VALID, DRY_RUN_DELETE] else "KO"
+    remarque = "-" if status == "Succès" else status
+
+    if chf_id and pd.notna(chf_id):
+        chf_id_str = str(chf_id)
+        # Clean up float-like strings (e.g. "12345.0" -> "12345")
+        if '.' in chf_id_str and chf_id_str.replace('.', '', 1).replace('-', '', 1).isdigit():
+            try:
+                chf_id_str = str(int(float(chf_id_str)))
+            except (ValueError, OverflowError):
+                pass
+        numero_camu = chf_id_str
+    else:
+        numero_camu = ""
+
+    return {
+        "ligne": index + 1,
+        "numero_camu": numero_camu,
+        "nom": nom,
+        "prenom": prenom,
+        "Etat": etat,
+        "remarque": remarque,
+    }
+
+def get_import_contribution_plan_bundle(policyholder):
+    ph_cpb = PolicyHolderContributionPlan.objects.filter(
+        policy_holder=policyholder, is_deleted=False
+    ).first()
+
+    if not ph_cpb:
+        raise Exception("No contribution plan bundle found for policyholder")
+
+    return ph_cpb.contribution_plan_bundle
+
+
+def _upsert_import_links(pending_links, user, timer):
+    links = [link for _, link, _ in pending_links]
+    with timer.stage("phi_upsert"):
+        saved_links = PolicyHolderInsuree.objects.bulk_upsert(links, user.username)
+        save_row_fingerprints(
+            links[0].policy_holder,
+            [(row_fingerprint, link.insuree) for _, link, row_fingerprint in pending_links if row_fingerprint],
+        )
+    with timer.stage("side_effects"):
+        for link, (phi, _) in zip(links, saved_links):
+            # notification and email are delivered by the outbox workers
+            enqueue_attached_insuree_side_effects(phi, link.insuree, user=user)
+
+
+def save_import_links(pending_links, user, timer=None, on_saved=None):
+    """
+    Upsert the PolicyHolderInsuree links of a batch of imported rows and queue
+    their side effects in one transaction. ``pending_links`` holds
+    (result entry, unsaved link, RowFingerprint or None) triples and is emptied.
+    When the batch cannot be saved, each link is saved again in its own
+    savepoint so that only the rows whose link fails are turned into errors.
+    ``on_saved(saved, failed)`` runs in that transaction.
+    Returns (saved, failed) row counts.
+    """
+    if not pending_links:
+        if on_saved:
+            on_saved(0, 0)
+        return 0, 0
+
+    timer = timer or ImportStageTimer()
+    saved, failed = len(pending_links), 0
+    with transaction.atomic():
+        try:
+            with transaction.atomic():
+                _upsert_import_links(pending_links, user, timer)
+        except Exception as e:
+            logger.warning(f"Failed to save {len(pending_links)} policyholder insuree links at once, "
+                           f"saving them one by one: {e}")
+            saved = 0
+            for pending_link in pending_links:
+                result_entry, link, _ = pending_link
+                try:
+                    with transaction.atomic():
+                        _upsert_import_links([pending_link], user, timer)
+                    saved += 1
+                except Exception as e:
+                    logger.error(f"Failed to save the policyholder insuree link of {link.insuree}: {e}", exc_info=True)
+                    result_entry["Etat"] = "KO"
+                    result_entry["remarque"] = f"Erreur: {str(e)}"
+                    failed += 1
+        if on_saved:
+            on_saved(saved, failed)
+
+    pending_links.clear()
+    return saved, failed
+
+
+def create_import_families(family_builder, pending_links, timer=None):
+    """
+    Build the families queued in ``family_builder`` (ImportFamilyBuilder) for
+    a batch of rows. When they cannot be created, the rows of their heads are
+    turned into errors and dropped from ``pending_links`` (see save_import_links()).
+    Returns (ids of the heads left without a family, failed row count).
+    """
+    if not family_builder.pending:
+        return set(), 0
+
+    timer = timer or ImportStageTimer()
+    heads = set(family_builder.pending)
+    try:
+        with timer.stage("family"):
+            family_builder.build()
+        return set(), 0
+    except Exception as e:
+        logger.error(f"Failed to create {len(heads)} families: {e}", exc_info=True)
+
+    failed = 0
+    for result_entry, link, _ in pending_links:
+        if link.insuree.id in heads:
+            result_entry["Etat"] = "KO"
+            result_entry["remarque"] = "Impossible de créer ou de trouver la famille."
+            failed += 1
+    pending_links[:] = [pending for pending in pending_links if pending[1].insuree.id not in heads]
+    return heads, failed
+
+
+def delete_import_links(pending_deletes, policyholder, timer=None, dry_run=False):
+    """
+    End the links to ``policyholder`` of the delete-flagged rows of a batch
+    with soft_delete_insurees(). ``pending_deletes`` holds (result entry, row,
+    insuree) triples and is emptied, the entries of the insurees without a
+    link, or of a failed batch, are turned into errors.
+    Returns (deleted, not deleted) row counts.
+    """
+    if not pending_deletes:
+        return 0, 0
+
+    timer = timer or ImportStageTimer()
+    try:
+        with timer.stage("delete"), transaction.atomic():
+            linked = soft_delete_insurees(
+                [insuree for _, _, insuree in pending_deletes], policyholder.code, dry_run=dry_run
+            )
+            if not dry_run:
+                forget_row_fingerprints(
+                    policyholder, [row for _, row, insuree in pending_deletes if insuree.id in linked]
+                )
+    except Exception as e:
+        logger.error(f"Failed to delete {len(pending_deletes)} policyholder insuree links: {e}", exc_info=True)
+        for result_entry, _, _ in pending_deletes:
+            result_entry["Etat"] = "KO"
+            result_entry["remarque"] = f"Erreur: {str(e)}"
+        failed = len(pending_deletes)
+        pending_deletes.clear()
+        return 0, failed
+
+    deleted = 0
+    for result_entry, _, insuree in pending_deletes:
+        if insuree.id in linked:
+            # a second row of the same insuree finds the link already ended
+            linked.discard(insuree.id)
+            deleted += 1
+        else:
+            result_entry["Etat"] = "KO"
+            result_entry["remarque"] = "Erreur: Assuré non trouvé"
+    not_deleted = len(pending_deletes) - deleted
+    pending_deletes.clear()
+    return deleted, not_deleted
+
+
+def _make_checkpoint_callback(sink, end_row, results_data, success_count, error_count):
+    """``on_saved`` of save_import_links() checkpointing ``sink`` with the counters of the saved rows added."""
+    def on_saved(saved, failed):
+        sink.checkpoint(end_row, results_data, success_count + saved, error_count + failed)
+    return on_saved
+
+
+def process_insuree_import_rows(
+    rows, user, policyholder, cpb, progress_callback=None, timer=None, sink=None, dry_run=False
+):
+    """
+    Run the import row pipeline over ``rows``, (index, row) pairs from a row
+    source such as iter_import_rows(). The sheet index is kept as is, so a
+    slice of the sheet produces the same ``ligne`` numbers as the whole sheet.
+    Time and queries of each stage are collected in ``timer`` (ImportStageTimer).
+    Results go to ``sink`` (ImportResultSink) as they are known.
+    A ``dry_run`` stops every row after the checks made against the preloaded
+    data (columns, date of birth, duplicates, village, enrolment type): nothing
+    is written and no side effect is queued, only the results are reported.
+    Returns (results_data, success_count, error_count).
+    """
+    timer = timer or ImportStageTimer()
+    user_id_for_audit = user.id_for_audit
+    enrolment_type = cpb.name if cpb else None
+
+    results_data = []
+    success_count = 0
+    error_count = 0
+    processed_rows = 0
+
+    pending_links = []
+    pending_deletes = []
+    pending_category_changes = []
+    family_builder = ImportFamilyBuilder(user_id_for_audit, enrolment_type)
+    batch_context = None
+    last_index = None
+
+    def add_result(index, row, result_entry):
+        results_data.append(result_entry)
+        if sink:
+            sink.add(index, row, result_entry)
+
+    def save_batch(end_row):
+        failed_heads, family_failed = create_import_families(family_builder, pending_links, timer)
+        for row, row_context, insuree_id in pending_category_changes:
+            if insuree_id in failed_heads:
+                continue
+            # its failures are ignored and only roll back the request
+            try:
+                with timer.stage("category_change"), chunks.savepoint():
+                    check_for_category_change_request(
+                        user, row, policyholder, enrolment_type, context=row_context
+                    )
+            except Exception as e:
+                logger.warning(f"Error in check_for_category_change_request: {e}")
+        pending_category_changes.clear()
+
+        deleted, not_deleted = delete_import_links(pending_deletes, policyholder, timer, dry_run=dry_run)
+        on_saved = _make_checkpoint_callback(
+            sink, end_row, results_data, success_count + deleted, error_count + family_failed + not_deleted
+        ) if sink else None
+        saved, failed = save_import_links(pending_links, user, timer, on_saved=on_saved)
+        return deleted + saved, family_failed + not_deleted + failed
+
+    # temporary CAMU numbers are reserved in blocks, a crash only leaves a gap
+    chf_id_allocator = None if dry_run else get_chf_id_allocator()
+
+    # Insurees, villages and families of each batch of rows are resolved up front
+    rows_with_context = iter_rows_with_context(
+        timer.wrap_iterator("parse", rows),
+        minimum_age=get_import_minimum_age(cpb),
+        timer=timer,
+        row_fingerprints=get_import_row_fingerprints(policyholder, cpb),
+    )
+    # a dry run writes nothing, its rows need no transaction
+    transaction_rows = None if dry_run else PolicyholderConfig.insuree_import_transaction_rows
+    with ImportTransactionChunks(transaction_rows) as chunks:
+        for index, row, context in timer.wrap_iterator("lookup", rows_with_context):
+            # rows before this one are done
+            batch_done = context is not batch_context
+            batch_context = context
+            last_index = index
+
+            # the reservation of a new block of CAMU numbers stays locked until its transaction commits
+            reserved = bool(chf_id_allocator and chf_id_allocator.uncommitted_keys)
+            if batch_done or (chunks.active and (chunks.full or reserved)):
+                # the rows of the transaction are saved and checkpointed before it commits,
+                # a resume never sees rows written without their checkpoint
+                saved, failed = save_batch(index)
+                success_count += saved
+                error_count += failed
+                if chunks.commit():
+                    if chf_id_allocator:
+                        chf_id_allocator.mark_committed()
+                    # between two transactions, the reporter writes the counters only there
+                    if progress_callback:
+                        progress_callback(processed_rows, success_count, error_count)
+            chunks.begin()
+
+            context.start_row()
+            try:
+                # a failing row only rolls back its own writes
+                with chunks.savepoint():
+                    clean_line(row)
+
+                    # Date of birth, minimum age and mandatory columns were checked for the whole batch
+                    error = context.prevalidation_errors.get(index)
+                    if error:
+                        chf_id = row.get(HEADER_INSUREE_ID) or row.get(HEADER_INSUREE_CAMU_NO) or ""
+                        nom = row.get(HEADER_INSUREE_LAST_NAME, "")
+                        prenom = row.get(HEADER_INSUREE_OTHER_NAMES, "")
+                        add_result(
+                            index, row, build_result_entry(row, index, chf_id, error, nom, prenom)
+                        )
+                        error_count += 1
+                        continue
+
+                    # same values as the last import of this insuree, still linked
+                    row_fingerprint = context.row_fingerprints.get(index)
+                    if row_fingerprint and row_fingerprint.unchanged:
+                        chf_id = (
+                            row_fingerprint.unchanged_chf_id or row.get(HEADER_INSUREE_ID) or row.get(HEADER_INSUREE_CAMU_NO) or ""
+                        )
+                        nom = row.get(HEADER_INSUREE_LAST_NAME, "")
+                        prenom = row.get(HEADER_INSUREE_OTHER_NAMES, "")
+                        add_result(
+                            index, row, build_result_entry(row, index, chf_id, "Aucun changement", nom, prenom)
+                        )
+                        success_count += 1
+                        continue
+
+                    if not row.get(HEADER_INSUREE_ID) and not row.get(HEADER_INSUREE_CAMU_NO):
+                        with timer.stage("validate"):
+                            existing_insuree = validating_insuree_on_name_dob(row, policyholder, context=context)
+                        if existing_insuree:
+                            error = "Un assuré ayant le même nom et la même date de naissance existe déjà, veuillez ajouter son numéro CAMU ou numéro temporaire."
+                            chf_id = row.get(HEADER_INSUREE_ID) or row.get(HEADER_INSUREE_CAMU_NO) or ""
+                            nom = row.get(HEADER_INSUREE_LAST_NAME, "")
+                            prenom = row.get(HEADER_INSUREE_OTHER_NAMES, "")
+                            add_result(
+                                index, row, build_result_entry(row, index, chf_id, error, nom, prenom)
+                            )
+                            error_count += 1
+                            continue
+
+                    if is_delete_flagged(row.get(HEADER_DELETE)):
+                        chf_id = row.get(HEADER_INSUREE_ID) or row.get(HEADER_INSUREE_CAMU_NO) or ""
+                        nom = row.get(HEADER_INSUREE_LAST_NAME, "")
+                        prenom = row.get(HEADER_INSUREE_OTHER_NAMES, "")
+                        insuree = context.get_insuree(row)
+                        if insuree:
+                            # the links of the batch are ended together, rows without one are turned into errors
+                            result_entry = build_result_entry(
+                                row, index, chf_id, DRY_RUN_DELETE if dry_run else "Supprimé avec succès", nom, prenom
+                            )
+                            add_result(index, row, result_entry)
+                            pending_deletes.append((result_entry, row, insuree))
+                        else:
+                            add_result(
+                                index, row, build_result_entry(row, index, chf_id, "Erreur: Assuré non trouvé", nom, prenom)
+                            )
+                            error_count += 1
+                        continue
+
+                    with timer.stage("lookup"):
+                        village = get_village_from_line(row, context=context)
+                    if not village:
+                        error = f"Village inconnu - {row.get(HEADER_FAMILY_LOCATION_CODE, '')}"
+                        chf_id = row.get(HEADER_INSUREE_ID) or row.get(HEADER_INSUREE_CAMU_NO) or ""
+                        nom = row.get(HEADER_INSUREE_LAST_NAME, "")
+                        prenom = row.get(HEADER_INSUREE_OTHER_NAMES, "")
+                        add_result(
+                            index, row, build_result_entry(row, index, chf_id, error, nom, prenom)
+                        )
+                        error_count += 1
+                        continue
+
+                    with timer.stage("validate"):
+                        is_valid_enrolment = validate_enrolment_type(row, enrolment_type, context=context)
+                    if not is_valid_enrolment:
+                        error = "Le type d'enrôlement doit être différent de 'étudiant."
+                        chf_id = row.get(HEADER_INSUREE_ID) or row.get(HEADER_INSUREE_CAMU_NO) or ""
+                        nom = row.get(HEADER_INSUREE_LAST_NAME, "")
+                        prenom = row.get(HEADER_INSUREE_OTHER_NAMES, "")
+                        add_result(
+                            index, row, build_result_entry(row, index, chf_id, error, nom, prenom)
+                        )
+                        error_count += 1
+                        continue
+
+                    if dry_run:
+                        if context.get_insuree(row) is None:
+                            # nothing is created, a later row with the same name and dob is still a duplicate
+                            context.register_name_dob(name_dob_key(row))
+                        chf_id = row.get(HEADER_INSUREE_ID) or row.get(HEADER_INSUREE_CAMU_NO) or ""
+                        nom = row.get(HEADER_INSUREE_LAST_NAME, "")
+                        prenom = row.get(HEADER_INSUREE_OTHER_NAMES, "")
+                        add_result(
+                            index, row, build_result_entry(row, index, chf_id, DRY_RUN_VALID, nom, prenom)
+                        )
+                        success_count += 1
+                        continue
+
+                    # CRITICAL: Pass 'user' object to utility function
+                    with timer.stage("insuree"):
+                        insuree, error = get_or_create_insuree_from_line(
+                            row,
+                            village,
+                            user_id_for_audit,
+                            user, # Pass the User object
+                            user.id,
+                            enrolment_type,
+                            context=context,
+                            chf_id_allocator=chf_id_allocator,
+                        )
+
+                    if error:
+                        chf_id = row.get(HEADER_INSUREE_ID) or row.get(HEADER_INSUREE_CAMU_NO) or ""
+                        nom = row.get(HEADER_INSUREE_LAST_NAME, "")
+                        prenom = row.get(HEADER_INSUREE_OTHER_NAMES, "")
+                        add_result(
+                            index, row, build_result_entry(row, index, chf_id, error, nom, prenom)
+                        )
+                        error_count += 1
+                        continue
+
+                    # new heads get their family with those of the batch, see create_import_families()
+                    with timer.stage("family"):
+                        has_family = family_builder.has_family(insuree, context)
+
+                    phi_json_ext = {}
+                    employer_number = None
+
+                    # links are upserted in bulk once the batch of rows is processed
+                    chf_id = insuree.chf_id or insuree.camu_number or ""
+                    nom = insuree.last_name or ""
+                    prenom = insuree.other_names or ""
+                    result_entry = build_result_entry(row, index, chf_id, "Succès", nom, prenom)
+                    add_result(index, row, result_entry)
+                    pending_links.append((
+                        result_entry,
+                        PolicyHolderInsuree(
+                            insuree=insuree,
+                            policy_holder=policyholder,
+                            contribution_plan_bundle=cpb,
+                            json_ext=phi_json_ext,
+                            employer_number=employer_number,
+                        ),
+                        row_fingerprint,
+                    ))
+                    if not has_family:
+                        family_builder.add(row, insuree, village, context=context)
+                    # run once the families of the batch exist, the request depends on them
+                    pending_category_changes.append((row, context, insuree.id))
+
+            except Exception as e:
+                logger.error(f"Error processing row {index + 1}: {str(e)}", exc_info=True)
+                if chunks.active:
+                    context.rollback_row(row)
+                    if chf_id_allocator:
+                        chf_id_allocator.discard_uncommitted()
+                chf_id = row.get(HEADER_INSUREE_ID) or row.get(HEADER_INSUREE_CAMU_NO) or ""
+                nom = row.get(HEADER_INSUREE_LAST_NAME, "")
+                prenom = row.get(HEADER_INSUREE_OTHER_NAMES, "")
+                add_result(
+                    index, row, build_result_entry(row, index, chf_id, f"Erreur: {str(e)}", nom, prenom)
+                )
+                error_count += 1
+            finally:
+                # counted even when the row ends early with "continue"
+                processed_rows += 1
+                if progress_callback:
+                    progress_callback(processed_rows, success_count, error_count)
+
+        if chf_id_allocator:
+            chf_id_allocator.release()
+
+        if last_index is not None:
+            saved, failed = save_batch(last_index + 1)
+            success_count += saved
+            error_count += failed
+        else:
+            saved = failed = 0
+
+    # also flushes the progress held back while the last chunk was open
+    if progress_callback and (saved or failed or transaction_rows is not None):
+        progress_callback(processed_rows, success_count, error_count)
+
+    return results_data, success_count, error_count
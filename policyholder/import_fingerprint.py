@@ -0,0 +1,181 @@
+"""
+Row fingerprints of policyholder insuree imports.
+
+Employers resend their whole roster every month. Every successfully imported
+row leaves the fingerprint of its normalized values in
+PolicyHolderInsureeImportFingerprint, keyed by the identity of the row for the
+policyholder. On the next import a row with the same fingerprint, whose insuree
+is still linked to the policyholder, is reported as "Aucun changement" without
+going through the insuree, family, link and side effect stages.
+"""
+import hashlib
+import json
+from datetime import date, datetime
+
+from django.utils import timezone
+
+from policyholder.apps import PolicyholderConfig
+from policyholder.import_utils import (
+    HEADERS,
+    HEADER_DELETE,
+    HEADER_INSUREE_CAMU_NO,
+    HEADER_INSUREE_DOB,
+    HEADER_INSUREE_ID,
+    HEADER_INSUREE_LAST_NAME,
+    HEADER_INSUREE_OTHER_NAMES,
+    _blank_to_none,
+    _chunks,
+    _normalize_lookup_value,
+    _parse_name_dob_date,
+    is_delete_flagged,
+)
+from policyholder.models import PolicyHolderInsuree, PolicyHolderInsureeImportFingerprint
+
+FINGERPRINT_HEADERS = [header for header in HEADERS if header != HEADER_DELETE]
+
+
+class RowFingerprint:
+    def __init__(self, key, fingerprint, unchanged_chf_id=None):
+        self.key = key
+        self.fingerprint = fingerprint
+        # temporary CAMU number of the insuree when the row did not change
+        self.unchanged_chf_id = unchanged_chf_id
+
+    @property
+    def unchanged(self):
+        return self.unchanged_chf_id is not None
+
+
+def get_row_key(row):
+    """Identity of a row for its policyholder: its CAMU numbers, else its name and date of birth."""
+    chf_id = _normalize_lookup_value(row.get(HEADER_INSUREE_ID))
+    if chf_id:
+        return f"id:{chf_id}"
+    camu_number = _normalize_lookup_value(row.get(HEADER_INSUREE_CAMU_NO))
+    if camu_number:
+        return f"camu:{camu_number}"
+    last_name = _blank_to_none(row.get(HEADER_INSUREE_LAST_NAME))
+    other_names = _blank_to_none(row.get(HEADER_INSUREE_OTHER_NAMES))
+    dob = _parse_name_dob_date(row.get(HEADER_INSUREE_DOB))
+    if last_name is None or other_names is None or dob is None:
+        return None
+    return f"name:{last_name}|{other_names}|{dob.isoformat()}"
+
+
+def _fingerprint_value(header, value):
+    value = _blank_to_none(value)
+    if value is None:
+        return None
+    if header == HEADER_INSUREE_DOB:
+        dob = _parse_name_dob_date(value)
+        return dob.isoformat() if dob else str(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, float) and value.is_integer():
+        # phone numbers and codes read as floats
+        return str(int(value))
+    return str(value)
+
+
+def get_row_fingerprint(row, contribution_plan_bundle_id=None):
+    """SHA-256 of the normalized values of the row and of the bundle it is imported in."""
+    values = [_fingerprint_value(header, row.get(header)) for header in FINGERPRINT_HEADERS]
+    values.append(str(contribution_plan_bundle_id) if contribution_plan_bundle_id else None)
+    return hashlib.sha256(json.dumps(values, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class ImportRowFingerprints:
+    """
+    Fingerprints of the rows imported for ``policyholder`` in ``cpb``, given to
+    iter_rows_with_context() to resolve each batch of rows with two queries.
+    """
+
+    def __init__(self, policyholder, cpb=None):
+        self.policyholder = policyholder
+        self.contribution_plan_bundle_id = cpb.id if cpb else None
+
+    def load(self, batch):
+        """{row index: RowFingerprint} of the (index, row) pairs of a batch."""
+        fingerprints = {}
+        for index, row in batch:
+            key = get_row_key(row)
+            if key and not is_delete_flagged(row.get(HEADER_DELETE)):
+                fingerprints[index] = RowFingerprint(
+                    key, get_row_fingerprint(row, self.contribution_plan_bundle_id)
+                )
+
+        stored = {}
+        for chunk in _chunks({fingerprint.key for fingerprint in fingerprints.values()}):
+            stored.update(
+                (key, (fingerprint, insuree_id, chf_id))
+                for key, fingerprint, insuree_id, chf_id in PolicyHolderInsureeImportFingerprint.objects.filter(
+                    policy_holder=self.policyholder, row_key__in=chunk
+                ).values_list("row_key", "fingerprint", "insuree_id", "insuree__chf_id")
+            )
+
+        candidates = {
+            index: stored[fingerprint.key]
+            for index, fingerprint in fingerprints.items()
+            if fingerprint.key in stored and stored[fingerprint.key][0] == fingerprint.fingerprint
+        }
+        # the row is unchanged only while its insuree is still live and linked
+        linked = set()
+        for chunk in _chunks({insuree_id for _, insuree_id, _ in candidates.values()}):
+            linked.update(
+                PolicyHolderInsuree.objects.filter(
+                    policy_holder=self.policyholder,
+                    insuree_id__in=chunk,
+                    is_deleted=False,
+                    insuree__validity_to__isnull=True,
+                ).values_list("insuree_id", flat=True)
+            )
+        for index, (_, insuree_id, chf_id) in candidates.items():
+            if insuree_id in linked:
+                fingerprints[index].unchanged_chf_id = chf_id or ""
+        return fingerprints
+
+
+def get_import_row_fingerprints(policyholder, cpb=None):
+    """ImportRowFingerprints of the policyholder, None when insuree_import_skip_unchanged_rows is off."""
+    if PolicyholderConfig.insuree_import_skip_unchanged_rows:
+        return ImportRowFingerprints(policyholder, cpb)
+    return None
+
+
+def save_row_fingerprints(policyholder, fingerprints_by_insuree):
+    """Store the (RowFingerprint, insuree) pairs of the rows imported successfully."""
+    entries = {fingerprint.key: (fingerprint, insuree) for fingerprint, insuree in fingerprints_by_insuree}
+    if not entries:
+        return
+    existing = {
+        stored.row_key: stored
+        for stored in PolicyHolderInsureeImportFingerprint.objects.filter(
+            policy_holder=policyholder, row_key__in=list(entries)
+        )
+    }
+    now = timezone.now()
+    to_update = []
+    to_create = []
+    for key, (fingerprint, insuree) in entries.items():
+        stored = existing.get(key)
+        if stored:
+            stored.fingerprint = fingerprint.fingerprint
+            stored.insuree = insuree
+            stored.updated_at = now
+            to_update.append(stored)
+        else:
+            to_create.append(PolicyHolderInsureeImportFingerprint(
+                policy_holder=policyholder, row_key=key, fingerprint=fingerprint.fingerprint, insuree=insuree
+            ))
+    if to_update:
+        PolicyHolderInsureeImportFingerprint.objects.bulk_update(to_update, ["fingerprint", "insuree", "updated_at"])
+    if to_create:
+        # a parallel chunk may store the same row first
+        PolicyHolderInsureeImportFingerprint.objects.bulk_create(to_create, ignore_conflicts=True)
+
+
+def forget_row_fingerprints(policyholder, rows):
+    """Drop the fingerprints of rows, e.g. once their insurees are removed, so they are imported again."""
+    keys = {key for key in (get_row_key(row) for row in rows) if key}
+    if keys:
+        PolicyHolderInsureeImportFingerprint.objects.filter(policy_holder=policyholder, row_key__in=keys).delete()
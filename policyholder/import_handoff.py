@@ -0,0 +1,150 @@
+"""
+Handoff of the uploaded workbook from the API to the import workers.
+
+The upload is always stored (see import_storage), resumed imports read it from
+there. The first run can skip the storage round trip:
+
+* ``inline``: files up to insuree_import_inline_max_bytes travel base64 encoded
+  in the task message and are read from memory;
+* ``shared``: the file is copied to insuree_import_shared_dir, a volume the API
+  and the workers share, and read in place;
+* otherwise the worker reads the stored file: in place with the local storage
+  backend, from a temporary download with the bucket, removed once read.
+"""
+import base64
+import io
+import logging
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from policyholder.apps import PolicyholderConfig
+from policyholder.import_storage import LocalImportFileStorage, get_import_file_storage
+
+logger = logging.getLogger(__name__)
+
+HANDOFF_INLINE = "inline"
+HANDOFF_SHARED = "shared"
+
+
+def build_import_file_handoff(local_path, file_name, file_size):
+    """
+    Handoff of the upload at ``local_path`` for import_policyholder_insurees_async(),
+    None when the worker should read the stored file.
+    """
+    if file_size <= PolicyholderConfig.insuree_import_inline_max_bytes:
+        with open(local_path, "rb") as file:
+            data = base64.b64encode(file.read()).decode("ascii")
+        return {"mode": HANDOFF_INLINE, "name": file_name, "data": data}
+
+    shared_dir = PolicyholderConfig.insuree_import_shared_dir
+    if shared_dir:
+        os.makedirs(shared_dir, exist_ok=True)
+        shared_path = os.path.join(shared_dir, f"{uuid.uuid4().hex}{os.path.splitext(file_name)[1].lower()}")
+        try:
+            # no copy when the upload was spooled on the same file system
+            os.link(local_path, shared_path)
+        except OSError:
+            shutil.copyfile(local_path, f"{shared_path}.tmp")
+            os.replace(f"{shared_path}.tmp", shared_path)
+        return {"mode": HANDOFF_SHARED, "path": shared_path}
+
+    return None
+
+
+def get_chunk_file_handoff(file_handoff):
+    """Handoff passed on to the chunks of a split import, inline data is not copied in every chunk."""
+    if file_handoff and file_handoff.get("mode") == HANDOFF_SHARED:
+        return file_handoff
+    return None
+
+
+def release_import_file_handoff(file_handoff):
+    """Remove the shared copy of a file once its import is over."""
+    if file_handoff and file_handoff.get("mode") == HANDOFF_SHARED:
+        remove_downloaded_import_file(file_handoff.get("path"))
+
+
+def remove_stale_handoff_files(older_than):
+    """Remove the shared copies left by imports lost for ``older_than`` seconds."""
+    shared_dir = PolicyholderConfig.insuree_import_shared_dir
+    if not shared_dir or not os.path.isdir(shared_dir):
+        return 0
+    removed = 0
+    stale_before = time.time() - older_than
+    for entry in os.scandir(shared_dir):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < stale_before:
+                os.unlink(entry.path)
+                removed += 1
+        except OSError as e:
+            logger.warning(f"Failed to remove stale import file {entry.path}: {e}")
+    return removed
+
+
+def download_insuree_import_file(uploaded_file_record, download_prefix=""):
+    """
+    Download the uploaded workbook from the import file storage and return its local path.
+    """
+    if not uploaded_file_record.file_path:
+        raise Exception("Uploaded file record has no file path")
+
+    # Use MEDIA_ROOT if available, otherwise use temp directory
+    base_path = settings.MEDIA_ROOT or tempfile.gettempdir()
+
+    # Ensure the directory exists
+    download_dir = os.path.join(base_path, "policyholder", "insuree_import")
+    os.makedirs(download_dir, exist_ok=True)
+
+    download_path = os.path.join(
+        download_dir,
+        f"{download_prefix}{os.path.basename(uploaded_file_record.file_path)}",
+    )
+
+    return get_import_file_storage().load(uploaded_file_record.file_path, download_path)
+
+
+def remove_downloaded_import_file(file_path):
+    try:
+        if file_path and os.path.exists(file_path):
+            os.unlink(file_path)
+    except Exception as e:
+        logger.warning(f"Failed to clean up temp file: {e}")
+
+
+@contextmanager
+def open_import_file(uploaded_file_record, file_handoff=None, download_prefix=""):
+    """
+    Yield the workbook to read, a file object or a local path, for
+    iter_import_rows(). A temporary download is removed on exit, failures included.
+    """
+    mode = (file_handoff or {}).get("mode")
+    if mode == HANDOFF_INLINE:
+        file = io.BytesIO(base64.b64decode(file_handoff["data"]))
+        # the extension tells legacy xls files apart
+        file.name = file_handoff.get("name") or ""
+        yield file
+        return
+
+    if mode == HANDOFF_SHARED:
+        if os.path.exists(file_handoff["path"]):
+            yield file_handoff["path"]
+            return
+        logger.warning(f"Shared import file {file_handoff['path']} is gone, reading the stored file")
+
+    storage = get_import_file_storage()
+    if isinstance(storage, LocalImportFileStorage) and uploaded_file_record.file_path:
+        yield storage.path(uploaded_file_record.file_path)
+        return
+
+    file_path = None
+    try:
+        file_path = download_insuree_import_file(uploaded_file_record, download_prefix=download_prefix)
+        yield file_path
+    finally:
+        remove_downloaded_import_file(file_path)
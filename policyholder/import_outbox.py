@@ -0,0 +1,255 @@
+"""
+Outbox for the side effects of policyholder insuree imports.
+
+The import writes one PolicyHolderInsureeImportOutbox row per external call
+(CAMU notification, email, DMS folder, workflow, ABIS) in the transaction that
+creates the insuree or PolicyHolderInsuree, so the import itself only waits on
+the database. The drain_import_outbox Celery task delivers the entries in
+batches, retries failures with an exponential backoff and limits the number of
+workers calling each target at the same time. Only one delayed drain per target
+waits for the next retry (schedule_outbox_retry()).
+"""
+import logging
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from core.constants import INS_ADDED_NT
+from core.notification_service import create_camu_notification
+from insuree.dms_utils import send_mail_to_temp_insuree_with_pdf
+
+from policyholder.apps import PolicyholderConfig
+from policyholder.models import PolicyHolderInsureeImportOutbox
+
+logger = logging.getLogger(__name__)
+
+Target = PolicyHolderInsureeImportOutbox.Target
+Status = PolicyHolderInsureeImportOutbox.Status
+
+OUTBOX_SLOT_CACHE_KEY_PREFIX = "policyholder_import_outbox_slot"
+OUTBOX_RETRY_CACHE_KEY_PREFIX = "policyholder_import_outbox_retry"
+# a delayed drain not started that long after its time was lost
+OUTBOX_RETRY_GRACE = timedelta(minutes=10)
+# entries left PROCESSING longer than this belong to a dead worker
+OUTBOX_PROCESSING_LEASE = timedelta(hours=1)
+
+
+def _deliver_notification(entry):
+    create_camu_notification(INS_ADDED_NT, entry.policy_holder_insuree)
+
+
+def _deliver_email(entry):
+    send_mail_to_temp_insuree_with_pdf(entry.insuree, entry.payload["enrolment_type"])
+
+
+def _deliver_dms_folder(entry):
+    from insuree.dms_utils import create_openKm_folder_for_bulkupload
+    create_openKm_folder_for_bulkupload(entry.created_by, entry.insuree)
+
+
+def _deliver_workflow(entry):
+    from workflow.workflow_stage import insuree_add_to_workflow
+    insuree_add_to_workflow(None, entry.insuree.id, "INSUREE_ENROLLMENT", "Pre_Register")
+
+
+def _deliver_abis(entry):
+    from insuree.abis_api import create_abis_insuree
+    create_abis_insuree(None, entry.insuree)
+
+
+OUTBOX_HANDLERS = {
+    Target.NOTIFICATION: _deliver_notification,
+    Target.EMAIL: _deliver_email,
+    Target.DMS_FOLDER: _deliver_dms_folder,
+    Target.WORKFLOW: _deliver_workflow,
+    Target.ABIS: _deliver_abis,
+}
+
+
+def enqueue_import_side_effect(target, insuree=None, phi=None, user=None, payload=None):
+    """
+    Record a side effect of the import. Must be called inside the transaction
+    writing ``insuree``/``phi``. When insuree_import_outbox_enabled is off the
+    side effect is delivered right away, as imports used to do.
+    """
+    entry = PolicyHolderInsureeImportOutbox(
+        target=target,
+        insuree=insuree,
+        policy_holder_insuree=phi,
+        created_by=user,
+        payload=payload,
+        available_at=timezone.now(),
+    )
+    if not PolicyholderConfig.insuree_import_outbox_enabled:
+        try:
+            OUTBOX_HANDLERS[target](entry)
+        except Exception as e:
+            logger.error(f"Import side effect {target} failed for insuree {insuree and insuree.id}: {e}")
+        return None
+    entry.save()
+    return entry
+
+
+def enqueue_created_insuree_side_effects(insuree, user=None):
+    """DMS folder, enrolment workflow and ABIS registration of a new insuree."""
+    if user:
+        enqueue_import_side_effect(Target.DMS_FOLDER, insuree=insuree, user=user)
+    enqueue_import_side_effect(Target.WORKFLOW, insuree=insuree, user=user)
+    enqueue_import_side_effect(Target.ABIS, insuree=insuree, user=user)
+
+
+def enqueue_attached_insuree_side_effects(phi, insuree, user=None):
+    """CAMU notification and welcome email once an insuree is attached to a policyholder."""
+    enqueue_import_side_effect(Target.NOTIFICATION, insuree=insuree, phi=phi, user=user)
+    if insuree.email:
+        enrolment_type = (insuree.json_ext or {}).get("insureeEnrolmentType", "").lower()
+        if enrolment_type:
+            enqueue_import_side_effect(
+                Target.EMAIL,
+                insuree=insuree,
+                phi=phi,
+                user=user,
+                payload={"enrolment_type": enrolment_type},
+            )
+
+
+def get_outbox_concurrency(target):
+    return max(1, int(PolicyholderConfig.insuree_import_outbox_concurrency.get(target, 1)))
+
+
+def get_pending_outbox_targets():
+    """Targets having entries ready to be delivered."""
+    return set(
+        PolicyHolderInsureeImportOutbox.objects.filter(
+            status=Status.PENDING, available_at__lte=timezone.now()
+        ).values_list("target", flat=True).distinct()
+    )
+
+
+def get_next_outbox_retry(target=None):
+    """Earliest available_at of the entries waiting for a retry, or None."""
+    queryset = PolicyHolderInsureeImportOutbox.objects.filter(
+        status=Status.PENDING, available_at__gt=timezone.now()
+    )
+    if target:
+        queryset = queryset.filter(target=target)
+    entry = queryset.order_by("available_at").only("available_at").first()
+    return entry.available_at if entry else None
+
+
+def release_stale_outbox_entries():
+    """Give back to the queue the entries claimed by a worker that died."""
+    return PolicyHolderInsureeImportOutbox.objects.filter(
+        status=Status.PROCESSING, updated_at__lt=timezone.now() - OUTBOX_PROCESSING_LEASE
+    ).update(status=Status.PENDING, updated_at=timezone.now())
+
+
+def acquire_outbox_slot(target):
+    """
+    Take one of the ``insuree_import_outbox_concurrency[target]`` slots,
+    returns its cache key or None when every slot is taken.
+    """
+    timeout = int(OUTBOX_PROCESSING_LEASE.total_seconds())
+    for slot in range(get_outbox_concurrency(target)):
+        key = f"{OUTBOX_SLOT_CACHE_KEY_PREFIX}_{target}_{slot}"
+        if cache.add(key, 1, timeout):
+            return key
+    return None
+
+
+def release_outbox_slot(key):
+    cache.delete(key)
+
+
+def schedule_outbox_retry(target, retry_at):
+    """
+    Whether the caller should schedule a drain of ``target`` at ``retry_at``:
+    False when a drain is already scheduled for that time or earlier, it will
+    schedule the next retry itself.
+    """
+    key = f"{OUTBOX_RETRY_CACHE_KEY_PREFIX}_{target}"
+    scheduled = cache.get(key)
+    if scheduled is not None and scheduled <= retry_at.timestamp():
+        return False
+    timeout = max(0, (retry_at - timezone.now()).total_seconds()) + OUTBOX_RETRY_GRACE.total_seconds()
+    cache.set(key, retry_at.timestamp(), int(timeout))
+    return True
+
+
+def clear_outbox_retry(target):
+    """Called by the scheduled drain when it starts, the next retry can be scheduled."""
+    cache.delete(f"{OUTBOX_RETRY_CACHE_KEY_PREFIX}_{target}")
+
+
+def claim_outbox_entries(target, batch_size):
+    """Lock and mark as PROCESSING the next ``batch_size`` ready entries of ``target``."""
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(
+            PolicyHolderInsureeImportOutbox.objects.select_for_update(skip_locked=True)
+            .filter(target=target, status=Status.PENDING, available_at__lte=now)
+            .order_by("available_at")
+            .values_list("id", flat=True)[:batch_size]
+        )
+        if not ids:
+            return []
+        PolicyHolderInsureeImportOutbox.objects.filter(id__in=ids).update(
+            status=Status.PROCESSING, attempts=F("attempts") + 1, updated_at=now
+        )
+    return list(
+        PolicyHolderInsureeImportOutbox.objects.filter(id__in=ids)
+        .select_related("insuree", "policy_holder_insuree", "created_by")
+    )
+
+
+def deliver_outbox_entry(entry):
+    """Run the handler of a claimed entry and record the outcome, returns True on success."""
+    try:
+        OUTBOX_HANDLERS[entry.target](entry)
+    except Exception as e:
+        logger.warning(f"Import outbox entry {entry.id} ({entry.target}) failed: {e}")
+        entry.last_error = str(e)
+        if entry.attempts >= PolicyholderConfig.insuree_import_outbox_max_attempts:
+            entry.status = Status.FAILED
+            logger.error(f"Import outbox entry {entry.id} ({entry.target}) given up after {entry.attempts} attempts")
+        else:
+            entry.status = Status.PENDING
+            delay = PolicyholderConfig.insuree_import_outbox_retry_delay * 2 ** (entry.attempts - 1)
+            entry.available_at = timezone.now() + timedelta(seconds=delay)
+        entry.save(update_fields=["status", "last_error", "available_at", "updated_at"])
+        return False
+
+    entry.status = Status.DONE
+    entry.last_error = None
+    entry.save(update_fields=["status", "last_error", "updated_at"])
+    return True
+
+
+def drain_outbox_target(target, batch_size=None):
+    """
+    Deliver the ready entries of ``target`` batch after batch until none is
+    left. Returns (delivered, failed) or None when no concurrency slot was free.
+    """
+    batch_size = batch_size or PolicyholderConfig.insuree_import_outbox_batch_size
+    slot = acquire_outbox_slot(target)
+    if not slot:
+        return None
+
+    delivered = 0
+    failed = 0
+    try:
+        while True:
+            entries = claim_outbox_entries(target, batch_size)
+            if not entries:
+                break
+            for entry in entries:
+                if deliver_outbox_entry(entry):
+                    delivered += 1
+                else:
+                    failed += 1
+    finally:
+        release_outbox_slot(slot)
+    return delivered, failed
@@ -0,0 +1,237 @@
+"""
+Progress reporting for policyholder insuree imports.
+
+The import loop reports after every row, the reporter only writes the
+PolicyHolderInsureeBatchUpload counters every N rows or every T seconds and
+optionally mirrors them in the Django cache, so status polls can be answered
+without reading the batch from the database.
+
+The cached progress is also pushed to the portal: the progress stream view
+follows it (wait_for_cached_progress / iter_cached_progress) and sends every
+change as a Server-Sent Event or as the answer of a long poll.
+"""
+import logging
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+
+from policyholder.apps import PolicyholderConfig
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_CACHE_KEY_PREFIX = "policyholder_insuree_import"
+PROGRESS_CACHE_COUNTERS = ("processed", "success_count", "error_count")
+PROGRESS_FINAL_STATUSES = ("COMPLETED", "FAILED")
+
+
+def progress_cache_key(task_id, name):
+    return f"{PROGRESS_CACHE_KEY_PREFIX}_{task_id}_{name}"
+
+
+def get_cached_progress(task_id):
+    """
+    Return the live progress of an import from the cache, or None when the
+    cache is disabled or holds nothing for this task.
+    """
+    if not PolicyholderConfig.insuree_import_progress_cache or not task_id:
+        return None
+    keys = [progress_cache_key(task_id, name) for name in PROGRESS_CACHE_COUNTERS + ("info",)]
+    values = cache.get_many(keys)
+    info = values.get(progress_cache_key(task_id, "info"))
+    if not info:
+        return None
+    progress = dict(info)
+    for name in PROGRESS_CACHE_COUNTERS:
+        progress[name] = values.get(progress_cache_key(task_id, name), 0)
+    return progress
+
+
+def set_cached_progress_info(task_id, **info):
+    """Store the static part of the cached progress (status, total, policyholder...)."""
+    if not PolicyholderConfig.insuree_import_progress_cache or not task_id:
+        return
+    key = progress_cache_key(task_id, "info")
+    current = cache.get(key) or {}
+    current.update(info)
+    cache.set(key, current, PolicyholderConfig.insuree_import_progress_cache_timeout)
+
+
+def set_cached_progress_counters(task_id, processed, success_count, error_count):
+    """Start the cached counters of a task at the given values, e.g. those of a resumed import."""
+    if not PolicyholderConfig.insuree_import_progress_cache or not task_id:
+        return
+    cache.set_many(
+        {
+            progress_cache_key(task_id, name): value
+            for name, value in zip(PROGRESS_CACHE_COUNTERS, (processed, success_count, error_count))
+        },
+        PolicyholderConfig.insuree_import_progress_cache_timeout,
+    )
+
+
+def set_cached_final_progress(batch_upload, task_id=None):
+    """Cache the outcome of a finished import, so that polls and streams need no database read."""
+    task_id = task_id or batch_upload.celery_task_id
+    if batch_upload.status == "COMPLETED":
+        set_cached_progress_counters(
+            task_id,
+            batch_upload.processed_rows,
+            batch_upload.success_count,
+            batch_upload.error_count,
+        )
+    set_cached_progress_info(
+        task_id,
+        status=batch_upload.status,
+        completed_at=batch_upload.completed_at.isoformat() if batch_upload.completed_at else None,
+        error_message=batch_upload.error_message,
+    )
+
+
+def get_progress_event_id(progress):
+    """Id of a progress state, it changes with the status and with every processed row."""
+    return ":".join(
+        str(progress.get(name) or 0) for name in ("status",) + PROGRESS_CACHE_COUNTERS
+    )
+
+
+def wait_for_cached_progress(task_id, last_event_id=None, timeout=None, interval=None):
+    """
+    Cached progress of the task as soon as it differs from ``last_event_id`` or
+    the import is finished, else the unchanged progress after ``timeout`` seconds.
+    None when the cache holds nothing for the task.
+    """
+    timeout = PolicyholderConfig.insuree_import_progress_stream_timeout if timeout is None else timeout
+    interval = interval or PolicyholderConfig.insuree_import_progress_stream_interval
+    deadline = time.monotonic() + timeout
+    while True:
+        progress = get_cached_progress(task_id)
+        if (
+            progress is None
+            or progress.get("status") in PROGRESS_FINAL_STATUSES
+            or get_progress_event_id(progress) != last_event_id
+            or time.monotonic() >= deadline
+        ):
+            return progress
+        time.sleep(min(interval, max(0, deadline - time.monotonic())))
+
+
+def iter_cached_progress(task_id, last_event_id=None, timeout=None, interval=None):
+    """
+    Cached progress states of the task as they change, after ``last_event_id``,
+    until the import finishes or for ``timeout`` seconds.
+    """
+    timeout = PolicyholderConfig.insuree_import_progress_stream_timeout if timeout is None else timeout
+    deadline = time.monotonic() + timeout
+    while True:
+        progress = wait_for_cached_progress(
+            task_id, last_event_id, max(0, deadline - time.monotonic()), interval
+        )
+        if progress is None:
+            return
+        event_id = get_progress_event_id(progress)
+        if event_id != last_event_id:
+            yield progress
+            last_event_id = event_id
+        if progress.get("status") in PROGRESS_FINAL_STATUSES or time.monotonic() >= deadline:
+            return
+
+
+class ImportProgressReporter:
+    """
+    Progress callback for process_insuree_import_rows().
+
+    Counters are flushed to the batch every ``every_rows`` rows or every
+    ``every_seconds`` seconds, whichever comes first; callers must call flush()
+    once the import is finished or failed. With ``incremental`` the flush adds
+    the rows processed since the previous flush instead of overwriting the
+    counters, which is what parallel import chunks need. Otherwise the stage
+    timings of ``timer`` are written along with the counters.
+    """
+
+    def __init__(
+        self, batch_upload, task_id=None, incremental=False, every_rows=None, every_seconds=None, timer=None
+    ):
+        self.batch_upload = batch_upload
+        self.timer = None if incremental else timer
+        self.task_id = task_id or batch_upload.celery_task_id
+        self.incremental = incremental
+        self.every_rows = every_rows or PolicyholderConfig.insuree_import_progress_every_rows
+        self.every_seconds = every_seconds or PolicyholderConfig.insuree_import_progress_every_seconds
+        self.use_cache = bool(PolicyholderConfig.insuree_import_progress_cache and self.task_id)
+
+        self.processed_rows = 0
+        self.success_count = 0
+        self.error_count = 0
+        self._flushed = (0, 0, 0)
+        self._cached = (0, 0, 0)
+        self._flushed_at = time.monotonic()
+        # transactions already open when the import starts (e.g. a test case)
+        self._atomic_depth = len(transaction.get_connection().atomic_blocks)
+
+    def __call__(self, processed_rows, success_count, error_count):
+        self.processed_rows = processed_rows
+        self.success_count = success_count
+        self.error_count = error_count
+
+        if self.use_cache:
+            self._update_cache()
+
+        # not from the transaction of an import chunk, the batch row would stay
+        # locked until it commits; the import calls again once it committed
+        if len(transaction.get_connection().atomic_blocks) > self._atomic_depth:
+            return
+        if (
+            self.processed_rows - self._flushed[0] >= self.every_rows
+            or time.monotonic() - self._flushed_at >= self.every_seconds
+        ):
+            self.flush()
+
+    @property
+    def counters(self):
+        return self.processed_rows, self.success_count, self.error_count
+
+    def flush(self):
+        """Write the pending counters to the batch upload row."""
+        counters = self.counters
+        if counters != self._flushed:
+            try:
+                if self.incremental:
+                    self.batch_upload.increment_progress(
+                        processed_rows=counters[0] - self._flushed[0],
+                        success_count=counters[1] - self._flushed[1],
+                        error_count=counters[2] - self._flushed[2],
+                    )
+                else:
+                    self.batch_upload.update_progress(
+                        processed_rows=counters[0],
+                        success_count=counters[1],
+                        error_count=counters[2],
+                        stage_timings=self.timer.as_dict() if self.timer else None,
+                    )
+                self._flushed = counters
+            except Exception as e:
+                logger.warning(f"Failed to flush import progress of batch {self.batch_upload.id}: {e}")
+        if self.use_cache:
+            self._update_cache()
+            if self.timer:
+                set_cached_progress_info(self.task_id, stage_timings=self.timer.as_dict())
+        self._flushed_at = time.monotonic()
+
+    def _update_cache(self):
+        counters = self.counters
+        timeout = PolicyholderConfig.insuree_import_progress_cache_timeout
+        try:
+            for name, value, cached in zip(PROGRESS_CACHE_COUNTERS, counters, self._cached):
+                if value == cached:
+                    continue
+                key = progress_cache_key(self.task_id, name)
+                if self.incremental:
+                    # chunks of the same import share the counters
+                    if not cache.add(key, value - cached, timeout):
+                        cache.incr(key, value - cached)
+                else:
+                    cache.set(key, value, timeout)
+            self._cached = counters
+        except Exception as e:
+            logger.warning(f"Failed to cache import progress of task {self.task_id}: {e}")
@@ -0,0 +1,112 @@
+"""
+Excel report of policyholder insuree imports.
+
+The report is rendered once, when the import completes, by xlsxwriter in
+constant_memory mode (rows are flushed to disk as they are written) and stored
+in the import file storage under the batch. Downloads serve the stored file, kept in a local
+cache, instead of rendering the results again.
+"""
+import logging
+import os
+import tempfile
+
+import xlsxwriter
+from django.conf import settings
+
+from policyholder.import_results import iter_import_results
+from policyholder.import_storage import get_import_file_storage
+
+logger = logging.getLogger(__name__)
+
+REPORT_FILE_NAME = "Rapport d'importation des assurés.xlsx"
+REPORT_SHEET_NAME = "Résultats"
+REPORT_COLUMNS = [
+    ("ligne", "Ligne"),
+    ("numero_camu", "Numéro CAMU"),
+    ("nom", "Nom"),
+    ("prenom", "Prénom"),
+    ("Etat", "État"),
+    ("remarque", "Remarque"),
+]
+
+
+def render_import_report(batch_upload, path):
+    """Write the report of the batch to ``path``, returns the number of result rows."""
+    workbook = xlsxwriter.Workbook(path, {"constant_memory": True})
+    try:
+        sheet = workbook.add_worksheet(REPORT_SHEET_NAME)
+        sheet.write_row(0, 0, [header for _, header in REPORT_COLUMNS], workbook.add_format({"bold": True}))
+        row_number = 0
+        for row_number, entry in enumerate(iter_import_results(batch_upload), start=1):
+            sheet.write_row(row_number, 0, [
+                "" if entry.get(key) is None else entry.get(key) for key, _ in REPORT_COLUMNS
+            ])
+    finally:
+        workbook.close()
+    return row_number
+
+
+def get_report_object_key(batch_upload):
+    app_env = os.environ.get("APP_ENV", "dev")
+    return f"{app_env}/{batch_upload.policy_holder_id}/reports/{batch_upload.id}.xlsx"
+
+
+def get_report_cache_path(batch_upload):
+    base_path = settings.MEDIA_ROOT or tempfile.gettempdir()
+    cache_dir = os.path.join(base_path, "policyholder", "insuree_import", "reports")
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, f"{batch_upload.id}.xlsx")
+
+
+def build_import_report(batch_upload):
+    """
+    Render and store the report of the batch, sets ``report_file_path``
+    (not saved). Returns False when the batch has no results to report.
+    """
+    cache_path = get_report_cache_path(batch_upload)
+    temp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        if not render_import_report(batch_upload, temp_path):
+            return False
+        object_key = get_report_object_key(batch_upload)
+        get_import_file_storage().save(temp_path, object_key)
+        os.replace(temp_path, cache_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+    batch_upload.report_file_path = object_key
+    return True
+
+
+def store_import_report(batch_upload):
+    """build_import_report() for a finished import, failures are only logged."""
+    try:
+        if build_import_report(batch_upload):
+            batch_upload.save(update_fields=["report_file_path", "updated_at"])
+    except Exception as e:
+        logger.warning(f"Failed to build the import report of batch {batch_upload.id}: {e}", exc_info=True)
+
+
+def get_import_report_file(batch_upload):
+    """
+    Local path of the report of the batch, fetched from the storage or built
+    when missing (batches imported before the stored reports). None without results.
+    """
+    cache_path = get_report_cache_path(batch_upload)
+    if batch_upload.report_file_path:
+        if os.path.exists(cache_path):
+            return cache_path
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+        try:
+            os.replace(get_import_file_storage().load(batch_upload.report_file_path, temp_path), cache_path)
+            return cache_path
+        except Exception as e:
+            logger.warning(f"Stored import report of batch {batch_upload.id} not loaded, building it again: {e}")
+        finally:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+
+    if not build_import_report(batch_upload):
+        return None
+    batch_upload.save(update_fields=["report_file_path", "updated_at"])
+    return cache_path
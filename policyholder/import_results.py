@@ -0,0 +1,65 @@
+"""
+Row-level results of policyholder insuree imports.
+
+Results are written as PolicyHolderInsureeImportResult rows along with the
+checkpoints of the import, and read back in sheet order, page by page or as a
+stream. Batches imported before keep their results in the ``results`` JSON of
+the batch, read the same way.
+"""
+from policyholder.models import PolicyHolderInsureeBatchUpload, PolicyHolderInsureeImportResult
+
+IMPORT_RESULTS_BATCH_SIZE = 1000
+IMPORT_RESULTS_MAX_PAGE_SIZE = 1000
+
+
+def save_import_results(batch_upload, entries):
+    """Store build_result_entry() dicts of ``batch_upload``."""
+    PolicyHolderInsureeImportResult.objects.bulk_create(
+        [PolicyHolderInsureeImportResult.from_entry(batch_upload, entry) for entry in entries],
+        batch_size=IMPORT_RESULTS_BATCH_SIZE,
+    )
+
+
+def _legacy_results(batch_upload, status=None):
+    results = PolicyHolderInsureeBatchUpload.objects.filter(id=batch_upload.id).values_list(
+        "results", flat=True
+    ).first()
+    entries = (results or {}).get("results") or []
+    if status:
+        entries = [entry for entry in entries if entry.get("Etat") == status]
+    return entries
+
+
+def _result_rows(batch_upload, status=None):
+    rows = batch_upload.result_rows.order_by("line")
+    if status:
+        rows = rows.filter(status=status)
+    return rows
+
+
+def has_import_results(batch_upload):
+    return batch_upload.result_rows.exists() or PolicyHolderInsureeBatchUpload.objects.filter(
+        id=batch_upload.id, results__isnull=False
+    ).exists()
+
+
+def iter_import_results(batch_upload, status=None):
+    """Result entries of the batch in sheet order, optionally only those with ``status`` (OK/KO)."""
+    if not batch_upload.result_rows.exists():
+        yield from _legacy_results(batch_upload, status)
+        return
+    for row in _result_rows(batch_upload, status).iterator(chunk_size=IMPORT_RESULTS_BATCH_SIZE):
+        yield row.to_entry()
+
+
+def get_import_results_page(batch_upload, status=None, page=1, page_size=100):
+    """(entries, total count) of one page of the results of the batch."""
+    page = max(1, page)
+    page_size = max(1, min(page_size, IMPORT_RESULTS_MAX_PAGE_SIZE))
+    offset = (page - 1) * page_size
+    rows = _result_rows(batch_upload, status)
+    total = rows.count()
+    if total or batch_upload.result_rows.exists():
+        return [row.to_entry() for row in rows[offset:offset + page_size]], total
+    entries = _legacy_results(batch_upload, status)
+    return entries[offset:offset + page_size], len(entries)
@@ -0,0 +1,132 @@
+"""
+Scheduling of policyholder insuree imports.
+
+Uploaded imports wait in the PolicyHolderInsureeBatchUpload table (PENDING,
+no ``dispatched_at``) until the scheduler sends them to the workers:
+
+* at most one import per policyholder is active, so two imports never race
+  on the insurees and families of the same employer;
+* files of insuree_import_large_file_min_bytes and more go to the large lane,
+  with at most insuree_import_max_active_large imports active, small files
+  never wait behind them;
+* when several policyholders are waiting, the one served least recently goes
+  first, so that an employer sending many files only gets one turn at a time.
+
+Dry runs write nothing, they start right away and do not hold their
+policyholder's turn.
+
+A dispatched import no worker started (its task message was lost) would hold
+its policyholder's turn forever, release_lost_dispatches() puts it back in the
+queue.
+
+Each lane can be routed to its own Celery queue (insuree_import_small_queue /
+insuree_import_large_queue).
+"""
+import logging
+
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from policyholder.apps import PolicyholderConfig
+from policyholder.models import PolicyHolderInsureeBatchUpload
+
+logger = logging.getLogger(__name__)
+
+
+def get_import_lane(file_size):
+    if file_size >= PolicyholderConfig.insuree_import_large_file_min_bytes:
+        return PolicyHolderInsureeBatchUpload.Lane.LARGE
+    return PolicyHolderInsureeBatchUpload.Lane.SMALL
+
+
+def get_import_queue_options(batch_upload):
+    """apply_async() options routing the tasks of the import to the queue of its lane."""
+    if batch_upload.lane == PolicyHolderInsureeBatchUpload.Lane.LARGE:
+        queue = PolicyholderConfig.insuree_import_large_queue
+    else:
+        queue = PolicyholderConfig.insuree_import_small_queue
+    return {"queue": queue} if queue else {}
+
+
+def _active_batches():
+    return PolicyHolderInsureeBatchUpload.objects.filter(
+        status__in=[PolicyHolderInsureeBatchUpload.Status.PENDING, PolicyHolderInsureeBatchUpload.Status.PROCESSING],
+        dispatched_at__isnull=False,
+        dry_run=False,
+    )
+
+
+def claim_schedulable_imports():
+    """
+    Mark the waiting imports that may start now as dispatched and return them,
+    the caller sends them to the workers.
+    """
+    with transaction.atomic():
+        # locking the waiting batches serializes concurrent schedulers
+        waiting = list(
+            PolicyHolderInsureeBatchUpload.objects.select_for_update()
+            .filter(status=PolicyHolderInsureeBatchUpload.Status.PENDING, dispatched_at__isnull=True)
+            .order_by("created_at")
+        )
+        if not waiting:
+            return []
+
+        active = _active_batches()
+        busy_policyholders = set(active.values_list("policy_holder_id", flat=True))
+        active_large = active.filter(lane=PolicyHolderInsureeBatchUpload.Lane.LARGE).count()
+        max_active_large = PolicyholderConfig.insuree_import_max_active_large
+
+        # oldest waiting import of each idle policyholder
+        dry_runs = [batch_upload for batch_upload in waiting if batch_upload.dry_run]
+        candidates = {}
+        for batch_upload in waiting:
+            if not batch_upload.dry_run and batch_upload.policy_holder_id not in busy_policyholders:
+                candidates.setdefault(batch_upload.policy_holder_id, batch_upload)
+
+        last_served = dict(
+            PolicyHolderInsureeBatchUpload.objects.filter(
+                policy_holder_id__in=list(candidates), dispatched_at__isnull=False, dry_run=False
+            )
+            .values("policy_holder_id")
+            .annotate(last_dispatched_at=Max("dispatched_at"))
+            .values_list("policy_holder_id", "last_dispatched_at")
+        )
+        # policyholders never served first, then the least recently served
+        ordered = sorted(
+            candidates.values(),
+            key=lambda batch_upload: (
+                last_served.get(batch_upload.policy_holder_id) is not None,
+                last_served.get(batch_upload.policy_holder_id) or batch_upload.created_at,
+                batch_upload.created_at,
+            ),
+        )
+
+        claimed = []
+        now = timezone.now()
+        for batch_upload in dry_runs + ordered:
+            if batch_upload.lane == PolicyHolderInsureeBatchUpload.Lane.LARGE and not batch_upload.dry_run:
+                if max_active_large and active_large >= max_active_large:
+                    continue
+                active_large += 1
+            batch_upload.dispatched_at = now
+            batch_upload.save(update_fields=["dispatched_at", "updated_at"])
+            claimed.append(batch_upload)
+
+    if claimed:
+        logger.info(f"Dispatching {len(claimed)} policyholder insuree imports, {len(waiting) - len(claimed)} waiting")
+    return claimed
+
+
+def release_lost_dispatches(stale_before):
+    """
+    Put the imports dispatched before ``stale_before`` that are still pending
+    back in the queue, their task message was lost. Returns their number.
+    """
+    released = PolicyHolderInsureeBatchUpload.objects.filter(
+        status=PolicyHolderInsureeBatchUpload.Status.PENDING,
+        dispatched_at__lt=stale_before,
+    ).update(dispatched_at=None, updated_at=timezone.now())
+    if released:
+        logger.warning(f"{released} dispatched policyholder insuree imports never started, queued again")
+    return released
@@ -0,0 +1,209 @@
+"""
+Storage of the workbooks uploaded for policyholder insuree imports.
+
+Files are stored under a key derived from the SHA-256 of their content, so a
+file resent by the same or another policyholder is stored only once. The same
+hash finds the completed import of an identical file, whose report can be
+returned without importing the file again.
+
+The upload is hashed while Django receives it (HashingUploadHandler) and goes
+to the storage from the file Django spooled to disk, the workbook is never
+held in memory. The storage is the bucket, or a local directory for tests and
+single host setups (insuree_import_storage_backend).
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.files.uploadhandler import FileUploadHandler
+
+from rest_api.lib.file_bucket import download_file_from_s3_bucket, upload_file_to_s3_bucket
+
+from policyholder.apps import PolicyholderConfig
+from policyholder.models import PolicyHolderInsureeBatchUpload, PolicyHolderInsureeUploadedFile
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class S3ImportFileStorage:
+    """Files in the bucket, under the ``policyholder`` prefix."""
+
+    def save(self, local_path, object_key):
+        # the bucket client switches to multipart uploads for large files
+        upload_file_to_s3_bucket(file_path=local_path, object_key=object_key, key_prefix="policyholder")
+
+    def load(self, object_key, download_path):
+        file_path = download_file_from_s3_bucket(
+            object_key=f"policyholder/{object_key}", download_path=download_path
+        )
+        # the bucket helper may return None and still download
+        if file_path and os.path.exists(file_path):
+            return file_path
+        if os.path.exists(download_path):
+            return download_path
+        raise Exception("Failed to download file from S3 bucket")
+
+
+class LocalImportFileStorage:
+    """Files in a local directory, for tests and hosts without a bucket."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, object_key):
+        return os.path.join(self.root, "policyholder", *object_key.split("/"))
+
+    def save(self, local_path, object_key):
+        path = self.path(object_key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        shutil.copyfile(local_path, temp_path)
+        os.replace(temp_path, path)
+
+    def load(self, object_key, download_path):
+        path = self.path(object_key)
+        if not os.path.exists(path):
+            raise Exception(f"Stored file {object_key} not found")
+        shutil.copyfile(path, download_path)
+        return download_path
+
+
+def get_import_file_storage():
+    if PolicyholderConfig.insuree_import_storage_backend == "local":
+        root = PolicyholderConfig.insuree_import_local_storage_dir or os.path.join(
+            settings.MEDIA_ROOT or tempfile.gettempdir(), "policyholder_storage"
+        )
+        return LocalImportFileStorage(root)
+    return S3ImportFileStorage()
+
+
+class HashingUploadHandler(FileUploadHandler):
+    """
+    First upload handler of the chain: computes the SHA-256 of each uploaded
+    file while it is received and passes the data on untouched.
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.hashes = {}
+        self._hash = None
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self._hash = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        self._hash.update(raw_data)
+        return raw_data
+
+    def file_complete(self, file_size):
+        self.hashes[self.field_name] = self._hash.hexdigest()
+        return None
+
+
+def install_hashing_upload_handler(request):
+    """
+    Put a HashingUploadHandler in front of the upload handlers of the Django
+    ``request``, None when the body was already parsed.
+    """
+    handler = HashingUploadHandler(request)
+    try:
+        request.upload_handlers.insert(0, handler)
+    except AttributeError:
+        # upload handlers are frozen once request.FILES was read
+        return None
+    return handler
+
+
+def hash_import_file(path):
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+@contextmanager
+def spooled_upload(uploaded_file, file_hash=None):
+    """
+    (local path, sha256) of an uploaded file. Large uploads are already on
+    disk and used in place, small ones are written once to a temporary file,
+    hashed on the way when ``file_hash`` is unknown.
+    """
+    if hasattr(uploaded_file, "temporary_file_path"):
+        path = uploaded_file.temporary_file_path()
+        yield path, file_hash or hash_import_file(path)
+        return
+
+    hasher = None if file_hash else hashlib.sha256()
+    with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(uploaded_file.name)[1]) as temp_file:
+        for chunk in uploaded_file.chunks():
+            if hasher:
+                hasher.update(chunk)
+            temp_file.write(chunk)
+        path = temp_file.name
+    try:
+        yield path, file_hash or hasher.hexdigest()
+    finally:
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def get_import_object_key(file_hash, file_name):
+    """Storage key (under the policyholder prefix) of a file content."""
+    app_env = os.environ.get("APP_ENV", "dev")
+    return f"{app_env}/sha256/{file_hash}{os.path.splitext(file_name)[1].lower()}"
+
+
+def is_import_file_stored(file_hash, object_key):
+    """Whether an earlier upload already put this content at ``object_key``."""
+    return PolicyHolderInsureeUploadedFile.objects.filter(
+        file_name_hash=file_hash, file_path=object_key
+    ).exists()
+
+
+def store_import_file(policyholder, local_path, file_name, file_hash):
+    """
+    Store the file at ``local_path`` unless the storage already holds the same
+    content and return the PolicyHolderInsureeUploadedFile of the policyholder for it.
+    """
+    object_key = get_import_object_key(file_hash, file_name)
+
+    if not is_import_file_stored(file_hash, object_key):
+        get_import_file_storage().save(local_path, object_key)
+
+    uploaded_file_record = PolicyHolderInsureeUploadedFile.objects.filter(
+        file_name_hash=file_hash, policy_holder=policyholder
+    ).first()
+    if uploaded_file_record:
+        if uploaded_file_record.file_path != object_key:
+            uploaded_file_record.file_path = object_key
+            uploaded_file_record.save(update_fields=["file_path"])
+    else:
+        uploaded_file_record = PolicyHolderInsureeUploadedFile.objects.create(
+            policy_holder=policyholder, file_name_hash=file_hash, file_path=object_key
+        )
+    return uploaded_file_record
+
+
+def find_completed_import(policyholder, file_hash, reimport=False):
+    """
+    Latest completed import of a file with this content for the policyholder,
+    None when the upload asks to ``reimport`` it or when
+    insuree_import_reuse_completed_reports is off.
+    """
+    if reimport or not PolicyholderConfig.insuree_import_reuse_completed_reports:
+        return None
+    return (
+        PolicyHolderInsureeBatchUpload.objects.filter(
+            policy_holder=policyholder,
+            status=PolicyHolderInsureeBatchUpload.Status.COMPLETED,
+            uploaded_file__file_name_hash=file_hash,
+            dry_run=False,
+        )
+        .order_by("-completed_at")
+        .first()
+    )
@@ -0,0 +1,112 @@
+"""
+Wall time and query count per stage of a policyholder insuree import.
+
+Stages nest: time and queries are charged to the innermost open stage only, so
+the stage totals add up to the instrumented part of the import.
+"""
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+
+IMPORT_STAGES = (
+    "parse",
+    "validate",
+    "lookup",
+    "insuree",
+    "family",
+    "category_change",
+    "delete",
+    "phi_upsert",
+    "side_effects",
+)
+
+
+class ImportStageTimer:
+    """
+    Collects cumulative {"seconds", "queries", "calls"} per stage.
+    Queries are only counted while the timer is active (``with timer:``),
+    ``queries`` also counts those run outside of any stage.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.queries = 0
+        self._stack = []
+        self._started_at = None
+
+    def __enter__(self):
+        self._wrapper = connection.execute_wrapper(self._count_query)
+        self._wrapper.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._wrapper.__exit__(*exc_info)
+
+    def _entry(self, name):
+        return self.stages.setdefault(name, {"seconds": 0.0, "queries": 0, "calls": 0})
+
+    def _count_query(self, execute, sql, params, many, context):
+        self.queries += 1
+        if self._stack:
+            self._entry(self._stack[-1])["queries"] += 1
+        return execute(sql, params, many, context)
+
+    def _pause_current(self, now):
+        if self._stack:
+            self._entry(self._stack[-1])["seconds"] += now - self._started_at
+
+    @contextmanager
+    def stage(self, name):
+        now = time.perf_counter()
+        self._pause_current(now)
+        self._stack.append(name)
+        self._entry(name)["calls"] += 1
+        self._started_at = now
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self._pause_current(now)
+            self._stack.pop()
+            self._started_at = now
+
+    def wrap(self, name, function):
+        """``function`` with each call charged to ``name``."""
+        def timed(*args, **kwargs):
+            with self.stage(name):
+                return function(*args, **kwargs)
+        return timed
+
+    def wrap_iterator(self, name, iterable):
+        """Iterate over ``iterable`` charging the production of each item to ``name``."""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def as_dict(self):
+        return {
+            name: {
+                "seconds": round(values["seconds"], 3),
+                "queries": values["queries"],
+                "calls": values["calls"],
+            }
+            for name, values in self.stages.items()
+        }
+
+
+def merge_stage_timings(*timings):
+    """Sum stage timings dicts, e.g. those of the chunks of one import."""
+    merged = {}
+    for stages in timings:
+        for name, values in (stages or {}).items():
+            entry = merged.setdefault(name, {"seconds": 0.0, "queries": 0, "calls": 0})
+            entry["seconds"] = round(entry["seconds"] + values.get("seconds", 0), 3)
+            entry["queries"] += values.get("queries", 0)
+            entry["calls"] += values.get("calls", 0)
+    return merged
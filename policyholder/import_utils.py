@@ -5,22 +5,30 @@ Shared between views.py (synchronous) and tasks.py (asynchronous) imports.
 import json
 import logging
 import math
-from datetime import datetime, timedelta
+import os
+from contextlib import nullcontext
+from datetime import date, datetime, timedelta
 
+import openpyxl
+import pandas as pd
+from openpyxl.utils.exceptions import InvalidFileException
+
+from django.db import transaction
 from django.utils import timezone
 from insuree.models import Family, Gender, Insuree
 from location.models import Location
-from policyholder.models import PolicyHolder, PolicyHolderInsuree, CategoryChange
+from policyholder.models import PHI_BULK_BATCH_SIZE, PolicyHolder, PolicyHolderInsuree, CategoryChange
 from policyholder.constants import (
     CC_PENDING, CC_WAITING_FOR_DOCUMENT, CC_PROCESSING, CC_WAITING_FOR_APPROVAL
 )
 
 from contract.utils import map_enrolment_type_to_category
-from insuree.gql_mutations import temp_generate_employee_camu_registration_number
 from policyholder.dms_utils import (
     create_folder_for_cat_chnage_req,
     send_notification_to_head,
 )
+from policyholder.chf_id_allocator import reserve_chf_id
+from policyholder.import_outbox import enqueue_created_insuree_side_effects
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +36,9 @@ logger = logging.getLogger(__name__)
 MINIMUM_AGE_LIMIT = 18
 MINIMUM_AGE_LIMIT_FOR_STUDENTS = 16
 
+# Keeps IN (...) lookups well below the SQL Server 2100 parameter limit
+IMPORT_LOOKUP_BATCH_SIZE = 1000
+
 HEADER_INSUREE_CAMU_NO = "camu_number"
 HEADER_FAMILY_LOCATION_CODE = "family_location_code"
 HEADER_INSUREE_OTHER_NAMES = "insuree_other_names"
@@ -60,6 +71,36 @@ HEADERS = [
     HEADER_DELETE,
 ]
 
+# Formats tried in this order for the date of birth of new insurees
+IMPORT_DATE_FORMATS = ["%Y-%m-%d", "%m/%d/%Y", "%d/%m/%Y"]
+IMPORT_DELETE_VALUES = ["true", "1", "oui", "yes"]
+
+# Columns required to create an insuree, with the label used in error messages
+IMPORT_MANDATORY_HEADERS = {
+    HEADER_INSUREE_LAST_NAME: "Nom",
+    HEADER_INSUREE_OTHER_NAMES: "Prénom",
+    HEADER_INSUREE_DOB: "Date de naissance",
+    HEADER_INSUREE_GENDER: "Sexe",
+    HEADER_FAMILY_LOCATION_CODE: "Village",
+}
+
+# French column names of the import sheet mapped to the headers above
+IMPORT_COLUMN_MAPPING = {
+    "Numéro CAMU": HEADER_INSUREE_CAMU_NO,
+    "Prénom": HEADER_INSUREE_OTHER_NAMES,
+    "Nom": HEADER_INSUREE_LAST_NAME,
+    "Numéro CAMU temporaire": HEADER_INSUREE_ID,
+    "Date de naissance": HEADER_INSUREE_DOB,
+    "Lieu de naissance": HEADER_BIRTH_LOCATION_CODE,
+    "Sexe": HEADER_INSUREE_GENDER,
+    "Civilité": HEADER_CIVILITY,
+    "Téléphone": HEADER_PHONE,
+    "Adresse": HEADER_ADDRESS,
+    "Village": HEADER_FAMILY_LOCATION_CODE,
+    "Email": HEADER_EMAIL,
+    "Supprimé": HEADER_DELETE,
+}
+
 GENDERS = {
     "F": Gender.objects.get(code="F"),
     "M": Gender.objects.get(code="M"),
@@ -81,6 +122,508 @@ class LocationEncoder(json.JSONEncoder):
         return super().default(obj)
 
 
+def _rewind(file):
+    if hasattr(file, "seek"):
+        file.seek(0)
+
+
+def _is_legacy_xls(file):
+    name = file if isinstance(file, str) else getattr(file, "name", "") or ""
+    return os.path.splitext(str(name))[1].lower() == ".xls"
+
+
+def _iter_sheet_values(file):
+    """
+    Yield the raw cell values of the first sheet, header row included.
+    xlsx files are streamed with openpyxl in read-only mode, legacy xls files
+    (not supported by openpyxl) go through pandas.
+    """
+    _rewind(file)
+    if _is_legacy_xls(file):
+        df = pd.read_excel(file, header=None)
+        for values in df.itertuples(index=False, name=None):
+            yield tuple(None if pd.isna(value) else value for value in values)
+        return
+
+    try:
+        workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    except InvalidFileException:
+        _rewind(file)
+        df = pd.read_excel(file, header=None)
+        for values in df.itertuples(index=False, name=None):
+            yield tuple(None if pd.isna(value) else value for value in values)
+        return
+
+    try:
+        for values in workbook.worksheets[0].iter_rows(values_only=True):
+            yield values
+    finally:
+        workbook.close()
+
+
+def _iter_sheet_rows(file):
+    """
+    Yield the stripped column names, then the data rows of the first sheet.
+    Trailing empty rows are dropped like pandas.read_excel does.
+    """
+    values = _iter_sheet_values(file)
+    header = next(values, None)
+    if header is None:
+        yield []
+        return
+    yield [
+        str(column).strip() if column is not None else f"Unnamed: {position}"
+        for position, column in enumerate(header)
+    ]
+
+    blank_rows = []
+    for row in values:
+        if all(value is None or (isinstance(value, str) and not value) for value in row):
+            blank_rows.append(row)
+            continue
+        yield from blank_rows
+        blank_rows = []
+        yield row
+
+
+def read_import_columns(file):
+    """Return the stripped column names of the import sheet, as they were uploaded."""
+    rows = _iter_sheet_rows(file)
+    try:
+        return next(rows)
+    finally:
+        rows.close()
+
+
+def count_import_rows(file):
+    """Count the data rows of the import sheet without keeping them in memory."""
+    rows = _iter_sheet_rows(file)
+    next(rows)
+    return sum(1 for _ in rows)
+
+
+def iter_import_rows(file, start=0, end=None):
+    """
+    Stream the rows of the import sheet as (index, row) pairs.
+
+    ``index`` is the 0-based data row number (as with DataFrame.iterrows) and
+    ``row`` a dict keyed by the import headers (see IMPORT_COLUMN_MAPPING),
+    ready for clean_line(). Only one row is held in memory at a time.
+    Rows before ``start`` and from ``end`` on are skipped.
+    """
+    rows = _iter_sheet_rows(file)
+    columns = [IMPORT_COLUMN_MAPPING.get(column, column) for column in next(rows)]
+    try:
+        for index, values in enumerate(rows):
+            if index < start:
+                continue
+            if end is not None and index >= end:
+                break
+            values = tuple(values) + (None,) * (len(columns) - len(values))
+            yield index, dict(zip(columns, values))
+    finally:
+        rows.close()
+
+
+def row_ranges_share_insurees(file, row_ranges):
+    """
+    Whether rows of different ``row_ranges`` (sorted (start, end) pairs) refer
+    to the same insuree: same temporary CAMU or CAMU number, or for new
+    insurees the same name and date of birth. The duplicate checks only see the
+    rows processed before, parallel chunks would miss such rows.
+    """
+    range_of_key = {}
+    position = 0
+    for index, row in iter_import_rows(file, start=row_ranges[0][0], end=row_ranges[-1][1]):
+        while index >= row_ranges[position][1]:
+            position += 1
+        if index < row_ranges[position][0]:
+            continue
+        keys = [
+            (header, _normalize_lookup_value(row.get(header)))
+            for header in (HEADER_INSUREE_ID, HEADER_INSUREE_CAMU_NO)
+            if _normalize_lookup_value(row.get(header))
+        ]
+        if not keys and name_dob_key(row):
+            keys.append((HEADER_INSUREE_DOB, name_dob_key(row)))
+        for key in keys:
+            if range_of_key.setdefault(key, position) != position:
+                return True
+    return False
+
+
+def _as_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
+
+def _parse_name_dob_date(value):
+    """Date of birth as stored on insuree creation, see validating_insuree_on_name_dob()."""
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    if isinstance(value, str):
+        for date_format in ("%d/%m/%Y", "%Y-%m-%d"):
+            try:
+                return datetime.strptime(value.strip(), date_format).date()
+            except ValueError:
+                continue
+    return None
+
+
+def name_dob_key(line):
+    """(last_name, other_names, dob) used to detect insurees registered twice, or None."""
+    last_name = _blank_to_none(line.get(HEADER_INSUREE_LAST_NAME))
+    other_names = _blank_to_none(line.get(HEADER_INSUREE_OTHER_NAMES))
+    dob = _parse_name_dob_date(line.get(HEADER_INSUREE_DOB))
+    if last_name is None or other_names is None or dob is None:
+        return None
+    return last_name, other_names, dob
+
+
+def _normalize_lookup_value(value):
+    """Mirror clean_line() so preloaded keys match the values seen in the row loop."""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = value.strip()
+        return value or None
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return str(value)
+
+
+def _chunks(values, size=IMPORT_LOOKUP_BATCH_SIZE):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+_MISSING = object()
+
+
+class InsureeImportContext:
+    """
+    Lookups preloaded once per imported sheet.
+
+    All insurees (by temporary CAMU number and CAMU number), villages and
+    families referenced by the sheet are resolved with a few IN (...) queries
+    before the row loop, and the same instances are handed to every helper so
+    a row no longer hits the Insuree table once per helper.
+    """
+
+    def __init__(self):
+        self.insurees_by_id = {}
+        self.insurees_by_chf_id = {}
+        self.insurees_by_camu_number = {}
+        self.villages_by_code = {}
+        self.families_by_head_id = {}
+        # {row index: error} found by prevalidate_import_rows() for this batch
+        self.prevalidation_errors = {}
+        # (last_name, other_names, dob) of the insurees already registered
+        self.existing_name_dob = set()
+        # {row index: RowFingerprint} of this batch, see import_fingerprint
+        self.row_fingerprints = {}
+        # registrations of the current row, undone when its writes are rolled back
+        self._row_journal = None
+
+    @classmethod
+    def from_dataframe(cls, df):
+        return cls.from_rows(df.to_dict("records"))
+
+    @classmethod
+    def from_rows(cls, rows):
+        chf_ids, camu_numbers, village_codes, name_dob_keys = set(), set(), set(), set()
+        for row in rows:
+            if not _normalize_lookup_value(row.get(HEADER_INSUREE_ID)) \
+                    and not _normalize_lookup_value(row.get(HEADER_INSUREE_CAMU_NO)):
+                key = name_dob_key(row)
+                if key:
+                    name_dob_keys.add(key)
+            for values, header in (
+                (chf_ids, HEADER_INSUREE_ID),
+                (camu_numbers, HEADER_INSUREE_CAMU_NO),
+                (village_codes, HEADER_FAMILY_LOCATION_CODE),
+            ):
+                value = _normalize_lookup_value(row.get(header))
+                if value:
+                    values.add(value)
+
+        context = cls()
+        context.preload(
+            chf_ids=chf_ids,
+            camu_numbers=camu_numbers,
+            village_codes=village_codes,
+        )
+        context.preload_name_dob(name_dob_keys)
+        return context
+
+    def preload(self, chf_ids=(), camu_numbers=(), village_codes=()):
+        for chunk in _chunks(chf_ids):
+            self._add_insurees(
+                Insuree.objects.filter(validity_to__isnull=True, chf_id__in=chunk)
+            )
+        for chunk in _chunks(camu_numbers):
+            self._add_insurees(
+                Insuree.objects.filter(validity_to__isnull=True, camu_number__in=chunk)
+            )
+        for chunk in _chunks(village_codes):
+            villages = Location.objects.filter(
+                validity_to__isnull=True, type="V", code__in=chunk
+            ).select_related("parent__parent__parent").order_by("id")
+            for village in villages:
+                self.villages_by_code.setdefault(village.code, village)
+
+        head_ids = {insuree.id for insuree in self.insurees}
+        for chunk in _chunks(head_ids):
+            families = Family.objects.filter(
+                validity_to__isnull=True, head_insuree_id__in=chunk
+            ).order_by("id")
+            for family in families:
+                self.families_by_head_id.setdefault(family.head_insuree_id, family)
+
+    def preload_name_dob(self, keys):
+        """
+        Resolve which (last_name, other_names, dob) already belong to an insuree,
+        the bulk version of validating_insuree_on_name_dob().
+        """
+        for chunk in _chunks(keys, IMPORT_LOOKUP_BATCH_SIZE // 2):
+            existing = Insuree.objects.filter(
+                validity_to__isnull=True,
+                legacy_id__isnull=True,
+                dob__in={dob for _, _, dob in chunk},
+                last_name__in={last_name for last_name, _, _ in chunk},
+            ).values_list("last_name", "other_names", "dob")
+            wanted = set(chunk)
+            self.existing_name_dob.update(
+                key for key in ((last_name, other_names, _as_date(dob)) for last_name, other_names, dob in existing)
+                if key in wanted
+            )
+
+    def has_name_dob(self, key):
+        return key in self.existing_name_dob
+
+    def _add_insurees(self, queryset):
+        for insuree in queryset.select_related("family").order_by("id"):
+            self.register_insuree(insuree)
+
+    @property
+    def insurees(self):
+        return self.insurees_by_id.values()
+
+    def _set(self, mapping, key, value, replace=True):
+        previous = mapping.get(key, _MISSING)
+        if previous is not _MISSING and not replace:
+            return previous
+        if self._row_journal is not None:
+            self._row_journal.append((mapping, key, previous))
+        mapping[key] = value
+        return value
+
+    def register_insuree(self, insuree):
+        # one instance per insuree, and the lowest id wins like .first() would
+        insuree = self._set(self.insurees_by_id, insuree.id, insuree, replace=False)
+        if insuree.chf_id:
+            self._set(self.insurees_by_chf_id, str(insuree.chf_id), insuree, replace=False)
+        if insuree.camu_number:
+            self._set(self.insurees_by_camu_number, str(insuree.camu_number), insuree, replace=False)
+
+    def register_created_insuree(self, insuree):
+        self.register_insuree(insuree)
+        dob = _parse_name_dob_date(insuree.dob)
+        if dob:
+            self.register_name_dob((insuree.last_name, insuree.other_names, dob))
+
+    def register_name_dob(self, key):
+        """Make the (last_name, other_names, dob) ``key`` of a new insuree a duplicate for later rows."""
+        if key and key not in self.existing_name_dob:
+            self.existing_name_dob.add(key)
+            if self._row_journal is not None:
+                self._row_journal.append((self.existing_name_dob, key, _MISSING))
+
+    def register_family(self, family):
+        self._set(self.families_by_head_id, family.head_insuree_id, family)
+
+    def start_row(self):
+        self._row_journal = []
+
+    def rollback_row(self, line):
+        """
+        Undo the registrations of the row started last, whose writes were rolled
+        back, and reload its existing insuree that the row may have modified.
+        """
+        for mapping, key, previous in reversed(self._row_journal or []):
+            if previous is not _MISSING:
+                mapping[key] = previous
+            elif isinstance(mapping, set):
+                mapping.discard(key)
+            else:
+                mapping.pop(key, None)
+        self._row_journal = None
+        insuree = self.get_insuree(line)
+        if insuree is not None:
+            insuree.refresh_from_db()
+
+    def get_insuree(self, line, camu_fallback=True):
+        id_val = _normalize_lookup_value(line.get(HEADER_INSUREE_ID))
+        camu_num = _normalize_lookup_value(line.get(HEADER_INSUREE_CAMU_NO))
+        if id_val:
+            insuree = self.insurees_by_chf_id.get(id_val)
+            if insuree or not camu_fallback:
+                return insuree
+        if camu_num:
+            return self.insurees_by_camu_number.get(camu_num)
+        return None
+
+    def get_village(self, village_code):
+        village_code = _normalize_lookup_value(village_code)
+        return self.villages_by_code.get(village_code) if village_code else None
+
+    def get_family(self, insuree):
+        return self.families_by_head_id.get(insuree.id)
+
+
+def iter_rows_with_context(
+    rows, batch_size=IMPORT_LOOKUP_BATCH_SIZE, minimum_age=None, timer=None, row_fingerprints=None
+):
+    """
+    Yield (index, row, context) for streamed (index, row) pairs.
+    Rows are read ahead ``batch_size`` at a time and each batch gets its own
+    InsureeImportContext, so memory stays bounded for any file size.
+    With ``minimum_age`` each batch is also run through prevalidate_import_rows(),
+    charged to the "validate" stage of ``timer`` when given.
+    With ``row_fingerprints`` (ImportRowFingerprints) the context tells which
+    rows did not change since the previous import.
+    """
+    batch = []
+    for item in rows:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield from _batch_with_context(batch, minimum_age, timer, row_fingerprints)
+            batch = []
+    if batch:
+        yield from _batch_with_context(batch, minimum_age, timer, row_fingerprints)
+
+
+def _batch_with_context(batch, minimum_age=None, timer=None, row_fingerprints=None):
+    errors = {}
+    if minimum_age is not None:
+        with timer.stage("validate") if timer else nullcontext():
+            errors = prevalidate_import_rows(batch, minimum_age)
+    fingerprints = {}
+    if row_fingerprints is not None:
+        fingerprints = row_fingerprints.load([(index, row) for index, row in batch if index not in errors])
+    # rows rejected or unchanged never reach the ORM stage, no need to preload them
+    context = InsureeImportContext.from_rows(
+        row for index, row in batch
+        if index not in errors and not (index in fingerprints and fingerprints[index].unchanged)
+    )
+    context.prevalidation_errors = errors
+    context.row_fingerprints = fingerprints
+    for index, row in batch:
+        yield index, row, context
+
+
+def get_import_minimum_age(cpb):
+    if cpb and (cpb.code == "PSC05" or cpb.name == "Etudiants"):
+        return MINIMUM_AGE_LIMIT_FOR_STUDENTS
+    return MINIMUM_AGE_LIMIT
+
+
+def is_delete_flagged(value):
+    return bool(value) and str(value).lower() in IMPORT_DELETE_VALUES
+
+
+def _parse_dob(value):
+    if isinstance(value, datetime):
+        return value
+    for date_format in IMPORT_DATE_FORMATS:
+        try:
+            return datetime.strptime(str(value), date_format)
+        except (ValueError, TypeError):
+            continue
+    return None
+
+
+def _blank_to_none(value):
+    if isinstance(value, str):
+        value = value.strip()
+        return value or None
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def prevalidate_import_rows(rows, minimum_age):
+    """
+    Column-wise validation of a batch of (index, row) pairs, run before any
+    database work. Rows without temporary CAMU / CAMU number (new insurees) are
+    checked for a parsable date of birth, the minimum age and, unless flagged
+    for deletion, the mandatory columns. Returns {index: error} for the rows
+    to report as KO straight away, messages are the ones of the row loop.
+    """
+    rows = list(rows)
+    if not rows:
+        return {}
+
+    index = [row_index for row_index, _ in rows]
+    df = pd.DataFrame.from_records(
+        [{header: _blank_to_none(row.get(header)) for header in HEADERS} for _, row in rows],
+        index=index,
+        columns=HEADERS,
+    )
+
+    new_insuree = df[HEADER_INSUREE_ID].isna() & df[HEADER_INSUREE_CAMU_NO].isna()
+    to_delete = df[HEADER_DELETE].map(is_delete_flagged)
+    dob_values = df[HEADER_INSUREE_DOB]
+    has_dob = new_insuree & dob_values.notna()
+
+    # Parse every date format in bulk, first matching format wins like in the row loop
+    dob_text = dob_values[has_dob].map(
+        lambda value: value.strftime("%Y-%m-%d") if isinstance(value, datetime) else str(value)
+    )
+    dobs = pd.Series(pd.NaT, index=dob_text.index, dtype="datetime64[ns]")
+    for date_format in IMPORT_DATE_FORMATS:
+        missing = dobs.isna()
+        if not missing.any():
+            break
+        parsed = pd.to_datetime(dob_text[missing], format=date_format, errors="coerce")
+        parsed = parsed[(parsed >= pd.Timestamp.min) & (parsed <= pd.Timestamp.max)]
+        dobs[parsed.index] = parsed.astype("datetime64[ns]")
+
+    # Dates pandas cannot represent (e.g. year < 1677) are retried one by one
+    ages = {}
+    for row_index in dobs.index[dobs.isna()]:
+        dob = _parse_dob(dob_values[row_index])
+        if dob is not None:
+            ages[row_index] = (datetime.now().date() - dob.date()) // timedelta(days=365.25)
+
+    today = pd.Timestamp(datetime.now().date())
+    parsed = dobs.dropna()
+    age_values = ((today - parsed.dt.normalize()).dt.days // 365.25).astype(int)
+    ages.update(age_values.to_dict())
+
+    errors = {}
+    for row_index in dob_text.index:
+        age = ages.get(row_index)
+        if age is None:
+            errors[row_index] = f"Format de date invalide: {dob_values[row_index]}"
+        elif age < minimum_age:
+            errors[row_index] = f"L'assuré doit être âgé d'au moins {minimum_age} ans."
+
+    required = new_insuree & ~to_delete
+    missing_columns = df.loc[required, list(IMPORT_MANDATORY_HEADERS)].isna()
+    for row_index, missing in missing_columns[missing_columns.any(axis=1)].iterrows():
+        if row_index in errors:
+            continue
+        labels = [IMPORT_MANDATORY_HEADERS[header] for header, is_missing in missing.items() if is_missing]
+        errors[row_index] = f"Champs obligatoires manquants : {', '.join(labels)}"
+
+    return errors
+
+
 def clean_line(line):
     for header in HEADERS:
         value = line[header]
@@ -98,17 +641,22 @@ def clean_line(line):
             line[header] = int(value)
 
 
-def get_village_from_line(line):
+def get_village_from_line(line, context=None):
     village_code = line.get(HEADER_FAMILY_LOCATION_CODE)
+    if context is not None:
+        return context.get_village(village_code)
     return Location.objects.filter(
         validity_to__isnull=True, type="V", code=village_code
     ).first()
 
 
-def get_or_create_family_from_line(line, audit_user_id, enrolment_type, insuree, village):
-    family = Family.objects.filter(
-        validity_to__isnull=True, head_insuree=insuree
-    ).first()
+def get_or_create_family_from_line(line, audit_user_id, enrolment_type, insuree, village, context=None):
+    if context is not None:
+        family = context.get_family(insuree)
+    else:
+        family = Family.objects.filter(
+            validity_to__isnull=True, head_insuree=insuree
+        ).first()
 
     if family:
         return family, True
@@ -126,15 +674,106 @@ def get_or_create_family_from_line(line, audit_user_id, enrolment_type, insuree,
     )
 
     if family:
-        insurees = Insuree.objects.filter(id=insuree.id).first()
-        insurees.family = family
-        insurees.head = True
-        insurees.save()
+        # the instance in hand is up to date, no need to fetch it again
+        Insuree.objects.filter(id=insuree.id).update(family=family, head=True)
+        insuree.family = family
+        insuree.head = True
+        if context is not None:
+            context.register_family(family)
         return family, True
 
     return None, False
 
 
+class ImportFamilyBuilder:
+    """
+    Families of the new heads of an import, created a batch of rows at a time:
+    build() inserts the queued families with one bulk_create and sets the
+    family and head of their insurees with one bulk_update. The insuree
+    instances in hand are updated in place, nothing is fetched again.
+    """
+
+    def __init__(self, audit_user_id, enrolment_type):
+        self.audit_user_id = audit_user_id
+        self.enrolment_type = enrolment_type
+        # {head insuree id: (insuree, unsaved Family, InsureeImportContext or None)}
+        self.pending = {}
+        # {head insuree id: family id} of the families built so far
+        self.family_ids = {}
+
+    def has_family(self, insuree, context=None):
+        """
+        Whether the insuree heads a family, of the context or built earlier in
+        the import (a batch preloaded before its family was built is updated).
+        """
+        if context is not None and context.get_family(insuree):
+            return True
+        if insuree.id in self.pending:
+            return True
+        family_id = self.family_ids.get(insuree.id)
+        if family_id is None:
+            return False
+        insuree.family_id = family_id
+        insuree.head = True
+        return True
+
+    def add(self, line, insuree, village, context=None):
+        """Queue the family of ``insuree`` as head, in ``village``."""
+        if insuree.id in self.pending:
+            return
+        self.pending[insuree.id] = (
+            insuree,
+            Family(
+                head_insuree=insuree,
+                location=village,
+                audit_user_id=self.audit_user_id,
+                status="PRE_REGISTERED",
+                address=line.get(HEADER_ADDRESS),
+                json_ext={"enrolmentType": map_enrolment_type_to_category(self.enrolment_type)},
+            ),
+            context,
+        )
+
+    def build(self):
+        """
+        Create the queued families and return the ids of their heads. The
+        queue is emptied, also when the families cannot be created.
+        """
+        pending, self.pending = self.pending, {}
+        if not pending:
+            return set()
+
+        previous = {insuree_id: (insuree.family, insuree.head) for insuree_id, (insuree, _, _) in pending.items()}
+        families = [family for _, family, _ in pending.values()]
+        try:
+            with transaction.atomic():
+                Family.objects.bulk_create(families)
+                if any(family.pk is None for family in families):
+                    # backends that do not return the ids of inserted rows
+                    family_ids = {
+                        str(uuid).lower(): family_id
+                        for uuid, family_id in Family.objects.filter(
+                            uuid__in=[str(family.uuid) for family in families]
+                        ).values_list("uuid", "id")
+                    }
+                    for family in families:
+                        family.pk = family_ids[str(family.uuid).lower()]
+                for insuree, family, _ in pending.values():
+                    insuree.family = family
+                    insuree.head = True
+                Insuree.objects.bulk_update([insuree for insuree, _, _ in pending.values()], ["family", "head"])
+        except Exception:
+            for insuree, _, _ in pending.values():
+                insuree.family, insuree.head = previous[insuree.id]
+            raise
+
+        for insuree, family, context in pending.values():
+            self.family_ids[insuree.id] = family.pk
+            if context is not None:
+                context.register_family(family)
+        return set(pending)
+
+
 def get_or_create_insuree_from_line(
     line,
     village,
@@ -142,23 +781,26 @@ def get_or_create_insuree_from_line(
     user_obj,
     core_user_id=None,
     enrolment_type=None,
+    context=None,
+    chf_id_allocator=None,
 ):
     """
     Get or create Insuree from line data.
+    When an InsureeImportContext is given, existing insurees are taken from it,
+    new temporary CAMU numbers come from ``chf_id_allocator`` when given.
     """
-    from insuree.abis_api import create_abis_insuree
-    from insuree.dms_utils import create_openKm_folder_for_bulkupload
-    from workflow.workflow_stage import insuree_add_to_workflow
-
     id_val = line.get(HEADER_INSUREE_ID)
     camu_num = line.get(HEADER_INSUREE_CAMU_NO)
     insuree = None
 
-    if id_val:
-        insuree = Insuree.objects.filter(validity_to__isnull=True, chf_id=id_val).first()
+    if context is not None:
+        insuree = context.get_insuree(line)
+    else:
+        if id_val:
+            insuree = Insuree.objects.filter(validity_to__isnull=True, chf_id=id_val).first()
 
-    if not insuree and camu_num:
-        insuree = Insuree.objects.filter(validity_to__isnull=True, camu_number=camu_num).first()
+        if not insuree and camu_num:
+            insuree = Insuree.objects.filter(validity_to__isnull=True, camu_number=camu_num).first()
 
     if insuree:
         age = (datetime.now().date() - insuree.dob) // timedelta(days=365.25)
@@ -188,45 +830,42 @@ def get_or_create_insuree_from_line(
         village,
         line.get(HEADER_INSUREE_DOB),
         enrolment_type,
+        chf_id_allocator=chf_id_allocator,
     )
 
     current_village = village
     response_string = json.dumps(current_village, cls=LocationEncoder)
     response_data = json.loads(response_string)
     
-    insuree = Insuree.objects.create(
-        other_names=line.get(HEADER_INSUREE_OTHER_NAMES),
-        last_name=line.get(HEADER_INSUREE_LAST_NAME),
-        dob=line.get(HEADER_INSUREE_DOB),
-        audit_user_id=audit_user_id,
-        card_issued=False,
-        chf_id=insuree_id,
-        gender=GENDERS.get(line.get(HEADER_INSUREE_GENDER)),
-        head=False,
-        current_village=current_village,
-        current_address=line.get(HEADER_ADDRESS),
-        phone=line.get(HEADER_PHONE),
-        created_by=core_user_id,
-        modified_by=core_user_id,
-        marital=mapping_marital_status(line.get(HEADER_CIVILITY)),
-        email=line.get(HEADER_EMAIL),
-        json_ext={
-            "insureeEnrolmentType": map_enrolment_type_to_category(enrolment_type),
-            "insureelocations": response_data,
-            "BirthPlace": line.get(HEADER_BIRTH_LOCATION_CODE),
-            "insureeaddress": line.get(HEADER_ADDRESS),
-        },
-    )
+    with transaction.atomic():
+        insuree = Insuree.objects.create(
+            other_names=line.get(HEADER_INSUREE_OTHER_NAMES),
+            last_name=line.get(HEADER_INSUREE_LAST_NAME),
+            dob=line.get(HEADER_INSUREE_DOB),
+            audit_user_id=audit_user_id,
+            card_issued=False,
+            chf_id=insuree_id,
+            gender=GENDERS.get(line.get(HEADER_INSUREE_GENDER)),
+            head=False,
+            current_village=current_village,
+            current_address=line.get(HEADER_ADDRESS),
+            phone=line.get(HEADER_PHONE),
+            created_by=core_user_id,
+            modified_by=core_user_id,
+            marital=mapping_marital_status(line.get(HEADER_CIVILITY)),
+            email=line.get(HEADER_EMAIL),
+            json_ext={
+                "insureeEnrolmentType": map_enrolment_type_to_category(enrolment_type),
+                "insureelocations": response_data,
+                "BirthPlace": line.get(HEADER_BIRTH_LOCATION_CODE),
+                "insureeaddress": line.get(HEADER_ADDRESS),
+            },
+        )
+        # DMS folder, workflow and ABIS are delivered by the outbox workers
+        enqueue_created_insuree_side_effects(insuree, user=user_obj)
 
-    try:
-        # UPDATED: Use the passed user_obj, do not rely on request
-        if user_obj:
-            create_openKm_folder_for_bulkupload(user_obj, insuree)
-        
-        insuree_add_to_workflow(None, insuree.id, "INSUREE_ENROLLMENT", "Pre_Register")
-        create_abis_insuree(None, insuree)
-    except Exception as e:
-        logger.error(f"insuree bulk upload error for abis or workflow : {e}")
+    if insuree and context is not None:
+        context.register_created_insuree(insuree)
 
     if insuree:
         return insuree, None
@@ -270,7 +909,7 @@ def create_dependent_category_change(
     logger.info(f"CategoryChange request created for Insuree {insuree} for {request_type.lower()} request")
 
 
-def check_for_category_change_request(user, line, policy_holder, enrolment_type):
+def check_for_category_change_request(user, line, policy_holder, enrolment_type, context=None):
     try:
         insuree_id = line.get(HEADER_INSUREE_ID, "")
         camu_num = line.get(HEADER_INSUREE_CAMU_NO, "")
@@ -278,11 +917,14 @@ def check_for_category_change_request(user, line, policy_holder, enrolment_type)
         employer_number = line.get(HEADER_EMPLOYER_NUMBER, "")
         insuree = None
 
-        if insuree_id:
-            insuree = Insuree.objects.filter(validity_to__isnull=True, chf_id=insuree_id).first()
+        if context is not None:
+            insuree = context.get_insuree(line)
+        else:
+            if insuree_id:
+                insuree = Insuree.objects.filter(validity_to__isnull=True, chf_id=insuree_id).first()
 
-        if not insuree and camu_num:
-            insuree = Insuree.objects.filter(validity_to__isnull=True, camu_number=camu_num).first()
+            if not insuree and camu_num:
+                insuree = Insuree.objects.filter(validity_to__isnull=True, camu_number=camu_num).first()
 
         if insuree:
             new_category = map_enrolment_type_to_category(enrolment_type)
@@ -325,7 +967,11 @@ def check_for_category_change_request(user, line, policy_holder, enrolment_type)
         return False
 
 
-def generate_available_chf_id(gender, village, dob, insureeEnrolmentType):
+def generate_available_chf_id(gender, village, dob, insureeEnrolmentType, chf_id_allocator=None):
+    """
+    Next temporary CAMU number for the insuree, taken from the blocks of a
+    ChfIdBlockAllocator when one is given, reserved on its own otherwise.
+    """
     data = {
         "gender_id": gender.upper(),
         "json_ext": {
@@ -338,7 +984,11 @@ def generate_available_chf_id(gender, village, dob, insureeEnrolmentType):
         "dob": dob,
         "insureeEnrolmentType": map_enrolment_type_to_category(insureeEnrolmentType),
     }
-    return temp_generate_employee_camu_registration_number(None, data)
+    if chf_id_allocator is not None:
+        return chf_id_allocator.allocate(
+            village.parent.parent.parent.code, data["insureeEnrolmentType"], data
+        )
+    return reserve_chf_id(village.parent.parent.parent.code, data["insureeEnrolmentType"], data)
 
 
 def mapping_marital_status(marital, value=None):
@@ -355,7 +1005,7 @@ def mapping_marital_status(marital, value=None):
     else:
         return ""
 
-def validating_insuree_on_name_dob(line, policy_holder):
+def validating_insuree_on_name_dob(line, policy_holder, context=None):
     insuree_dob = line.get(HEADER_INSUREE_DOB)
     if not isinstance(insuree_dob, datetime):
         try:
@@ -364,6 +1014,10 @@ def validating_insuree_on_name_dob(line, policy_holder):
         except:
             pass
 
+    if context is not None:
+        key = name_dob_key(line)
+        return bool(key) and context.has_name_dob(key)
+
     insuree = Insuree.objects.filter(
         other_names=line.get(HEADER_INSUREE_OTHER_NAMES),
         last_name=line.get(HEADER_INSUREE_LAST_NAME),
@@ -377,15 +1031,22 @@ def validating_insuree_on_name_dob(line, policy_holder):
 def get_policy_holder_from_code(ph_code: str):
     return PolicyHolder.objects.filter(code=ph_code, is_deleted=False).first()
 
-def soft_delete_insuree(line, policy_holder_code, user_id):
+def soft_delete_insuree(line, policy_holder_code, user_id, context=None, dry_run=False):
+    """
+    End the link of the insuree of ``line`` to the policyholder, returns whether
+    there was one. A ``dry_run`` only checks that the link exists.
+    """
     id_val = line.get(HEADER_INSUREE_ID)
     camu_num = line.get(HEADER_INSUREE_CAMU_NO)
     insuree = None
-    if id_val:
-        insuree = Insuree.objects.filter(validity_to__isnull=True, chf_id=id_val).first()
-    if not insuree:
-        insuree = Insuree.objects.filter(validity_to__isnull=True, camu_number=camu_num).first()
-        
+    if context is not None:
+        insuree = context.get_insuree(line)
+    else:
+        if id_val:
+            insuree = Insuree.objects.filter(validity_to__isnull=True, chf_id=id_val).first()
+        if not insuree:
+            insuree = Insuree.objects.filter(validity_to__isnull=True, camu_number=camu_num).first()
+
     if insuree:
         phn = PolicyHolderInsuree.objects.filter(
             insuree_id=insuree.id,
@@ -395,9 +1056,40 @@ def soft_delete_insuree(line, policy_holder_code, user_id):
             date_valid_to__isnull=True,
             is_deleted=False,
         ).first()
+        if phn and dry_run:
+            return True
         if phn:
             PolicyHolderInsuree.objects.filter(id=phn.id).update(
                 is_deleted=True, date_valid_to=datetime.now()
             )
             return True
-    return False
\ No newline at end of file
+    return False
+
+
+def soft_delete_insurees(insurees, policy_holder_code, dry_run=False):
+    """
+    Set-based soft_delete_insuree() for the insurees of the delete-flagged rows
+    of a batch, as resolved by the InsureeImportContext: their links to the
+    policyholder are ended with an UPDATE per PHI_BULK_BATCH_SIZE links, as
+    MSSQL caps a query at 2100 parameters. Returns the ids of the insurees
+    that had a link. A ``dry_run`` only looks the links up.
+    """
+    linked = {}
+    for chunk in _chunks({insuree.id for insuree in insurees}):
+        linked.update(
+            PolicyHolderInsuree.objects.filter(
+                insuree_id__in=chunk,
+                policy_holder__code=policy_holder_code,
+                policy_holder__date_valid_to__isnull=True,
+                policy_holder__is_deleted=False,
+                date_valid_to__isnull=True,
+                is_deleted=False,
+            ).values_list("id", "insuree_id")
+        )
+    if linked and not dry_run:
+        now = datetime.now()
+        for chunk in _chunks(linked, PHI_BULK_BATCH_SIZE):
+            PolicyHolderInsuree.objects.filter(
+                id__in=chunk, date_valid_to__isnull=True, is_deleted=False
+            ).update(is_deleted=True, date_valid_to=now)
+    return set(linked.values())
\ No newline at end of file
@@ -0,0 +1,77 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import User
+
+from policyholder.import_benchmark import (
+    BENCHMARK_SIZES,
+    get_benchmark_village_codes,
+    run_import_benchmark,
+)
+from policyholder.import_timing import IMPORT_STAGES
+from policyholder.import_utils import get_policy_holder_from_code
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the insuree import on generated workbooks (1k/10k/100k rows by default) "
+        "with local stand-ins for S3, DMS, ABIS, workflow and emails. "
+        "Imports are committed unless --rollback is given: use a disposable database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("policyholder_code", help="Code of the policy holder the insurees are imported for")
+        parser.add_argument("--rows", type=int, nargs="+", default=list(BENCHMARK_SIZES))
+        parser.add_argument("--username", default="admin", help="User running the import")
+        parser.add_argument("--latency", type=float, default=0.0, help="Seconds slept by every external stand-in call")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--rollback", action="store_true", help="Roll back each run instead of committing it")
+        parser.add_argument("--json", dest="json_path", help="Also write the reports to this JSON file")
+
+    def handle(self, *args, **options):
+        policy_holder = get_policy_holder_from_code(options["policyholder_code"])
+        if not policy_holder:
+            raise CommandError(f"Unknown policy holder {options['policyholder_code']}")
+        user = User.objects.filter(username=options["username"]).first()
+        if not user:
+            raise CommandError(f"Unknown user {options['username']}")
+        village_codes = get_benchmark_village_codes()
+        if not village_codes:
+            raise CommandError("No village with a region found, load the location data first")
+
+        reports = []
+        for rows in options["rows"]:
+            self.stdout.write(f"Importing {rows} generated rows...")
+            report = run_import_benchmark(
+                rows,
+                policy_holder,
+                user,
+                village_codes,
+                latency=options["latency"],
+                rollback=options["rollback"],
+                seed=options["seed"],
+            )
+            reports.append(report)
+            self._write_report(report)
+
+        if options["json_path"]:
+            with open(options["json_path"], "w") as output:
+                json.dump(reports, output, indent=2, default=str)
+
+    def _write_report(self, report):
+        self.stdout.write(
+            f"{report['rows']} rows: {report['status']} in {report['import_seconds']}s, "
+            f"{report['rows_per_second']} rows/s, {report['queries_per_row']} queries/row, "
+            f"peak RSS {report['peak_rss_mb']} MB "
+            f"({report['success_count']} OK, {report['error_count']} KO, {report['outbox_entries']} outbox entries)"
+        )
+        if report.get("error"):
+            self.stdout.write(self.style.ERROR(f"  {report['error']}"))
+        stages = report["stages"]
+        for name in IMPORT_STAGES + tuple(sorted(set(stages) - set(IMPORT_STAGES))):
+            if name in stages:
+                stage = stages[name]
+                self.stdout.write(
+                    f"  {name:<16} {stage['seconds']:>10.3f}s {stage['queries']:>9} queries {stage['calls']:>9} calls"
+                )
@@ -6,7 +6,7 @@ from insuree.test_helpers import create_test_insuree
 
 from policyholder.models import PolicyHolder, PolicyHolderInsuree
 
-from policyholder.views import check_for_category_change_request
+from policyholder.import_utils import check_for_category_change_request
 
 HEADER_INSUREE_ID = "insuree_id"
 
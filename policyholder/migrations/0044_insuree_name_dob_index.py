@@ -0,0 +1,19 @@
+# Generated by Django 3.2.25 on 2026-10-18 10:12
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('policyholder', '0043_auto_20260114_1603'),
+    ]
+
+    operations = [
+        # Backs the bulk name + date of birth duplicate check of the insuree import
+        migrations.RunSQL("""
+            CREATE INDEX IF NOT EXISTS "tblInsuree_import_name_dob_idx"
+            ON "tblInsuree" ("DOB", "LastName", "OtherNames")
+            WHERE "ValidityTo" IS NULL AND "LegacyID" IS NULL;
+        """, reverse_sql="""DROP INDEX IF EXISTS "tblInsuree_import_name_dob_idx";"""),
+    ]
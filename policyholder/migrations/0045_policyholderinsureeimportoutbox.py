@@ -0,0 +1,43 @@
+# Generated by Django 3.2.25 on 2026-10-18 11:05
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('insuree', '__latest__'),
+        ('policyholder', '0044_insuree_name_dob_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PolicyHolderInsureeImportOutbox',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('target', models.CharField(choices=[('NOTIFICATION', 'CAMU notification'), ('EMAIL', 'Email'), ('DMS_FOLDER', 'DMS folder'), ('WORKFLOW', 'Workflow'), ('ABIS', 'ABIS')], db_column='Target', max_length=20)),
+                ('status', models.CharField(choices=[('PENDING', 'Pending'), ('PROCESSING', 'Processing'), ('DONE', 'Done'), ('FAILED', 'Failed')], db_column='Status', default='PENDING', max_length=20)),
+                ('payload', models.JSONField(blank=True, db_column='Payload', null=True)),
+                ('attempts', models.IntegerField(db_column='Attempts', default=0)),
+                ('last_error', models.TextField(blank=True, db_column='LastError', null=True)),
+                ('available_at', models.DateTimeField(db_column='AvailableAt', help_text='Not delivered before this time (retry backoff)')),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_column='CreatedAt')),
+                ('updated_at', models.DateTimeField(auto_now=True, db_column='UpdatedAt')),
+                ('created_by', models.ForeignKey(db_column='CreatedBy', null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+                ('insuree', models.ForeignKey(blank=True, db_column='InsureeID', null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='insuree.insuree')),
+                ('policy_holder_insuree', models.ForeignKey(blank=True, db_column='PolicyHolderInsureeID', null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='policyholder.policyholderinsuree')),
+            ],
+            options={
+                'db_table': 'policyholder_PolicyHolderInsureeImportOutbox',
+                'managed': True,
+            },
+        ),
+        migrations.AddIndex(
+            model_name='policyholderinsureeimportoutbox',
+            index=models.Index(fields=['target', 'status', 'available_at'], name='policyholde_Target_af3ab5_idx'),
+        ),
+    ]
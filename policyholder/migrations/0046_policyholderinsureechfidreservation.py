@@ -0,0 +1,30 @@
+# Generated by Django 3.2.25 on 2026-10-18 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('policyholder', '0045_policyholderinsureeimportoutbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PolicyHolderInsureeChfIdReservation',
+            fields=[
+                ('id', models.AutoField(db_column='ReservationID', primary_key=True, serialize=False)),
+                ('region_code', models.CharField(db_column='RegionCode', max_length=50)),
+                ('enrolment_category', models.CharField(db_column='EnrolmentCategory', max_length=50)),
+                ('prefix', models.CharField(db_column='Prefix', max_length=50)),
+                ('counter_width', models.IntegerField(db_column='CounterWidth')),
+                ('next_value', models.BigIntegerField(db_column='NextValue')),
+                ('updated_at', models.DateTimeField(auto_now=True, db_column='UpdatedAt')),
+            ],
+            options={
+                'db_table': 'policyholder_PolicyHolderInsureeChfIdReservation',
+                'managed': True,
+                'unique_together': {('region_code', 'enrolment_category')},
+            },
+        ),
+    ]
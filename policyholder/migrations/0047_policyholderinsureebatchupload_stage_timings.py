@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('policyholder', '0046_policyholderinsureechfidreservation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='policyholderinsureebatchupload',
+            name='stage_timings',
+            field=models.JSONField(blank=True, db_column='StageTimings', help_text='Cumulative seconds, queries and calls per import stage (parse, validate, lookup...)', null=True),
+        ),
+    ]
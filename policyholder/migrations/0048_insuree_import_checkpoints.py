@@ -0,0 +1,46 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('policyholder', '0047_policyholderinsureebatchupload_stage_timings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='policyholderinsureebatchupload',
+            name='uploaded_file',
+            field=models.ForeignKey(blank=True, db_column='UploadedFileUUID', help_text='Imported file, needed to resume the import', null=True, on_delete=django.db.models.deletion.SET_NULL, to='policyholder.policyholderinsureeuploadedfile'),
+        ),
+        migrations.AddField(
+            model_name='policyholderinsureebatchupload',
+            name='resume_count',
+            field=models.IntegerField(db_column='ResumeCount', default=0, help_text='Number of times the import was resumed after an interruption'),
+        ),
+        migrations.CreateModel(
+            name='PolicyHolderInsureeImportResultChunk',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('start_row', models.IntegerField(db_column='StartRow')),
+                ('end_row', models.IntegerField(db_column='EndRow')),
+                ('results', models.JSONField(db_column='Results', default=list)),
+                ('success_count', models.IntegerField(db_column='SuccessCount', default=0)),
+                ('error_count', models.IntegerField(db_column='ErrorCount', default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_column='CreatedAt')),
+                ('batch_upload', models.ForeignKey(db_column='BatchUploadUUID', on_delete=django.db.models.deletion.CASCADE, related_name='result_chunks', to='policyholder.policyholderinsureebatchupload')),
+            ],
+            options={
+                'db_table': 'policyholder_PolicyHolderInsureeImportResultChunk',
+                'managed': True,
+            },
+        ),
+        migrations.AddIndex(
+            model_name='policyholderinsureeimportresultchunk',
+            index=models.Index(fields=['batch_upload', 'start_row'], name='policyholde_BatchUp_f9d54c_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 17:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('policyholder', '0048_insuree_import_checkpoints'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='policyholderinsureeuploadedfile',
+            name='file_name_hash',
+            field=models.CharField(db_column='FileNameHash', db_index=True, max_length=255),
+        ),
+    ]
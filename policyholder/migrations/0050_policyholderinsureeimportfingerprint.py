@@ -0,0 +1,32 @@
+# Generated by Django 3.2.25 on 2026-10-18 18:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('insuree', '__latest__'),
+        ('policyholder', '0049_policyholderinsureeuploadedfile_hash_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PolicyHolderInsureeImportFingerprint',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('row_key', models.CharField(db_column='RowKey', max_length=255)),
+                ('fingerprint', models.CharField(db_column='Fingerprint', max_length=64)),
+                ('updated_at', models.DateTimeField(auto_now=True, db_column='UpdatedAt')),
+                ('insuree', models.ForeignKey(blank=True, db_column='InsureeID', null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='insuree.insuree')),
+                ('policy_holder', models.ForeignKey(db_column='PolicyHolderUUID', on_delete=django.db.models.deletion.CASCADE, related_name='insuree_import_fingerprints', to='policyholder.policyholder')),
+            ],
+            options={
+                'db_table': 'policyholder_PolicyHolderInsureeImportFingerprint',
+                'managed': True,
+                'unique_together': {('policy_holder', 'row_key')},
+            },
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 3.2.25 on 2026-10-18 18:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('policyholder', '0050_policyholderinsureeimportfingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PolicyHolderInsureeImportResult',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('line', models.IntegerField(db_column='Line')),
+                ('chf_id', models.CharField(blank=True, db_column='NumeroCamu', default='', max_length=255)),
+                ('last_name', models.CharField(blank=True, db_column='Nom', default='', max_length=255)),
+                ('other_names', models.CharField(blank=True, db_column='Prenom', default='', max_length=255)),
+                ('status', models.CharField(choices=[('OK', 'OK'), ('KO', 'KO')], db_column='Etat', max_length=2)),
+                ('remark', models.TextField(blank=True, db_column='Remarque', default='')),
+                ('batch_upload', models.ForeignKey(db_column='BatchUploadUUID', on_delete=django.db.models.deletion.CASCADE, related_name='result_rows', to='policyholder.policyholderinsureebatchupload')),
+            ],
+            options={
+                'db_table': 'policyholder_PolicyHolderInsureeImportResult',
+                'managed': True,
+            },
+        ),
+        migrations.AddIndex(
+            model_name='policyholderinsureeimportresult',
+            index=models.Index(fields=['batch_upload', 'line'], name='policyholde_BatchUp_3d3d8c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='policyholderinsureeimportresult',
+            index=models.Index(fields=['batch_upload', 'status', 'line'], name='policyholde_BatchUp_a5ecec_idx'),
+        ),
+        migrations.RemoveField(
+            model_name='policyholderinsureeimportresultchunk',
+            name='results',
+        ),
+        migrations.AlterField(
+            model_name='policyholderinsureebatchupload',
+            name='results',
+            field=models.JSONField(blank=True, db_column='Results', help_text='Row-specific results of batches imported before PolicyHolderInsureeImportResult, JSON array with ligne, nom, prenom, numero_camu, Etat, remarque', null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('policyholder', '0051_policyholderinsureeimportresult'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='policyholderinsureebatchupload',
+            name='report_file_path',
+            field=models.CharField(blank=True, db_column='ReportFilePath', help_text='Bucket key of the xlsx report rendered when the import finished', max_length=255, null=True),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.2.25 on 2026-10-18 21:05
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def mark_existing_batches_dispatched(apps, schema_editor):
+    # batches created before the scheduler were sent to the workers right away
+    PolicyHolderInsureeBatchUpload = apps.get_model('policyholder', 'PolicyHolderInsureeBatchUpload')
+    PolicyHolderInsureeBatchUpload.objects.filter(dispatched_at__isnull=True).update(dispatched_at=F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('policyholder', '0052_policyholderinsureebatchupload_report_file_path'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='policyholderinsureebatchupload',
+            name='lane',
+            field=models.CharField(choices=[('small', 'Small'), ('large', 'Large')], db_column='Lane', default='small', help_text='Priority lane of the import, from the size of the uploaded file', max_length=8),
+        ),
+        migrations.AddField(
+            model_name='policyholderinsureebatchupload',
+            name='dispatched_at',
+            field=models.DateTimeField(blank=True, db_column='DispatchedAt', help_text='When the import was sent to the workers, empty while it waits in the queue', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='policyholderinsureebatchupload',
+            index=models.Index(fields=['status', 'dispatched_at'], name='policyholde_Status_282535_idx'),
+        ),
+        migrations.RunPython(mark_existing_batches_dispatched, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 22:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('policyholder', '0053_insuree_import_scheduling'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='policyholderinsureebatchupload',
+            name='dry_run',
+            field=models.BooleanField(db_column='DryRun', default=False, help_text='Rows are only validated and reported, nothing is imported'),
+        ),
+    ]
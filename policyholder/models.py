@@ -3,7 +3,7 @@ import uuid
 import core
 from contribution_plan.models import ContributionPlanBundle
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
 from core import models as core_models, fields
 from graphql import ResolveInfo
 
@@ -94,6 +94,11 @@ class PolicyHolder(core_models.HistoryBusinessModel):
         db_table = "tblPolicyHolder"
 
 
+# fields of a PolicyHolderInsuree link refreshed by PolicyHolderInsureeManager.bulk_upsert()
+PHI_UPSERT_FIELDS = ("contribution_plan_bundle", "employer_number", "json_ext")
+PHI_BULK_BATCH_SIZE = 500
+
+
 class PolicyHolderInsureeManager(core_models.HistoryModelManager):
     def filter(self, *args, **kwargs):
         keys = [x for x in kwargs if "itemsvc" in x]
@@ -102,6 +107,88 @@ class PolicyHolderInsureeManager(core_models.HistoryModelManager):
             kwargs[new_key] = kwargs.pop(key)
         return super(PolicyHolderInsureeManager, self).filter(*args, **kwargs)
 
+    def bulk_upsert(self, links, username, update_fields=PHI_UPSERT_FIELDS, batch_size=PHI_BULK_BATCH_SIZE):
+        """
+        Create or update PolicyHolderInsuree links with bulk_create/bulk_update,
+        filling the HistoryBusinessModel audit fields (user_created/updated,
+        date_created/updated, date_valid_from, version) and the history rows
+        like save(username=...) does for a single link.
+
+        ``links`` are unsaved instances; when the insuree already has a live
+        link to the policy holder, that link takes their ``update_fields`` (and a
+        new version) if they differ. Returns [(link, created)] in the order of ``links``.
+        Only the insuree imports use it: no model signal or service hook runs,
+        so the mutations and the category change links keep going through
+        save(username=...).
+        """
+        from core import datetime
+        from simple_history.utils import bulk_create_with_history, bulk_update_with_history
+
+        links = list(links)
+        if not links:
+            return []
+
+        user = User.objects.get(username=username)
+        now = datetime.datetime.now()
+        attnames = [self.model._meta.get_field(name).attname for name in update_fields]
+
+        existing = {}
+        insuree_ids = sorted({link.insuree_id for link in links})
+        policy_holder_ids = sorted({link.policy_holder_id for link in links}, key=str)
+        for start in range(0, len(insuree_ids), batch_size):
+            for phi in self.filter(
+                insuree_id__in=insuree_ids[start:start + batch_size],
+                policy_holder_id__in=policy_holder_ids,
+                is_deleted=False,
+            ):
+                existing[(phi.insuree_id, phi.policy_holder_id)] = phi
+
+        results = []
+        to_create = {}
+        to_update = {}
+        for link in links:
+            key = (link.insuree_id, link.policy_holder_id)
+            current = to_create.get(key) or existing.get(key)
+            if current is None:
+                if link.id is None:
+                    link.id = uuid.uuid4()
+                link.user_created = user
+                link.user_updated = user
+                link.date_created = now
+                link.date_updated = now
+                link.date_valid_from = link.date_valid_from or now
+                link.version = 1
+                to_create[key] = link
+                results.append((link, True))
+                continue
+
+            if any(getattr(current, name) != getattr(link, name) for name in attnames):
+                for name in attnames:
+                    setattr(current, name, getattr(link, name))
+                if key not in to_create and key not in to_update:
+                    current.user_updated = user
+                    current.date_updated = now
+                    current.version = current.version + 1
+                    to_update[key] = current
+            results.append((current, False))
+
+        with transaction.atomic():
+            if to_create:
+                bulk_create_with_history(
+                    list(to_create.values()), self.model, batch_size=batch_size, default_user=user, default_date=now
+                )
+            if to_update:
+                bulk_update_with_history(
+                    list(to_update.values()),
+                    self.model,
+                    list(update_fields) + ["user_updated", "date_updated", "version"],
+                    batch_size=batch_size,
+                    default_user=user,
+                    default_date=now,
+                    manager=self,
+                )
+        return results
+
 
 class PolicyHolderInsuree(core_models.HistoryBusinessModel):
     policy_holder = models.ForeignKey(
@@ -387,9 +474,16 @@ class PolicyHolderUserPending(models.Model):
         db_table = "tblPolicyHolderUserPending"
 
 
+class PolicyHolderInsureeBatchUploadManager(models.Manager):
+    def get_queryset(self):
+        # results of batches imported before the result rows can weigh megabytes
+        return super().get_queryset().defer("results")
+
+
 class PolicyHolderInsureeBatchUpload(core_models.UUIDModel):
     """
     Model to track policyholder insuree import progress.
+    Row-level results are stored as PolicyHolderInsureeImportResult rows.
     """
     class Status(models.TextChoices):
         PENDING = "PENDING", "Pending"
@@ -397,6 +491,10 @@ class PolicyHolderInsureeBatchUpload(core_models.UUIDModel):
         COMPLETED = "COMPLETED", "Completed"
         FAILED = "FAILED", "Failed"
 
+    class Lane(models.TextChoices):
+        SMALL = "small", "Small"
+        LARGE = "large", "Large"
+
     policy_holder = models.ForeignKey(
         PolicyHolder,
         on_delete=models.CASCADE,
@@ -413,7 +511,8 @@ class PolicyHolderInsureeBatchUpload(core_models.UUIDModel):
         null=True,
         blank=True,
         db_column="Results",
-        help_text="Row-specific results stored as JSON array with ligne, nom, prenom, numero_camu, Etat, remarque",
+        help_text="Row-specific results of batches imported before PolicyHolderInsureeImportResult, "
+                  "JSON array with ligne, nom, prenom, numero_camu, Etat, remarque",
     )
 
     celery_task_id = models.CharField(
@@ -459,6 +558,50 @@ class PolicyHolderInsureeBatchUpload(core_models.UUIDModel):
         db_column="ErrorMessage",
         help_text="Error message if status is FAILED",
     )
+    stage_timings = models.JSONField(
+        null=True,
+        blank=True,
+        db_column="StageTimings",
+        help_text="Cumulative seconds, queries and calls per import stage (parse, validate, lookup...)",
+    )
+    uploaded_file = models.ForeignKey(
+        "PolicyHolderInsureeUploadedFile",
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        db_column="UploadedFileUUID",
+        help_text="Imported file, needed to resume the import",
+    )
+    resume_count = models.IntegerField(
+        default=0,
+        db_column="ResumeCount",
+        help_text="Number of times the import was resumed after an interruption",
+    )
+    report_file_path = models.CharField(
+        max_length=255,
+        null=True,
+        blank=True,
+        db_column="ReportFilePath",
+        help_text="Bucket key of the xlsx report rendered when the import finished",
+    )
+    lane = models.CharField(
+        max_length=8,
+        choices=Lane.choices,
+        default=Lane.SMALL,
+        db_column="Lane",
+        help_text="Priority lane of the import, from the size of the uploaded file",
+    )
+    dispatched_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        db_column="DispatchedAt",
+        help_text="When the import was sent to the workers, empty while it waits in the queue",
+    )
+    dry_run = models.BooleanField(
+        default=False,
+        db_column="DryRun",
+        help_text="Rows are only validated and reported, nothing is imported",
+    )
 
     created_by = models.ForeignKey(
         settings.AUTH_USER_MODEL,
@@ -469,6 +612,8 @@ class PolicyHolderInsureeBatchUpload(core_models.UUIDModel):
     created_at = models.DateTimeField(auto_now_add=True, db_column="CreatedAt")
     updated_at = models.DateTimeField(auto_now=True, db_column="UpdatedAt")
 
+    objects = PolicyHolderInsureeBatchUploadManager()
+
     class Meta:
         managed = True
         db_table = "policyholder_PolicyHolderInsureeBatchUpload"
@@ -477,6 +622,7 @@ class PolicyHolderInsureeBatchUpload(core_models.UUIDModel):
             models.Index(fields=["celery_task_id"]),
             models.Index(fields=["policy_holder", "created_at"]),
             models.Index(fields=["status", "created_at"]),
+            models.Index(fields=["status", "dispatched_at"]),
         ]
 
     def __str__(self):
@@ -515,22 +661,46 @@ class PolicyHolderInsureeBatchUpload(core_models.UUIDModel):
         self.started_at = timezone.now()
         self.save(update_fields=["status", "total_rows", "started_at", "updated_at"])
 
-    def update_progress(self, processed_rows, success_count=None, error_count=None):
+    def update_progress(self, processed_rows, success_count=None, error_count=None, stage_timings=None):
         """Update progress counters"""
         self.processed_rows = processed_rows
         if success_count is not None:
             self.success_count = success_count
         if error_count is not None:
             self.error_count = error_count
-        self.save(
-            update_fields=[
-                "processed_rows",
-                "success_count",
-                "error_count",
-                "updated_at",
-            ]
+        update_fields = ["processed_rows", "success_count", "error_count", "updated_at"]
+        if stage_timings is not None:
+            self.stage_timings = stage_timings
+            update_fields.append("stage_timings")
+        self.save(update_fields=update_fields)
+
+    def increment_progress(self, processed_rows=0, success_count=0, error_count=0):
+        """Atomically add to the progress counters, used by import chunks running in parallel"""
+        from django.db.models import F
+        from django.utils import timezone
+
+        PolicyHolderInsureeBatchUpload.objects.filter(id=self.id).update(
+            processed_rows=F("processed_rows") + processed_rows,
+            success_count=F("success_count") + success_count,
+            error_count=F("error_count") + error_count,
+            updated_at=timezone.now(),
         )
 
+    def mark_as_resumed(self, total_rows):
+        """Mark an interrupted batch as processing again, its counters are kept"""
+        from django.utils import timezone
+
+        self.status = self.Status.PROCESSING
+        self.total_rows = total_rows
+        self.resume_count += 1
+        self.completed_at = None
+        self.error_message = None
+        if not self.started_at:
+            self.started_at = timezone.now()
+        self.save(update_fields=[
+            "status", "total_rows", "resume_count", "completed_at", "error_message", "started_at", "updated_at"
+        ])
+
     def mark_as_completed(self):
         """Mark batch as completed"""
         from django.utils import timezone
@@ -551,6 +721,129 @@ class PolicyHolderInsureeBatchUpload(core_models.UUIDModel):
         )
 
 
+class PolicyHolderInsureeImportResultChunk(core_models.UUIDModel):
+    """
+    Checkpoint of an import: rows [start_row, end_row) of the sheet and their
+    counters, written with their results in the transaction that saved their
+    PolicyHolderInsuree links. An interrupted import resumes with the rows not
+    covered by any chunk.
+    """
+    batch_upload = models.ForeignKey(
+        PolicyHolderInsureeBatchUpload,
+        on_delete=models.CASCADE,
+        db_column="BatchUploadUUID",
+        related_name="result_chunks",
+    )
+    start_row = models.IntegerField(db_column="StartRow")
+    end_row = models.IntegerField(db_column="EndRow")
+    success_count = models.IntegerField(default=0, db_column="SuccessCount")
+    error_count = models.IntegerField(default=0, db_column="ErrorCount")
+    created_at = models.DateTimeField(auto_now_add=True, db_column="CreatedAt")
+
+    class Meta:
+        managed = True
+        db_table = "policyholder_PolicyHolderInsureeImportResultChunk"
+        indexes = [
+            models.Index(fields=["batch_upload", "start_row"]),
+        ]
+
+    def __str__(self):
+        return f"PolicyHolderInsureeImportResultChunk-{self.batch_upload_id} [{self.start_row}, {self.end_row})"
+
+
+class PolicyHolderInsureeImportResult(core_models.UUIDModel):
+    """
+    Result of one row of an import, the ``ligne``, ``numero_camu``, ``nom``,
+    ``prenom``, ``Etat`` and ``remarque`` columns of the import report.
+    """
+    class Status(models.TextChoices):
+        OK = "OK", "OK"
+        KO = "KO", "KO"
+
+    batch_upload = models.ForeignKey(
+        PolicyHolderInsureeBatchUpload,
+        on_delete=models.CASCADE,
+        db_column="BatchUploadUUID",
+        related_name="result_rows",
+    )
+    line = models.IntegerField(db_column="Line")
+    chf_id = models.CharField(max_length=255, blank=True, default="", db_column="NumeroCamu")
+    last_name = models.CharField(max_length=255, blank=True, default="", db_column="Nom")
+    other_names = models.CharField(max_length=255, blank=True, default="", db_column="Prenom")
+    status = models.CharField(max_length=2, choices=Status.choices, db_column="Etat")
+    remark = models.TextField(blank=True, default="", db_column="Remarque")
+
+    class Meta:
+        managed = True
+        db_table = "policyholder_PolicyHolderInsureeImportResult"
+        indexes = [
+            models.Index(fields=["batch_upload", "line"]),
+            models.Index(fields=["batch_upload", "status", "line"]),
+        ]
+
+    def __str__(self):
+        return f"PolicyHolderInsureeImportResult-{self.batch_upload_id} {self.line} ({self.status})"
+
+    @classmethod
+    def from_entry(cls, batch_upload, entry):
+        """Row built from a build_result_entry() dict."""
+        def text(value, max_length=None):
+            value = "" if value is None else str(value)
+            return value[:max_length] if max_length else value
+
+        return cls(
+            batch_upload=batch_upload,
+            line=entry["ligne"],
+            chf_id=text(entry.get("numero_camu"), 255),
+            last_name=text(entry.get("nom"), 255),
+            other_names=text(entry.get("prenom"), 255),
+            status=entry["Etat"],
+            remark=text(entry.get("remarque")),
+        )
+
+    def to_entry(self):
+        return {
+            "ligne": self.line,
+            "numero_camu": self.chf_id,
+            "nom": self.last_name,
+            "prenom": self.other_names,
+            "Etat": self.status,
+            "remarque": self.remark,
+        }
+
+
+class PolicyHolderInsureeImportFingerprint(core_models.UUIDModel):
+    """
+    Fingerprint of the last successfully imported row of an insuree for a
+    policyholder, see import_fingerprint. ``row_key`` identifies the row by its
+    CAMU numbers, or by name and date of birth when it has none.
+    """
+    policy_holder = models.ForeignKey(
+        PolicyHolder,
+        on_delete=models.deletion.CASCADE,
+        db_column="PolicyHolderUUID",
+        related_name="insuree_import_fingerprints",
+    )
+    row_key = models.CharField(max_length=255, db_column="RowKey")
+    fingerprint = models.CharField(max_length=64, db_column="Fingerprint")
+    insuree = models.ForeignKey(
+        Insuree,
+        on_delete=models.deletion.DO_NOTHING,
+        db_column="InsureeID",
+        null=True,
+        blank=True,
+    )
+    updated_at = models.DateTimeField(auto_now=True, db_column="UpdatedAt")
+
+    class Meta:
+        managed = True
+        db_table = "policyholder_PolicyHolderInsureeImportFingerprint"
+        unique_together = ("policy_holder", "row_key")
+
+    def __str__(self):
+        return f"PolicyHolderInsureeImportFingerprint-{self.policy_holder_id} {self.row_key}"
+
+
 class PolicyHolderInsureeUploadedFile(core_models.UUIDModel):
     """
     Model to track uploaded files for policyholder insuree imports.
@@ -562,7 +855,7 @@ class PolicyHolderInsureeUploadedFile(core_models.UUIDModel):
         db_column="PolicyHolderUUID",
         related_name="insuree_uploaded_files",
     )
-    file_name_hash = models.CharField(max_length=255, db_column="FileNameHash")
+    file_name_hash = models.CharField(max_length=255, db_column="FileNameHash", db_index=True)
     file_path = models.CharField(
         max_length=255, db_column="FilePath", null=True, blank=True
     )
@@ -573,3 +866,93 @@ class PolicyHolderInsureeUploadedFile(core_models.UUIDModel):
 
     def __str__(self):
         return f"PolicyHolderInsureeUploadedFile-{self.id}"
+
+
+class PolicyHolderInsureeImportOutbox(core_models.UUIDModel):
+    """
+    Side effects of an insuree import (notifications, emails, DMS folders,
+    workflow, ABIS) written in the same transaction as the insuree and
+    PolicyHolderInsuree rows, and delivered later by the outbox workers.
+    """
+    class Target(models.TextChoices):
+        NOTIFICATION = "NOTIFICATION", "CAMU notification"
+        EMAIL = "EMAIL", "Email"
+        DMS_FOLDER = "DMS_FOLDER", "DMS folder"
+        WORKFLOW = "WORKFLOW", "Workflow"
+        ABIS = "ABIS", "ABIS"
+
+    class Status(models.TextChoices):
+        PENDING = "PENDING", "Pending"
+        PROCESSING = "PROCESSING", "Processing"
+        DONE = "DONE", "Done"
+        FAILED = "FAILED", "Failed"
+
+    target = models.CharField(max_length=20, choices=Target.choices, db_column="Target")
+    status = models.CharField(
+        max_length=20,
+        choices=Status.choices,
+        default=Status.PENDING,
+        db_column="Status",
+    )
+    insuree = models.ForeignKey(
+        Insuree,
+        on_delete=models.deletion.DO_NOTHING,
+        db_column="InsureeID",
+        null=True,
+        blank=True,
+    )
+    policy_holder_insuree = models.ForeignKey(
+        PolicyHolderInsuree,
+        on_delete=models.deletion.DO_NOTHING,
+        db_column="PolicyHolderInsureeID",
+        null=True,
+        blank=True,
+    )
+    payload = models.JSONField(null=True, blank=True, db_column="Payload")
+    attempts = models.IntegerField(default=0, db_column="Attempts")
+    last_error = models.TextField(null=True, blank=True, db_column="LastError")
+    available_at = models.DateTimeField(
+        db_column="AvailableAt", help_text="Not delivered before this time (retry backoff)"
+    )
+
+    created_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.SET_NULL,
+        null=True,
+        db_column="CreatedBy",
+    )
+    created_at = models.DateTimeField(auto_now_add=True, db_column="CreatedAt")
+    updated_at = models.DateTimeField(auto_now=True, db_column="UpdatedAt")
+
+    class Meta:
+        managed = True
+        db_table = "policyholder_PolicyHolderInsureeImportOutbox"
+        indexes = [
+            models.Index(fields=["target", "status", "available_at"]),
+        ]
+
+    def __str__(self):
+        return f"PolicyHolderInsureeImportOutbox-{self.id} ({self.target}, {self.status})"
+
+
+class PolicyHolderInsureeChfIdReservation(models.Model):
+    """
+    High-water mark of the temporary CAMU numbers (chf_id) reserved in blocks
+    by bulk enrolment, one row per (region code, enrolment category).
+    Rows are locked with select_for_update while a block is taken.
+    """
+    id = models.AutoField(primary_key=True, db_column="ReservationID")
+    region_code = models.CharField(max_length=50, db_column="RegionCode")
+    enrolment_category = models.CharField(max_length=50, db_column="EnrolmentCategory")
+    prefix = models.CharField(max_length=50, db_column="Prefix")
+    counter_width = models.IntegerField(db_column="CounterWidth")
+    next_value = models.BigIntegerField(db_column="NextValue")
+    updated_at = models.DateTimeField(auto_now=True, db_column="UpdatedAt")
+
+    class Meta:
+        managed = True
+        db_table = "policyholder_PolicyHolderInsureeChfIdReservation"
+        unique_together = (("region_code", "enrolment_category"),)
+
+    def __str__(self):
+        return f"{self.region_code}/{self.enrolment_category}: {self.prefix}{self.next_value}"
@@ -1,57 +1,66 @@
-from celery import shared_task
+from celery import chord, shared_task
 import logging
-import os
+import math
 import hashlib
-import pandas as pd
-from datetime import datetime, timedelta
-from django.conf import settings
+import uuid
+from datetime import timedelta
+from django.db import transaction
 from django.utils import timezone
 
 from core.models import User
-from core.constants import INS_ADDED_NT
-from core.notification_service import create_camu_notification
 
+from policyholder.apps import PolicyholderConfig
 from policyholder.models import (
     PolicyHolder,
     PolicyHolderContributionPlan,
-    PolicyHolderInsuree,
     PolicyHolderInsureeBatchUpload,
     PolicyHolderInsureeUploadedFile,
 )
 from policyholder.erp_intigration import erp_create_update_policyholder
+from policyholder.import_outbox import (
+    clear_outbox_retry,
+    drain_outbox_target,
+    get_next_outbox_retry,
+    get_outbox_concurrency,
+    get_pending_outbox_targets,
+    release_stale_outbox_entries,
+    schedule_outbox_retry,
+)
+from policyholder.import_engine import get_import_contribution_plan_bundle, process_insuree_import_rows
+from policyholder.import_checkpoint import (
+    ImportCheckpointer,
+    get_checkpointed_counters,
+    get_pending_row_ranges,
+)
+from policyholder.import_report import store_import_report
+from policyholder.import_handoff import (
+    get_chunk_file_handoff,
+    open_import_file,
+    release_import_file_handoff,
+    remove_stale_handoff_files,
+)
+from policyholder.import_scheduler import (
+    claim_schedulable_imports,
+    get_import_queue_options,
+    release_lost_dispatches,
+)
+from policyholder.import_timing import ImportStageTimer, merge_stage_timings
+from policyholder.import_progress import (
+    ImportProgressReporter,
+    set_cached_final_progress,
+    set_cached_progress_counters,
+    set_cached_progress_info,
+)
 from policyholder.utils import Utils
-from policyholder.dms_utils import validate_enrolment_type
 
 # --- IMPORT SHARED UTILS (Breaks Circular Dependency) ---
 from policyholder.import_utils import (
     get_policy_holder_from_code,
-    get_or_create_insuree_from_line,
-    soft_delete_insuree,
-    get_village_from_line,
-    get_or_create_family_from_line,
-    validating_insuree_on_name_dob,
-    check_for_category_change_request,
-    clean_line,
-    HEADER_INSUREE_ID,
-    HEADER_INSUREE_CAMU_NO,
-    HEADER_INSUREE_DOB,
-    HEADER_DELETE,
-    HEADER_FAMILY_LOCATION_CODE,
-    HEADER_INSUREE_OTHER_NAMES,
-    HEADER_INSUREE_LAST_NAME,
-    HEADER_BIRTH_LOCATION_CODE,
-    HEADER_INSUREE_GENDER,
-    HEADER_CIVILITY,
-    HEADER_PHONE,
-    HEADER_ADDRESS,
-    HEADER_EMAIL,
-    MINIMUM_AGE_LIMIT,
-    MINIMUM_AGE_LIMIT_FOR_STUDENTS,
+    count_import_rows,
+    iter_import_rows,
+    row_ranges_share_insurees,
 )
 
-from insuree.dms_utils import send_mail_to_temp_insuree_with_pdf
-from rest_api.lib.file_bucket import download_file_from_s3_bucket
-
 logger = logging.getLogger(__name__)
 
 
@@ -81,67 +90,141 @@ def sync_policyholders_to_erp():
     logger.info("Sync process completed.")
 
 
-def build_result_entry(line, index, chf_id, status, nom="", prenom=""):
+def dispatch_import_outbox_on_commit():
+    """Start delivering the queued side effects once the current transaction commits."""
+    if PolicyholderConfig.insuree_import_outbox_enabled:
+        transaction.on_commit(lambda: dispatch_import_outbox.delay())
+
+
+def schedule_insuree_imports(file_handoffs=None):
     """
-    Build a result entry in the format: ligne, numero_camu, nom, prenom, Etat, remarque
+    Send the queued imports whose turn came to the workers, see import_scheduler.
+    ``file_handoffs`` maps batch ids to the file handoff of their upload.
+    Returns the ids of the dispatched batches.
     """
-    etat = "OK" if status in ["Succès", "Aucun changement"] else "KO"
-    remarque = "-" if status == "Succès" else status
-
-    if chf_id and pd.notna(chf_id):
-        chf_id_str = str(chf_id)
-        # Clean up float-like strings (e.g. "12345.0" -> "12345")
-        if '.' in chf_id_str and chf_id_str.replace('.', '', 1).replace('-', '', 1).isdigit():
-            try:
-                chf_id_str = str(int(float(chf_id_str)))
-            except (ValueError, OverflowError):
-                pass
-        numero_camu = chf_id_str
-    else:
-        numero_camu = ""
+    file_handoffs = file_handoffs or {}
+    dispatched = []
+    for batch_upload in claim_schedulable_imports():
+        batch_upload_id = str(batch_upload.id)
+        try:
+            import_policyholder_insurees_async.apply_async(
+                kwargs={
+                    "user_id": batch_upload.created_by_id,
+                    "policyholder_code": batch_upload.policy_holder.code,
+                    "batch_upload_id": batch_upload_id,
+                    "uploaded_file_record_id": str(batch_upload.uploaded_file_id),
+                    "file_handoff": file_handoffs.get(batch_upload_id),
+                },
+                task_id=batch_upload.celery_task_id,
+                **get_import_queue_options(batch_upload),
+            )
+        except Exception as e:
+            # back in the queue, the next scheduling retries it
+            logger.error(f"Failed to dispatch policyholder insuree import {batch_upload_id}: {e}", exc_info=True)
+            PolicyHolderInsureeBatchUpload.objects.filter(id=batch_upload.id).update(dispatched_at=None)
+            continue
+        dispatched.append(batch_upload_id)
+    return dispatched
+
+
+def schedule_insuree_imports_on_commit():
+    """Start the next queued imports once the current transaction commits."""
+    transaction.on_commit(schedule_insuree_imports)
+
+
+def split_import_row_ranges(total_rows, chunk_size, max_parallel_chunks):
+    """
+    Split ``total_rows`` into contiguous (start, end) row ranges.
+    Chunks hold at least ``chunk_size`` rows and there are never more than
+    ``max_parallel_chunks`` of them, a single range means serial processing.
+    """
+    if total_rows <= 0:
+        return []
+    if not chunk_size or chunk_size <= 0 or max_parallel_chunks <= 1:
+        return [(0, total_rows)]
+
+    chunk_count = min(max_parallel_chunks, math.ceil(total_rows / chunk_size))
+    rows_per_chunk = math.ceil(total_rows / chunk_count)
+    return [
+        (start, min(start + rows_per_chunk, total_rows))
+        for start in range(0, total_rows, rows_per_chunk)
+    ]
+
+
+def split_pending_row_ranges(pending_ranges, chunk_size, max_parallel_chunks):
+    """
+    split_import_row_ranges() over the rows of ``pending_ranges``, the ranges
+    left to process when an import is resumed.
+    """
+    total_rows = sum(end - start for start, end in pending_ranges)
+    row_ranges = []
+    for start, end in pending_ranges:
+        # each pending range gets its share of the parallel chunks
+        share = max(1, round(max_parallel_chunks * (end - start) / total_rows)) if total_rows else 1
+        row_ranges.extend(
+            (start + chunk_start, start + chunk_end)
+            for chunk_start, chunk_end in split_import_row_ranges(end - start, chunk_size, share)
+        )
+    return row_ranges
+
+
+def complete_insuree_import(batch_upload, stage_timings=None):
+    """
+    Set the counters of an import from its checkpoints and mark it completed.
+    The checkpoints are removed, the result rows stay.
+    """
+    processed_rows, success_count, error_count = get_checkpointed_counters(batch_upload)
+    batch_upload.processed_rows = processed_rows
+    batch_upload.success_count = success_count
+    batch_upload.error_count = error_count
+    if stage_timings is not None:
+        batch_upload.stage_timings = stage_timings
+    # the report is ready before the batch shows as completed
+    store_import_report(batch_upload)
+    with transaction.atomic():
+        batch_upload.save(update_fields=[
+            "processed_rows", "success_count", "error_count", "stage_timings", "updated_at"
+        ])
+        batch_upload.mark_as_completed()
+        batch_upload.result_chunks.all().delete()
+    set_cached_final_progress(batch_upload)
+    dispatch_import_outbox_on_commit()
+    schedule_insuree_imports_on_commit()
+    return success_count, error_count
 
-    return {
-        "ligne": index + 1,
-        "numero_camu": numero_camu,
-        "nom": nom,
-        "prenom": prenom,
-        "Etat": etat,
-        "remarque": remarque,
-    }
 
 @shared_task(bind=True)
 def import_policyholder_insurees_async(
-    self, user_id, policyholder_code, batch_upload_id, uploaded_file_record_id
+    self, user_id, policyholder_code, batch_upload_id, uploaded_file_record_id, resume=False,
+    file_handoff=None,
 ):
     """
     Asynchronous task to import policyholder insurees from Excel file.
+    Large sheets are split into row ranges processed in parallel as a Celery
+    chord (see insuree_import_chunk_size / insuree_import_max_parallel_chunks).
+    Results are checkpointed along the way, with ``resume`` only the rows of an
+    interrupted run that no checkpoint covers are processed.
+    ``file_handoff`` (see import_handoff) hands the file over without the
+    storage round trip.
     """
     batch_upload = None
-    results_data = []
     total_rows = 0
+    split = False
 
     try:
         batch_upload = PolicyHolderInsureeBatchUpload.objects.get(id=batch_upload_id)
+        if not resume and batch_upload.status != PolicyHolderInsureeBatchUpload.Status.PENDING:
+            # dispatched again by requeue_stale_insuree_imports, the first message arrived after all
+            logger.warning(f"Policyholder insuree import {batch_upload_id} already started, message ignored")
+            return {"success": False, "skipped": True}
         user = User.objects.get(id=user_id)
         policyholder = get_policy_holder_from_code(policyholder_code)
-        core_username = user.username
-        user_id_for_audit = user.id_for_audit
 
         if not policyholder:
             raise Exception("Policy holder not found")
 
-        # Get contribution plan bundle
-        ph_cpb = PolicyHolderContributionPlan.objects.filter(
-            policy_holder=policyholder, is_deleted=False
-        ).first()
+        cpb = get_import_contribution_plan_bundle(policyholder)
 
-        if not ph_cpb:
-            raise Exception("No contribution plan bundle found for policyholder")
-
-        cpb = ph_cpb.contribution_plan_bundle
-        enrolment_type = cpb.name if cpb else None
-
-        # Download file from S3
         uploaded_file_record = PolicyHolderInsureeUploadedFile.objects.filter(
             id=uploaded_file_record_id
         ).first()
@@ -149,299 +232,350 @@ def import_policyholder_insurees_async(
         if not uploaded_file_record:
             raise Exception("Uploaded file record not found")
 
-        if not uploaded_file_record.file_path:
-            raise Exception("Uploaded file record has no file path")
-
-        # Use MEDIA_ROOT if available, otherwise use temp directory
-        base_path = settings.MEDIA_ROOT
-        if not base_path:
-            import tempfile
-            base_path = tempfile.gettempdir()
-
-        # Ensure the directory exists
-        download_dir = os.path.join(base_path, "policyholder", "insuree_import")
-        os.makedirs(download_dir, exist_ok=True)
+        # files are stored by content, identical uploads share the same name
+        with open_import_file(
+            uploaded_file_record, file_handoff, download_prefix=f"{batch_upload_id}_"
+        ) as import_file:
+            # Set total number of rows for progress tracking
+            timer = ImportStageTimer()
+            with timer.stage("parse"):
+                total_rows = count_import_rows(import_file)
+            if resume:
+                batch_upload.mark_as_resumed(total_rows)
+                pending_ranges = get_pending_row_ranges(batch_upload, total_rows)
+                processed_rows, success_count, error_count = get_checkpointed_counters(batch_upload)
+                batch_upload.update_progress(processed_rows, success_count, error_count)
+                set_cached_progress_counters(self.request.id, processed_rows, success_count, error_count)
+                logger.info(
+                    f"Resuming policyholder insuree import: batch_upload_id={batch_upload_id}, "
+                    f"{processed_rows} rows already done, pending {pending_ranges}"
+                )
+            else:
+                batch_upload.mark_as_processing(total_rows)
+                pending_ranges = [(0, total_rows)] if total_rows else []
+            set_cached_progress_info(
+                self.request.id,
+                status=batch_upload.status,
+                total=total_rows,
+                policyholder_code=policyholder_code,
+                created_at=batch_upload.created_at.isoformat(),
+                started_at=batch_upload.started_at.isoformat(),
+            )
 
-        download_path = os.path.join(
-            download_dir,
-            os.path.basename(uploaded_file_record.file_path),
-        )
+            row_ranges = split_pending_row_ranges(
+                pending_ranges,
+                PolicyholderConfig.insuree_import_chunk_size,
+                PolicyholderConfig.insuree_import_max_parallel_chunks,
+            )
+            parallel = len(row_ranges) > 1
+            if parallel:
+                with timer.stage("parse"):
+                    shared = row_ranges_share_insurees(import_file, row_ranges)
+                if shared:
+                    # only rows processed in order see their duplicates
+                    logger.info(
+                        f"Rows of different chunks refer to the same insurees, importing serially: "
+                        f"batch_upload_id={batch_upload_id}"
+                    )
+                    parallel = False
+                    row_ranges = list(pending_ranges)
+            if resume:
+                stage_timings = merge_stage_timings(batch_upload.stage_timings, timer.as_dict())
+            else:
+                stage_timings = timer.as_dict()
+
+            if parallel:
+                # the chunks add their own stage timings to these
+                batch_upload.stage_timings = stage_timings
+                batch_upload.save(update_fields=["stage_timings", "updated_at"])
+                chunk_file_handoff = get_chunk_file_handoff(file_handoff)
+                queue_options = get_import_queue_options(batch_upload)
+                chord([
+                    import_policyholder_insurees_chunk.s(
+                        user_id, policyholder_code, batch_upload_id, uploaded_file_record_id, start, end,
+                        parent_task_id=self.request.id,
+                        file_handoff=chunk_file_handoff,
+                    ).set(**queue_options)
+                    for start, end in row_ranges
+                ])(
+                    merge_policyholder_insuree_import_chunks.s(
+                        batch_upload_id, file_handoff=chunk_file_handoff
+                    ).set(**queue_options)
+                )
+                # the merge callback releases the shared file
+                split = True
+                logger.info(
+                    f"Policyholder insuree import split in {len(row_ranges)} chunks: batch_upload_id={batch_upload_id}"
+                )
+                return {
+                    "success": True,
+                    "total_rows": total_rows,
+                    "chunks": len(row_ranges),
+                }
+
+            with timer:
+                for start, end in row_ranges:
+                    # a resumed run adds to the checkpointed counters
+                    reporter = ImportProgressReporter(
+                        batch_upload, task_id=self.request.id, incremental=resume, timer=timer
+                    )
+                    try:
+                        process_insuree_import_rows(
+                            iter_import_rows(import_file, start=start, end=end),
+                            user,
+                            policyholder,
+                            cpb,
+                            progress_callback=reporter,
+                            timer=timer,
+                            sink=ImportCheckpointer(batch_upload, start),
+                            dry_run=batch_upload.dry_run,
+                        )
+                    finally:
+                        reporter.flush()
 
-        file_path = download_file_from_s3_bucket(
-            object_key=f"policyholder/{uploaded_file_record.file_path}",
-            download_path=download_path,
+        success_count, error_count = complete_insuree_import(
+            batch_upload, merge_stage_timings(stage_timings, timer.as_dict())
         )
 
-        if not file_path or not os.path.exists(file_path):
-            # Fallback: sometimes bucket function returns None but downloads
-            if not os.path.exists(download_path):
-                raise Exception("Failed to download file from S3 bucket")
-            file_path = download_path
-
-        # Read Excel file
-        df = pd.read_excel(file_path)
-        df.columns = [col.strip() for col in df.columns]
-
-        # Rename columns using constants from import_utils
-        rename_columns = {
-            "Numéro CAMU": HEADER_INSUREE_CAMU_NO,
-            "Prénom": HEADER_INSUREE_OTHER_NAMES,
-            "Nom": HEADER_INSUREE_LAST_NAME,
-            "Numéro CAMU temporaire": HEADER_INSUREE_ID,
-            "Date de naissance": HEADER_INSUREE_DOB,
-            "Lieu de naissance": HEADER_BIRTH_LOCATION_CODE,
-            "Sexe": HEADER_INSUREE_GENDER,
-            "Civilité": HEADER_CIVILITY,
-            "Téléphone": HEADER_PHONE,
-            "Adresse": HEADER_ADDRESS,
-            "Village": HEADER_FAMILY_LOCATION_CODE,
-            "Email": HEADER_EMAIL,
-            "Supprimé": HEADER_DELETE,
+        return {
+            "success": True,
+            "total_rows": total_rows,
+            "success_count": success_count,
+            "error_count": error_count,
         }
 
-        df.rename(columns=rename_columns, inplace=True)
-
-        # Set total number of rows for progress tracking
-        total_rows = len(df)
-        batch_upload.mark_as_processing(total_rows)
-
-        # Initialize counters
-        success_count = 0
-        error_count = 0
-
-        # Process each row
-        for index, row in df.iterrows():
-            try:
-                clean_line(row)
-
-                current_minimum_age = MINIMUM_AGE_LIMIT
-                if cpb.code == "PSC05" or enrolment_type == "Etudiants":
-                    current_minimum_age = MINIMUM_AGE_LIMIT_FOR_STUDENTS
-
-                if not row.get(HEADER_INSUREE_ID) and not row.get(HEADER_INSUREE_CAMU_NO):
-                    dob_value = row.get(HEADER_INSUREE_DOB)
-                    if dob_value:
-                        date_formats = ["%Y-%m-%d", "%m/%d/%Y", "%d/%m/%Y"]
-                        dob = None
-                        
-                        if isinstance(dob_value, datetime):
-                            dob = dob_value
-                        else:
-                            for date_format in date_formats:
-                                try:
-                                    dob = datetime.strptime(str(dob_value), date_format)
-                                    break
-                                except (ValueError, TypeError):
-                                    continue
-                        
-                        if dob is None:
-                            error = f"Format de date invalide: {dob_value}"
-                            chf_id = row.get(HEADER_INSUREE_ID) or row.get(HEADER_INSUREE_CAMU_NO) or ""
-                            nom = row.get(HEADER_INSUREE_LAST_NAME, "")
-                            prenom = row.get(HEADER_INSUREE_OTHER_NAMES, "")
-                            results_data.append(
-                                build_result_entry(row, index, chf_id, error, nom, prenom)
-                            )
-                            error_count += 1
-                            continue
-                        
-                        age = (datetime.now().date() - dob.date()) // timedelta(days=365.25)
-                        if age < current_minimum_age:
-                            error = f"L'assuré doit être âgé d'au moins {current_minimum_age} ans."
-                            chf_id = row.get(HEADER_INSUREE_ID) or row.get(HEADER_INSUREE_CAMU_NO) or ""
-                            nom = row.get(HEADER_INSUREE_LAST_NAME, "")
-                            prenom = row.get(HEADER_INSUREE_OTHER_NAMES, "")
-                            results_data.append(
-                                build_result_entry(row, index, chf_id, error, nom, prenom)
-                            )
-                            error_count += 1
-                            continue
-                    
-                    existing_insuree = validating_insuree_on_name_dob(row, policyholder)
-                    if existing_insuree:
-                        error = "Un assuré ayant le même nom et la même date de naissance existe déjà, veuillez ajouter son numéro CAMU ou numéro temporaire."
-                        chf_id = row.get(HEADER_INSUREE_ID) or row.get(HEADER_INSUREE_CAMU_NO) or ""
-                        nom = row.get(HEADER_INSUREE_LAST_NAME, "")
-                        prenom = row.get(HEADER_INSUREE_OTHER_NAMES, "")
-                        results_data.append(
-                            build_result_entry(row, index, chf_id, error, nom, prenom)
-                        )
-                        error_count += 1
-                        continue
-
-                if row.get(HEADER_DELETE) and str(row.get(HEADER_DELETE)).lower() in ["true", "1", "oui", "yes"]:
-                    deleted = soft_delete_insuree(row, policyholder.code, user_id_for_audit)
-                    chf_id = row.get(HEADER_INSUREE_ID) or row.get(HEADER_INSUREE_CAMU_NO) or ""
-                    nom = row.get(HEADER_INSUREE_LAST_NAME, "")
-                    prenom = row.get(HEADER_INSUREE_OTHER_NAMES, "")
-                    if deleted:
-                        results_data.append(
-                            build_result_entry(row, index, chf_id, "Supprimé avec succès", nom, prenom)
-                        )
-                        success_count += 1
-                    else:
-                        results_data.append(
-                            build_result_entry(row, index, chf_id, "Erreur: Assuré non trouvé", nom, prenom)
-                        )
-                        error_count += 1
-                    continue
-
-                village = get_village_from_line(row)
-                if not village:
-                    error = f"Village inconnu - {row.get(HEADER_FAMILY_LOCATION_CODE, '')}"
-                    chf_id = row.get(HEADER_INSUREE_ID) or row.get(HEADER_INSUREE_CAMU_NO) or ""
-                    nom = row.get(HEADER_INSUREE_LAST_NAME, "")
-                    prenom = row.get(HEADER_INSUREE_OTHER_NAMES, "")
-                    results_data.append(
-                        build_result_entry(row, index, chf_id, error, nom, prenom)
-                    )
-                    error_count += 1
-                    continue
-
-                is_valid_enrolment = validate_enrolment_type(row, enrolment_type)
-                if not is_valid_enrolment:
-                    error = "Le type d'enrôlement doit être différent de 'étudiant."
-                    chf_id = row.get(HEADER_INSUREE_ID) or row.get(HEADER_INSUREE_CAMU_NO) or ""
-                    nom = row.get(HEADER_INSUREE_LAST_NAME, "")
-                    prenom = row.get(HEADER_INSUREE_OTHER_NAMES, "")
-                    results_data.append(
-                        build_result_entry(row, index, chf_id, error, nom, prenom)
-                    )
-                    error_count += 1
-                    continue
-
-                # CRITICAL: Pass 'user' object to utility function
-                insuree, error = get_or_create_insuree_from_line(
-                    row,
-                    village,
-                    user_id_for_audit,
-                    user, # Pass the User object
-                    user.id,
-                    enrolment_type,
-                )
+    except Exception as e:
+        logger.error(f"Fatal error in import_policyholder_insurees_async: {str(e)}", exc_info=True)
 
-                if error:
-                    chf_id = row.get(HEADER_INSUREE_ID) or row.get(HEADER_INSUREE_CAMU_NO) or ""
-                    nom = row.get(HEADER_INSUREE_LAST_NAME, "")
-                    prenom = row.get(HEADER_INSUREE_OTHER_NAMES, "")
-                    results_data.append(
-                        build_result_entry(row, index, chf_id, error, nom, prenom)
-                    )
-                    error_count += 1
-                    continue
+        if batch_upload:
+            batch_upload.mark_as_failed(str(e))
+            set_cached_final_progress(batch_upload, task_id=self.request.id)
+            schedule_insuree_imports_on_commit()
+        raise
 
-                family, family_created = get_or_create_family_from_line(
-                    row, user_id_for_audit, enrolment_type, insuree, village
-                )
+    finally:
+        if not split:
+            release_import_file_handoff(file_handoff)
 
-                if not family:
-                    error = "Impossible de créer ou de trouver la famille."
-                    chf_id = row.get(HEADER_INSUREE_ID) or row.get(HEADER_INSUREE_CAMU_NO) or ""
-                    nom = row.get(HEADER_INSUREE_LAST_NAME, "")
-                    prenom = row.get(HEADER_INSUREE_OTHER_NAMES, "")
-                    results_data.append(
-                        build_result_entry(row, index, chf_id, error, nom, prenom)
-                    )
-                    error_count += 1
-                    continue
-
-                # Category Change Request
-                try:
-                    check_for_category_change_request(user, row, policyholder, enrolment_type)
-                except Exception as e:
-                    logger.warning(f"Error in check_for_category_change_request: {e}")
-
-                phi_json_ext = {}
-                employer_number = None
-
-                phi = PolicyHolderInsuree.objects.filter(
-                    insuree=insuree, policy_holder=policyholder
-                ).first()
-
-                if phi:
-                    phi._state.adding = True
-                    if (
-                        phi.contribution_plan_bundle != cpb
-                        or phi.employer_number != employer_number
-                        or phi.json_ext != phi_json_ext
-                    ):
-                        phi.contribution_plan_bundle = cpb
-                        phi.employer_number = employer_number
-                        phi.json_ext = phi_json_ext
-                        phi.save(username=core_username)
-                else:
-                    # Create new record
-                    phi = PolicyHolderInsuree(
-                        insuree=insuree,
-                        policy_holder=policyholder,
-                        contribution_plan_bundle=cpb,
-                        json_ext=phi_json_ext,
-                        employer_number=employer_number,
-                    )
-                    phi.save(username=core_username)
-
-                try:
-                    create_camu_notification(INS_ADDED_NT, phi)
-                except Exception as e:
-                    logger.error(f"Failed to create CAMU notification: {e}")
-
-                try:
-                    if insuree.email:
-                        insuree_enrolment_type = insuree.json_ext.get("insureeEnrolmentType", "").lower()
-                        if insuree_enrolment_type:
-                            send_mail_to_temp_insuree_with_pdf(insuree, insuree_enrolment_type)
-                except Exception as e:
-                    logger.error(f"Fail to send auto mail: {e}")
-
-                chf_id = insuree.chf_id or insuree.camu_number or ""
-                nom = insuree.last_name or ""
-                prenom = insuree.other_names or ""
-                results_data.append(
-                    build_result_entry(row, index, chf_id, "Succès", nom, prenom)
-                )
-                success_count += 1
-
-            except Exception as e:
-                logger.error(f"Error processing row {index + 1}: {str(e)}", exc_info=True)
-                chf_id = row.get(HEADER_INSUREE_ID) or row.get(HEADER_INSUREE_CAMU_NO) or ""
-                nom = row.get(HEADER_INSUREE_LAST_NAME, "")
-                prenom = row.get(HEADER_INSUREE_OTHER_NAMES, "")
-                results_data.append(
-                    build_result_entry(row, index, chf_id, f"Erreur: {str(e)}", nom, prenom)
-                )
-                error_count += 1
 
-            # Update progress
-            batch_upload.update_progress(
-                processed_rows=index + 1,
-                success_count=success_count,
-                error_count=error_count,
-            )
+@shared_task
+def import_policyholder_insurees_chunk(
+    user_id, policyholder_code, batch_upload_id, uploaded_file_record_id, start, end,
+    parent_task_id=None, file_handoff=None,
+):
+    """
+    Process rows [start, end) of an uploaded sheet, one member of the import chord.
+    Results are checkpointed, only a summary is returned to the merge callback.
+    Failures are returned instead of raised so the merge callback always runs.
+    """
+    reporter = None
+    try:
+        batch_upload = PolicyHolderInsureeBatchUpload.objects.get(id=batch_upload_id)
+        user = User.objects.get(id=user_id)
+        policyholder = get_policy_holder_from_code(policyholder_code)
 
-        batch_upload.success_count = success_count
-        batch_upload.error_count = error_count
-        batch_upload.results = {"results": results_data}
-        batch_upload.mark_as_completed()
-        batch_upload.save(update_fields=["results", "success_count", "error_count", "status", "completed_at", "updated_at"])
+        if not policyholder:
+            raise Exception("Policy holder not found")
 
-        # Clean up downloaded file
-        try:
-            if os.path.exists(file_path):
-                os.unlink(file_path)
-        except Exception as e:
-            logger.warning(f"Failed to clean up temp file: {e}")
+        cpb = get_import_contribution_plan_bundle(policyholder)
+        uploaded_file_record = PolicyHolderInsureeUploadedFile.objects.filter(
+            id=uploaded_file_record_id
+        ).first()
+
+        if not uploaded_file_record:
+            raise Exception("Uploaded file record not found")
+
+        timer = ImportStageTimer()
+        reporter = ImportProgressReporter(batch_upload, task_id=parent_task_id, incremental=True)
+        with open_import_file(
+            uploaded_file_record, file_handoff, download_prefix=f"{batch_upload_id}_{start}_"
+        ) as import_file, timer:
+            _, success_count, error_count = process_insuree_import_rows(
+                iter_import_rows(import_file, start=start, end=end),
+                user,
+                policyholder,
+                cpb,
+                progress_callback=reporter,
+                timer=timer,
+                sink=ImportCheckpointer(batch_upload, start),
+                dry_run=batch_upload.dry_run,
+            )
 
         return {
-            "success": True,
-            "total_rows": total_rows,
+            "start": start,
             "success_count": success_count,
             "error_count": error_count,
+            "stage_timings": timer.as_dict(),
         }
 
     except Exception as e:
-        logger.error(f"Fatal error in import_policyholder_insurees_async: {str(e)}", exc_info=True)
+        logger.error(
+            f"Fatal error in import chunk {start}-{end} of batch {batch_upload_id}: {str(e)}",
+            exc_info=True,
+        )
+        return {"start": start, "error": str(e)}
+
+    finally:
+        if reporter:
+            reporter.flush()
 
-        if batch_upload:
-            batch_upload.mark_as_failed(str(e))
 
-        raise
\ No newline at end of file
+@shared_task
+def dispatch_import_outbox():
+    """
+    Start the outbox workers: one drain task per free concurrency slot of every
+    target having entries ready. Can also be scheduled periodically with beat.
+    """
+    release_stale_outbox_entries()
+    targets = get_pending_outbox_targets()
+    for target in targets:
+        for _ in range(get_outbox_concurrency(target)):
+            drain_import_outbox.delay(target)
+    return sorted(targets)
+
+
+@shared_task
+def drain_import_outbox(target, retry=False):
+    """
+    Deliver the pending import side effects of one target, see import_outbox.
+    Entries waiting for a retry are picked up by a single delayed drain
+    (``retry``) per target.
+    """
+    if retry:
+        clear_outbox_retry(target)
+    drained = drain_outbox_target(target)
+    if drained is None:
+        # every worker slot of this target is busy
+        return None
+
+    delivered, failed = drained
+    if delivered or failed:
+        logger.info(f"Import outbox {target}: {delivered} delivered, {failed} failed")
+
+    next_retry = get_next_outbox_retry(target)
+    if next_retry and schedule_outbox_retry(target, next_retry):
+        countdown = max(0, (next_retry - timezone.now()).total_seconds())
+        drain_import_outbox.apply_async((target,), {"retry": True}, countdown=countdown)
+    return {"delivered": delivered, "failed": failed}
+
+
+@shared_task
+def merge_policyholder_insuree_import_chunks(chunk_results, batch_upload_id, file_handoff=None):
+    """
+    Chord callback: sum the checkpointed chunk counters and close the batch.
+    When a chunk failed the batch stays processing and resume_insuree_import()
+    redoes the rows its checkpoints do not cover, until
+    insuree_import_max_resumes is reached and the batch is failed. The shared
+    copy of the file the chunks read is released.
+    """
+    release_import_file_handoff(file_handoff)
+    batch_upload = PolicyHolderInsureeBatchUpload.objects.get(id=batch_upload_id)
+    chunk_errors = [
+        chunk["error"] for chunk in sorted(chunk_results, key=lambda chunk: chunk["start"]) if chunk.get("error")
+    ]
+    # seconds of parallel chunks add up, like CPU time
+    stage_timings = merge_stage_timings(
+        batch_upload.stage_timings, *(chunk.get("stage_timings") for chunk in chunk_results)
+    )
+
+    if chunk_errors:
+        batch_upload.stage_timings = stage_timings
+        batch_upload.save(update_fields=["stage_timings", "updated_at"])
+
+    if chunk_errors and get_resume_refusal(batch_upload) is None:
+        logger.warning(
+            f"Resuming policyholder insuree import {batch_upload.id} after failed chunks: {'; '.join(chunk_errors)}"
+        )
+        resume_insuree_import(batch_upload)
+        _, success_count, error_count = get_checkpointed_counters(batch_upload)
+    elif chunk_errors:
+        # report of the rows the other chunks imported
+        store_import_report(batch_upload)
+        batch_upload.mark_as_failed("; ".join(chunk_errors))
+        set_cached_final_progress(batch_upload)
+        dispatch_import_outbox_on_commit()
+        schedule_insuree_imports_on_commit()
+        _, success_count, error_count = get_checkpointed_counters(batch_upload)
+    else:
+        success_count, error_count = complete_insuree_import(batch_upload, stage_timings)
+
+    return {
+        "success": not chunk_errors,
+        "total_rows": batch_upload.total_rows,
+        "success_count": success_count,
+        "error_count": error_count,
+    }
+
+
+def get_resume_refusal(batch_upload):
+    """Why ``batch_upload`` cannot be resumed once more, None when it can."""
+    if not batch_upload.uploaded_file_id or not batch_upload.created_by_id:
+        return "the file or the user to resume it with is missing"
+    if batch_upload.resume_count >= PolicyholderConfig.insuree_import_max_resumes:
+        return f"given up after {batch_upload.resume_count} resumes"
+    return None
+
+
+def resume_insuree_import(batch_upload):
+    """
+    Start a new task processing the rows of ``batch_upload`` its checkpoints do
+    not cover. Returns the id of the task.
+    """
+    task_id = str(uuid.uuid4())
+    batch_upload.celery_task_id = task_id
+    batch_upload.save(update_fields=["celery_task_id", "updated_at"])
+    import_policyholder_insurees_async.apply_async(
+        kwargs={
+            "user_id": batch_upload.created_by_id,
+            "policyholder_code": batch_upload.policy_holder.code,
+            "batch_upload_id": str(batch_upload.id),
+            "uploaded_file_record_id": str(batch_upload.uploaded_file_id),
+            "resume": True,
+        },
+        task_id=task_id,
+        **get_import_queue_options(batch_upload),
+    )
+    return task_id
+
+
+@shared_task
+def requeue_stale_insuree_imports():
+    """
+    Resume the imports left processing by a lost worker: batches still
+    processing without any progress for insuree_import_stale_after seconds.
+    After insuree_import_max_resumes attempts the batch is failed instead.
+    Imports dispatched that long ago and still pending are queued again, and
+    the queued imports whose turn came are dispatched.
+    Meant to be scheduled periodically with beat.
+    """
+    remove_stale_handoff_files(PolicyholderConfig.insuree_import_stale_after)
+    stale_before = timezone.now() - timedelta(seconds=PolicyholderConfig.insuree_import_stale_after)
+    release_lost_dispatches(stale_before)
+    stale_batches = PolicyHolderInsureeBatchUpload.objects.filter(
+        status=PolicyHolderInsureeBatchUpload.Status.PROCESSING,
+        updated_at__lt=stale_before,
+    ).select_related("policy_holder")
+
+    resumed = []
+    for batch_upload in stale_batches:
+        # another sweeper, or the lost worker itself, may have moved it meanwhile
+        claimed = PolicyHolderInsureeBatchUpload.objects.filter(
+            id=batch_upload.id,
+            status=PolicyHolderInsureeBatchUpload.Status.PROCESSING,
+            updated_at=batch_upload.updated_at,
+        ).update(updated_at=timezone.now())
+        if not claimed:
+            continue
+        batch_upload.refresh_from_db()
+
+        refusal = get_resume_refusal(batch_upload)
+        if refusal:
+            batch_upload.mark_as_failed(f"Import interrupted, {refusal}")
+        else:
+            logger.warning(f"Resuming stale policyholder insuree import {batch_upload.id}")
+            resume_insuree_import(batch_upload)
+            resumed.append(str(batch_upload.id))
+            continue
+        set_cached_final_progress(batch_upload)
+    schedule_insuree_imports()
+    return resumed
@@ -1,2 +1,3 @@
 from .helpers import *
-from .helpers_tests import *
\ No newline at end of file
+from .helpers_tests import *
+from .import_utils_tests import *
@@ -0,0 +1,1008 @@
+import hashlib
+import io
+import os
+import tempfile
+from datetime import datetime, timedelta
+
+from unittest.mock import patch
+
+import openpyxl
+import pandas as pd
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache import cache
+from django.db import DatabaseError, transaction
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from core.models import User
+from insuree.models import Family, Insuree
+from insuree.test_helpers import create_test_insuree
+from location.models import Location
+
+from policyholder.apps import PolicyholderConfig
+
+from policyholder.chf_id_allocator import ChfIdBlockAllocator, format_chf_id, reserve_chf_id, split_chf_id
+from policyholder.import_fingerprint import get_row_fingerprint, get_row_key
+from policyholder.import_checkpoint import (
+    ImportCheckpointer,
+    get_checkpointed_counters,
+    get_pending_row_ranges,
+)
+from policyholder.import_engine import (
+    DRY_RUN_DELETE,
+    DRY_RUN_VALID,
+    ImportTransactionChunks,
+    InlineXlsxReportSink,
+    build_result_entry,
+    process_insuree_import_rows,
+    save_import_links,
+)
+from policyholder.import_outbox import (
+    OUTBOX_HANDLERS,
+    claim_outbox_entries,
+    clear_outbox_retry,
+    drain_outbox_target,
+    get_next_outbox_retry,
+    schedule_outbox_retry,
+    Status as OutboxStatus,
+    Target as OutboxTarget,
+)
+from policyholder.import_progress import PROGRESS_CACHE_COUNTERS, ImportProgressReporter, progress_cache_key
+from policyholder.import_report import (
+    REPORT_COLUMNS,
+    get_import_report_file,
+    get_report_cache_path,
+    render_import_report,
+    store_import_report,
+)
+from policyholder.import_results import get_import_results_page, iter_import_results, save_import_results
+from policyholder.import_scheduler import claim_schedulable_imports, release_lost_dispatches
+from policyholder.import_handoff import HANDOFF_INLINE, build_import_file_handoff, open_import_file
+from policyholder.import_storage import (
+    LocalImportFileStorage,
+    find_completed_import,
+    spooled_upload,
+    store_import_file,
+)
+from policyholder.models import (
+    PolicyHolderInsuree,
+    PolicyHolderInsureeBatchUpload,
+    PolicyHolderInsureeChfIdReservation,
+    PolicyHolderInsureeImportFingerprint,
+    PolicyHolderInsureeImportOutbox,
+)
+from policyholder.tests.helpers import create_test_policy_holder, create_test_policy_holder_insuree
+from policyholder.import_utils import (
+    IMPORT_COLUMN_MAPPING,
+    ImportFamilyBuilder,
+    InsureeImportContext,
+    _iter_sheet_values,
+    count_import_rows,
+    iter_import_rows,
+    prevalidate_import_rows,
+    read_import_columns,
+    row_ranges_share_insurees,
+    soft_delete_insurees,
+    HEADERS,
+    HEADER_INSUREE_ID,
+    HEADER_INSUREE_CAMU_NO,
+    HEADER_INSUREE_DOB,
+    HEADER_INSUREE_GENDER,
+    HEADER_INSUREE_LAST_NAME,
+    HEADER_INSUREE_OTHER_NAMES,
+    HEADER_FAMILY_LOCATION_CODE,
+    HEADER_DELETE,
+)
+
+
+def _get_test_user():
+    if not User.objects.filter(username='admin').exists():
+        User.objects.create_superuser(username='admin', password='S\/pe®Pąßw0rd™')
+    return User.objects.filter(username='admin').first()
+
+
+def _create_delete_rows(count):
+    """
+    (policyholder, contribution plan bundle, rows) of an import deleting
+    ``count`` insurees linked to the policyholder.
+    """
+    policyholder = create_test_policy_holder()
+    first = create_test_policy_holder_insuree(
+        policy_holder=policyholder, insuree=create_test_insuree(custom_props={"chf_id": "IMPDEL0000"})
+    )
+    links = [first] + [
+        create_test_policy_holder_insuree(
+            policy_holder=policyholder,
+            insuree=create_test_insuree(custom_props={"chf_id": f"IMPDEL{index:04d}"}),
+            contribution_plan_bundle=first.contribution_plan_bundle,
+            last_policy=first.last_policy,
+        )
+        for index in range(1, count)
+    ]
+    rows = []
+    for index, link in enumerate(links):
+        row = {header: None for header in HEADERS}
+        row.update({HEADER_INSUREE_ID: link.insuree.chf_id, HEADER_DELETE: "oui"})
+        rows.append((index, row))
+    return policyholder, first.contribution_plan_bundle, rows
+
+
+def _xlsx(columns, rows):
+    """In-memory xlsx file of ``rows`` under the ``columns`` header."""
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append(columns)
+    for row in rows:
+        sheet.append(row)
+    file = io.BytesIO()
+    workbook.save(file)
+    file.seek(0)
+    return file
+
+
+class InsureeImportContextTest(TestCase):
+    """
+    Class to check that the import context resolves the sheet lookups up front.
+    """
+
+    def test_preload_insuree_by_chf_id(self):
+        insuree = create_test_insuree(custom_props={"chf_id": "IMPCTX0001"})
+        df = pd.DataFrame([{
+            HEADER_INSUREE_ID: " IMPCTX0001 ",
+            HEADER_INSUREE_CAMU_NO: None,
+            HEADER_FAMILY_LOCATION_CODE: None,
+        }])
+
+        context = InsureeImportContext.from_dataframe(df)
+
+        found = context.get_insuree({HEADER_INSUREE_ID: "IMPCTX0001"})
+        self.assertEqual(found.id, insuree.id)
+
+    def test_unknown_values_are_not_resolved(self):
+        df = pd.DataFrame([{
+            HEADER_INSUREE_ID: "IMPCTX-UNKNOWN",
+            HEADER_INSUREE_CAMU_NO: float("nan"),
+            HEADER_FAMILY_LOCATION_CODE: "UNKNOWN-VILLAGE",
+        }])
+
+        context = InsureeImportContext.from_dataframe(df)
+
+        self.assertIsNone(context.get_insuree({HEADER_INSUREE_ID: "IMPCTX-UNKNOWN"}))
+        self.assertIsNone(context.get_village("UNKNOWN-VILLAGE"))
+
+    def test_rollback_row_forgets_its_insurees(self):
+        context = InsureeImportContext()
+        context.start_row()
+        context.register_created_insuree(create_test_insuree(custom_props={"chf_id": "IMPCTX0002"}))
+        self.assertIsNotNone(context.get_insuree({HEADER_INSUREE_ID: "IMPCTX0002"}))
+
+        context.rollback_row({HEADER_INSUREE_ID: "IMPCTX0002"})
+
+        self.assertIsNone(context.get_insuree({HEADER_INSUREE_ID: "IMPCTX0002"}))
+
+
+class ImportFamilyBuilderTest(TestCase):
+    """
+    Class to check that the families of new heads are created by batch.
+    """
+
+    def test_build_sets_family_and_head(self):
+        insurees = [
+            create_test_insuree(with_family=False, custom_props={"chf_id": f"IMPFAM000{index}"}) for index in range(2)
+        ]
+        context = InsureeImportContext()
+        builder = ImportFamilyBuilder(audit_user_id=-1, enrolment_type=None)
+        for insuree in insurees:
+            self.assertFalse(builder.has_family(insuree, context))
+            builder.add({}, insuree, None, context=context)
+        self.assertTrue(builder.has_family(insurees[0], context))
+
+        self.assertEqual(builder.build(), {insuree.id for insuree in insurees})
+
+        for insuree in insurees:
+            self.assertTrue(insuree.head)
+            self.assertEqual(context.get_family(insuree), insuree.family)
+            insuree.refresh_from_db()
+            self.assertTrue(insuree.head)
+            self.assertEqual(insuree.family.head_insuree_id, insuree.id)
+
+
+class PrevalidateImportRowsTest(TestCase):
+    """
+    Class to check the column-wise validation run before the row loop.
+    """
+
+    @staticmethod
+    def _row(**values):
+        row = {header: None for header in HEADERS}
+        row.update({
+            HEADER_INSUREE_LAST_NAME: "Nom",
+            HEADER_INSUREE_OTHER_NAMES: "Prenom",
+            HEADER_INSUREE_GENDER: "M",
+            HEADER_FAMILY_LOCATION_CODE: "V0001",
+        })
+        row.update(values)
+        return row
+
+    def test_date_of_birth_and_age(self):
+        errors = prevalidate_import_rows([
+            (0, self._row(**{HEADER_INSUREE_DOB: "1990-05-01"})),
+            (1, self._row(**{HEADER_INSUREE_DOB: "not a date"})),
+            (2, self._row(**{HEADER_INSUREE_DOB: "31/12/2020"})),
+            (3, self._row(**{HEADER_INSUREE_DOB: "12/31/1990"})),
+        ], 18)
+
+        self.assertEqual(errors, {
+            1: "Format de date invalide: not a date",
+            2: "L'assuré doit être âgé d'au moins 18 ans.",
+        })
+
+    def test_mandatory_columns_only_for_new_insurees(self):
+        errors = prevalidate_import_rows([
+            (0, self._row(**{HEADER_INSUREE_DOB: "1990-05-01", HEADER_INSUREE_GENDER: None})),
+            (1, self._row(**{HEADER_INSUREE_ID: "123456", HEADER_INSUREE_GENDER: None})),
+            (2, self._row(**{HEADER_DELETE: "oui"})),
+        ], 18)
+
+        self.assertEqual(errors, {0: "Champs obligatoires manquants : Sexe"})
+
+
+class PolicyHolderInsureeBulkUpsertTest(TestCase):
+    """
+    Class to check that bulk upserted links carry the history audit fields.
+    """
+
+    def test_bulk_upsert_creates_then_updates(self):
+        existing = create_test_policy_holder_insuree()
+        new_insuree = create_test_insuree(custom_props={"chf_id": "PHIBULK001"})
+        username = existing.user_created.username
+
+        results = PolicyHolderInsuree.objects.bulk_upsert([
+            PolicyHolderInsuree(
+                insuree=existing.insuree,
+                policy_holder=existing.policy_holder,
+                contribution_plan_bundle=existing.contribution_plan_bundle,
+                json_ext={},
+                employer_number="EMP-1",
+            ),
+            PolicyHolderInsuree(
+                insuree=new_insuree,
+                policy_holder=existing.policy_holder,
+                json_ext={},
+            ),
+        ], username)
+
+        (updated, updated_created), (created, created_created) = results
+        self.assertFalse(updated_created)
+        self.assertEqual(updated.id, existing.id)
+        self.assertTrue(created_created)
+
+        updated.refresh_from_db()
+        self.assertEqual(updated.employer_number, "EMP-1")
+        self.assertEqual(updated.version, existing.version + 1)
+
+        created.refresh_from_db()
+        self.assertEqual(created.version, 1)
+        self.assertEqual(created.user_created.username, username)
+        self.assertIsNotNone(created.date_valid_from)
+
+    def test_soft_delete_insurees_ends_existing_links_only(self):
+        existing = create_test_policy_holder_insuree()
+        unlinked = create_test_insuree(custom_props={"chf_id": "PHIDEL0001"})
+
+        deleted = soft_delete_insurees([existing.insuree, unlinked], existing.policy_holder.code)
+
+        self.assertEqual(deleted, {existing.insuree.id})
+        existing.refresh_from_db()
+        self.assertTrue(existing.is_deleted)
+        self.assertIsNotNone(existing.date_valid_to)
+
+    def test_failed_batch_saves_links_one_by_one(self):
+        existing = create_test_policy_holder_insuree()
+        failing = create_test_insuree(custom_props={"chf_id": "PHIBULK002"})
+        working = create_test_insuree(custom_props={"chf_id": "PHIBULK003"})
+        pending_links = [
+            ({"Etat": "OK"}, PolicyHolderInsuree(insuree=insuree, policy_holder=existing.policy_holder, json_ext={}), None)
+            for insuree in (failing, working)
+        ]
+        entries = [entry for entry, _, _ in pending_links]
+
+        def side_effects(phi, insuree, user=None):
+            if insuree.id == failing.id:
+                raise DatabaseError("outbox unavailable")
+
+        with patch("policyholder.import_engine.enqueue_attached_insuree_side_effects", side_effects):
+            counts = save_import_links(pending_links, existing.user_created)
+
+        self.assertEqual(counts, (1, 1))
+        self.assertEqual([entry["Etat"] for entry in entries], ["KO", "OK"])
+        linked = PolicyHolderInsuree.objects.filter(policy_holder=existing.policy_holder, is_deleted=False)
+        self.assertTrue(linked.filter(insuree=working).exists())
+        self.assertFalse(linked.filter(insuree=failing).exists())
+
+
+class ChfIdCounterTest(TestCase):
+    """
+    Class to check how temporary CAMU numbers are split for block reservation.
+    """
+
+    def test_split_and_format_keep_padding(self):
+        prefix, value, width = split_chf_id("TMP0100042")
+
+        self.assertEqual((prefix, value, width), ("TMP", 100042, 7))
+        self.assertEqual(format_chf_id(prefix, value + 1, width), "TMP0100043")
+        self.assertIsNone(split_chf_id("TMP"))
+
+
+@patch("policyholder.chf_id_allocator.temp_generate_employee_camu_registration_number", return_value="TMP001")
+class ChfIdBlockAllocatorTest(TestCase):
+    """
+    Class to check that temporary CAMU numbers are never handed out twice.
+    """
+
+    def _reservation(self):
+        return PolicyHolderInsureeChfIdReservation.objects.get(region_code="R1", enrolment_category="E")
+
+    def test_blocks_are_disjoint(self, generator):
+        first, second = ChfIdBlockAllocator(block_size=3), ChfIdBlockAllocator(block_size=3)
+
+        self.assertEqual([first.allocate("R1", "E", {}) for _ in range(2)], ["TMP001", "TMP002"])
+        self.assertEqual(second.allocate("R1", "E", {}), "TMP004")
+        self.assertEqual(first.allocate("R1", "E", {}), "TMP003")
+        # the first block is used up, the generator is only asked once per block
+        self.assertEqual(first.allocate("R1", "E", {}), "TMP007")
+        self.assertEqual(generator.call_count, 3)
+
+    def test_release_gives_back_the_unused_end(self, generator):
+        allocator = ChfIdBlockAllocator(block_size=3)
+        allocator.allocate("R1", "E", {})
+        allocator.release()
+        self.assertEqual(self._reservation().next_value, 2)
+
+        # reserved after, the end of the first block is left as a gap
+        first, second = ChfIdBlockAllocator(block_size=3), ChfIdBlockAllocator(block_size=3)
+        self.assertEqual(first.allocate("R1", "E", {}), "TMP002")
+        self.assertEqual(second.allocate("R1", "E", {}), "TMP005")
+        first.release()
+        self.assertEqual(self._reservation().next_value, 8)
+
+    def test_exhausted_counter_falls_back_to_the_generator(self, generator):
+        generator.return_value = "TMP998"
+        allocator = ChfIdBlockAllocator(block_size=5)
+
+        self.assertEqual([allocator.allocate("R1", "E", {}) for _ in range(2)], ["TMP998", "TMP999"])
+        self.assertEqual(allocator.allocate("R1", "E", {}), "TMP998")
+        self.assertEqual(self._reservation().next_value, 1000)
+
+    def test_rolled_back_reservation_is_discarded(self, generator):
+        allocator = ChfIdBlockAllocator(block_size=3)
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                allocator.allocate("R1", "E", {})
+                self.assertTrue(allocator.uncommitted_keys)
+                raise RuntimeError("row failed")
+        allocator.discard_uncommitted()
+
+        self.assertFalse(PolicyHolderInsureeChfIdReservation.objects.exists())
+        self.assertEqual(allocator.allocate("R1", "E", {}), "TMP001")
+
+    def test_single_numbers_skip_reserved_blocks(self, generator):
+        allocator = ChfIdBlockAllocator(block_size=3)
+        self.assertEqual(allocator.allocate("R1", "E", {}), "TMP001")
+
+        self.assertEqual(reserve_chf_id("R1", "E", {}), "TMP004")
+        self.assertEqual(reserve_chf_id("R1", "E", {}), "TMP005")
+        self.assertEqual(allocator.allocate("R1", "E", {}), "TMP002")
+
+
+class ImportRowReaderTest(TestCase):
+    """
+    Class to check that the streamed sheet reader reads what pandas.read_excel did.
+    """
+
+    columns = [" Nom ", "Date de naissance", "Numéro CAMU temporaire"]
+    rows = [
+        ["Doe", datetime(1990, 2, 1), 12345],
+        ["", "", ""],
+        ["Roe", "03/04/1985", 678],
+        ["", "", ""],
+        [None, None, None],
+    ]
+
+    def test_raw_values_keep_the_header_row(self):
+        values = list(_iter_sheet_values(_xlsx(self.columns, self.rows)))
+
+        self.assertEqual(values[0], tuple(self.columns))
+        self.assertEqual(values[1], ("Doe", datetime(1990, 2, 1), 12345))
+
+    def test_rows_match_pandas(self):
+        file = _xlsx(self.columns, self.rows)
+        df = pd.read_excel(file)
+        df.columns = df.columns.str.strip()
+
+        # the blank middle row stays, the trailing ones are dropped
+        self.assertEqual(read_import_columns(file), ["Nom", "Date de naissance", "Numéro CAMU temporaire"])
+        self.assertEqual(count_import_rows(file), len(df))
+        rows = list(iter_import_rows(file))
+        self.assertEqual([index for index, _ in rows], list(df.index))
+        for (_, row), (_, expected) in zip(rows, df.iterrows()):
+            self.assertEqual(
+                [row[IMPORT_COLUMN_MAPPING[column]] for column in df.columns],
+                [None if pd.isna(value) else value for value in expected],
+            )
+        # cells keep their type, the numbers pandas read as floats stay ints
+        self.assertEqual(rows[0][1][HEADER_INSUREE_ID], 12345)
+        self.assertEqual(rows[0][1][HEADER_INSUREE_DOB], datetime(1990, 2, 1))
+
+    def test_slice_of_rows(self):
+        file = _xlsx(self.columns, self.rows)
+
+        self.assertEqual(
+            [(index, row[HEADER_INSUREE_LAST_NAME]) for index, row in iter_import_rows(file, start=1, end=3)],
+            [(1, None), (2, "Roe")],
+        )
+
+
+class RowRangesShareInsureesTest(TestCase):
+    """
+    Class to check which files are split in parallel chunks.
+    """
+
+    columns = ["Nom", "Prénom", "Date de naissance", "Numéro CAMU temporaire"]
+
+    def test_same_insuree_in_two_chunks(self):
+        rows = [
+            ["Doe", "Jane", "01/02/1990", None],
+            ["Roe", "Rick", "03/04/1985", "TMP001"],
+            ["Poe", "Paul", "05/06/1980", None],
+            ["Moe", "Mary", "07/08/1975", None],
+        ]
+        self.assertFalse(row_ranges_share_insurees(_xlsx(self.columns, rows), [(0, 2), (2, 4)]))
+
+        # same temporary CAMU number, the update of the second row may run first
+        rows[3][3] = "TMP001"
+        self.assertTrue(row_ranges_share_insurees(_xlsx(self.columns, rows), [(0, 2), (2, 4)]))
+        # both rows in the same chunk
+        self.assertFalse(row_ranges_share_insurees(_xlsx(self.columns, rows), [(0, 1), (1, 4)]))
+
+    def test_same_new_insuree_in_two_chunks(self):
+        rows = [
+            ["Doe", "Jane", "01/02/1990", None],
+            ["Roe", "Rick", "03/04/1985", None],
+            ["Doe", "Jane", "01/02/1990", None],
+        ]
+        self.assertTrue(row_ranges_share_insurees(_xlsx(self.columns, rows), [(0, 2), (2, 3)]))
+        # rows already checkpointed are not looked at
+        self.assertFalse(row_ranges_share_insurees(_xlsx(self.columns, rows), [(1, 2), (2, 3)]))
+
+
+class ImportCheckpointTest(TestCase):
+    """
+    Class to check which rows an interrupted import resumes with.
+    """
+
+    def test_pending_ranges_skip_checkpointed_rows(self):
+        batch_upload = PolicyHolderInsureeBatchUpload.objects.create(
+            policy_holder=create_test_policy_holder(), input_file_name="import.xlsx"
+        )
+        checkpointer = ImportCheckpointer(batch_upload, 0)
+        results = [{"ligne": 2, "Etat": "OK"}, {"ligne": 3, "Etat": "OK"}]
+        checkpointer.checkpoint(2, results, 2, 0)
+        results.append({"ligne": 4, "Etat": "KO", "remarque": "Village inconnu - V1"})
+        checkpointer.checkpoint(3, results, 2, 1)
+        ImportCheckpointer(batch_upload, 6).checkpoint(8, [{"ligne": 9, "Etat": "OK"}, {"ligne": 8, "Etat": "OK"}], 2, 0)
+
+        self.assertEqual(get_pending_row_ranges(batch_upload, 10), [(3, 6), (8, 10)])
+        self.assertEqual(get_checkpointed_counters(batch_upload), (5, 4, 1))
+        self.assertEqual([result["ligne"] for result in iter_import_results(batch_upload)], [2, 3, 4, 8, 9])
+        errors, count = get_import_results_page(batch_upload, status="KO")
+        self.assertEqual(count, 1)
+        self.assertEqual(errors[0]["remarque"], "Village inconnu - V1")
+
+
+class ImportRowFingerprintTest(TestCase):
+    """
+    Class to check that row fingerprints ignore how the same values are read.
+    """
+
+    def test_fingerprint_normalizes_values(self):
+        row = {header: None for header in HEADERS}
+        row.update({
+            HEADER_INSUREE_LAST_NAME: "Nom",
+            HEADER_INSUREE_OTHER_NAMES: "Prenom",
+            HEADER_INSUREE_DOB: "01/05/1990",
+        })
+        same_row = dict(row, **{HEADER_INSUREE_LAST_NAME: " Nom ", HEADER_INSUREE_DOB: "1990-05-01"})
+        changed_row = dict(row, **{HEADER_INSUREE_GENDER: "F"})
+
+        self.assertEqual(get_row_key(row), "name:Nom|Prenom|1990-05-01")
+        self.assertEqual(get_row_key(dict(row, **{HEADER_INSUREE_ID: " TMP001 "})), "id:TMP001")
+        self.assertEqual(get_row_fingerprint(row, 1), get_row_fingerprint(same_row, 1))
+        self.assertNotEqual(get_row_fingerprint(row, 1), get_row_fingerprint(changed_row, 1))
+        self.assertNotEqual(get_row_fingerprint(row, 1), get_row_fingerprint(row, 2))
+
+
+class ImportFileStorageTest(TestCase):
+    """
+    Class to check that uploads are hashed and stored without reading them in memory.
+    """
+
+    def test_spooled_upload_round_trip(self):
+        data = b"PK\x03\x04" + os.urandom(4096)
+        storage = LocalImportFileStorage(tempfile.mkdtemp())
+
+        with spooled_upload(SimpleUploadedFile("roster.xlsx", data)) as (path, file_hash):
+            self.assertEqual(file_hash, hashlib.sha256(data).hexdigest())
+            storage.save(path, f"test/sha256/{file_hash}.xlsx")
+        self.assertFalse(os.path.exists(path))
+
+        download_path = os.path.join(tempfile.mkdtemp(), "roster.xlsx")
+        storage.load(f"test/sha256/{file_hash}.xlsx", download_path)
+        with open(download_path, "rb") as downloaded:
+            self.assertEqual(downloaded.read(), data)
+
+
+class CompletedImportReuseTest(TestCase):
+    """
+    Class to check that a file imported again is answered with its previous import.
+    """
+
+    def _import(self, policyholder, data, status=PolicyHolderInsureeBatchUpload.Status.COMPLETED):
+        with spooled_upload(SimpleUploadedFile("roster.xlsx", data)) as (path, file_hash):
+            uploaded_file = store_import_file(policyholder, path, "roster.xlsx", file_hash)
+        batch_upload = PolicyHolderInsureeBatchUpload.objects.create(
+            policy_holder=policyholder, input_file_name="roster.xlsx", uploaded_file=uploaded_file
+        )
+        if status == PolicyHolderInsureeBatchUpload.Status.COMPLETED:
+            batch_upload.mark_as_completed()
+        return batch_upload, file_hash
+
+    @patch.object(PolicyholderConfig, "insuree_import_storage_backend", "local")
+    def test_same_bytes_reuse_the_previous_import(self):
+        policyholder = create_test_policy_holder()
+        data = b"PK\x03\x04" + os.urandom(1024)
+        with patch.object(PolicyholderConfig, "insuree_import_local_storage_dir", tempfile.mkdtemp()):
+            previous, file_hash = self._import(policyholder, data)
+            self.assertEqual(find_completed_import(policyholder, file_hash), previous)
+            self.assertIsNone(find_completed_import(policyholder, file_hash, reimport=True))
+            # another policyholder, or a content never imported
+            other_policyholder = create_test_policy_holder(custom_props={"code": "REUSE2"})
+            self.assertIsNone(find_completed_import(other_policyholder, file_hash))
+            self.assertIsNone(find_completed_import(policyholder, hashlib.sha256(b"other").hexdigest()))
+            with patch.object(PolicyholderConfig, "insuree_import_reuse_completed_reports", False):
+                self.assertIsNone(find_completed_import(policyholder, file_hash))
+
+    @patch.object(PolicyholderConfig, "insuree_import_storage_backend", "local")
+    def test_unfinished_import_is_not_reused(self):
+        policyholder = create_test_policy_holder()
+        with patch.object(PolicyholderConfig, "insuree_import_local_storage_dir", tempfile.mkdtemp()):
+            _, file_hash = self._import(
+                policyholder, os.urandom(512), status=PolicyHolderInsureeBatchUpload.Status.PENDING
+            )
+
+        self.assertIsNone(find_completed_import(policyholder, file_hash))
+
+
+class ImportReportTest(TestCase):
+    """
+    Class to check the report rendered once an import is finished.
+    """
+
+    def setUp(self):
+        self.batch_upload = PolicyHolderInsureeBatchUpload.objects.create(
+            policy_holder=create_test_policy_holder(), input_file_name="import.xlsx"
+        )
+        save_import_results(self.batch_upload, [
+            build_result_entry({}, 2, "TMP002", "Village inconnu - V9", "Roe", "Rick"),
+            build_result_entry({}, 0, "TMP000", "Succès", "Doe", "Jane"),
+            build_result_entry({}, 1, "TMP001", "Aucun changement", "Poe", "Paul"),
+        ])
+
+    def _read(self, path):
+        workbook = openpyxl.load_workbook(path, read_only=True)
+        try:
+            return list(workbook.worksheets[0].iter_rows(values_only=True))
+        finally:
+            workbook.close()
+
+    def test_rows_in_sheet_order(self):
+        path = os.path.join(tempfile.mkdtemp(), "report.xlsx")
+
+        self.assertEqual(render_import_report(self.batch_upload, path), 3)
+        rows = self._read(path)
+        self.assertEqual(rows[0], tuple(header for _, header in REPORT_COLUMNS))
+        self.assertEqual([row[:3] for row in rows[1:]], [(1, "TMP000", "Doe"), (2, "TMP001", "Poe"), (3, "TMP002", "Roe")])
+        self.assertEqual(rows[3][4:], ("KO", "Village inconnu - V9"))
+
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+    @patch.object(PolicyholderConfig, "insuree_import_storage_backend", "local")
+    def test_report_is_stored_and_served_from_the_storage(self):
+        with patch.object(PolicyholderConfig, "insuree_import_local_storage_dir", tempfile.mkdtemp()):
+            store_import_report(self.batch_upload)
+            self.batch_upload.refresh_from_db()
+            self.assertTrue(self.batch_upload.report_file_path)
+
+            # the local copy is gone, e.g. on another API server
+            os.unlink(get_report_cache_path(self.batch_upload))
+            path = get_import_report_file(self.batch_upload)
+        self.assertEqual(len(self._read(path)), 4)
+
+
+class ImportFileHandoffTest(TestCase):
+    """
+    Class to check that small uploads reach the worker without the storage.
+    """
+
+    def test_inline_handoff_round_trip(self):
+        data = b"PK\x03\x04" + os.urandom(1024)
+        with tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False) as upload:
+            upload.write(data)
+
+        file_handoff = build_import_file_handoff(upload.name, "roster.xlsx", len(data))
+        os.unlink(upload.name)
+
+        self.assertEqual(file_handoff["mode"], HANDOFF_INLINE)
+        with open_import_file(None, file_handoff) as import_file:
+            self.assertEqual(import_file.name, "roster.xlsx")
+            self.assertEqual(import_file.read(), data)
+
+
+class ImportSchedulerTest(TestCase):
+    """
+    Class to check that a policyholder never runs two imports at once.
+    """
+
+    def test_one_active_import_per_policyholder(self):
+        policyholder = create_test_policy_holder()
+        first, second = [
+            PolicyHolderInsureeBatchUpload.objects.create(
+                policy_holder=policyholder, input_file_name=f"import_{index}.xlsx"
+            )
+            for index in range(2)
+        ]
+
+        self.assertEqual([batch_upload.id for batch_upload in claim_schedulable_imports()], [first.id])
+        self.assertEqual(claim_schedulable_imports(), [])
+
+        first.mark_as_completed()
+        self.assertEqual([batch_upload.id for batch_upload in claim_schedulable_imports()], [second.id])
+
+    def test_lost_dispatch_is_queued_again(self):
+        policyholder = create_test_policy_holder()
+        batch_upload = PolicyHolderInsureeBatchUpload.objects.create(
+            policy_holder=policyholder, input_file_name="import.xlsx"
+        )
+        self.assertEqual(len(claim_schedulable_imports()), 1)
+
+        # its task message never reached a worker, the batch is still pending
+        now = timezone.now()
+        self.assertEqual(release_lost_dispatches(now - timedelta(hours=1)), 0)
+        PolicyHolderInsureeBatchUpload.objects.filter(id=batch_upload.id).update(
+            dispatched_at=now - timedelta(hours=2)
+        )
+        self.assertEqual(release_lost_dispatches(now - timedelta(hours=1)), 1)
+        self.assertEqual([claimed.id for claimed in claim_schedulable_imports()], [batch_upload.id])
+
+
+class InlineXlsxReportSinkTest(TestCase):
+    """
+    Class to check the report of the synchronous import endpoint.
+    """
+
+    def test_status_code_follows_row_errors(self):
+        report = InlineXlsxReportSink(["Nom", "Village"])
+        report.add(0, {"Nom": "A", "Village": "V1"}, {"Etat": "OK", "remarque": "-"})
+        self.assertEqual(report.get_status_code(), 200)
+
+        report.add(1, {"Nom": "B", "Village": None}, {"Etat": "KO", "remarque": "Format de date invalide: 31/02"})
+        self.assertEqual(report.get_status_code(), 422)
+
+        report.add(2, {"Nom": "C", "Village": "V9"}, {"Etat": "KO", "remarque": "Village inconnu - V9"})
+        self.assertEqual(report.get_status_code(), 417)
+        self.assertTrue(report.render().startswith(b"PK"))
+
+
+class ImportDryRunTest(TestCase):
+    """
+    Class to check that a dry run only reports what the import would do.
+    """
+
+    def _counts(self):
+        return (
+            Insuree.objects.count(),
+            Family.objects.count(),
+            PolicyHolderInsuree.objects.filter(is_deleted=False).count(),
+            PolicyHolderInsureeImportOutbox.objects.count(),
+            PolicyHolderInsureeImportFingerprint.objects.count(),
+            PolicyHolderInsureeChfIdReservation.objects.count(),
+        )
+
+    def test_dry_run_writes_nothing(self):
+        policyholder, cpb, rows = _create_delete_rows(2)
+        village = Location.objects.filter(validity_to__isnull=True, type="V").first()
+        row = {header: None for header in HEADERS}
+        row.update({
+            HEADER_INSUREE_LAST_NAME: "Dryrun",
+            HEADER_INSUREE_OTHER_NAMES: "Nadia",
+            HEADER_INSUREE_DOB: "01/01/1990",
+            HEADER_INSUREE_GENDER: "F",
+            HEADER_FAMILY_LOCATION_CODE: village.code if village else "V-NONE",
+        })
+        rows.append((2, row))
+        before = self._counts()
+
+        results, success_count, error_count = process_insuree_import_rows(
+            rows, _get_test_user(), policyholder, cpb, dry_run=True
+        )
+
+        self.assertEqual(self._counts(), before)
+        self.assertEqual([entry["remarque"] for entry in results[:2]], [DRY_RUN_DELETE, DRY_RUN_DELETE])
+        self.assertEqual(success_count + error_count, 3)
+
+    def test_dry_run_reports_duplicated_new_rows(self):
+        policyholder, cpb, _ = _create_delete_rows(1)
+        village = Location.objects.filter(validity_to__isnull=True, type="V").first()
+        rows = []
+        for index in range(2):
+            row = {header: None for header in HEADERS}
+            row.update({
+                HEADER_INSUREE_LAST_NAME: "Dryrun",
+                HEADER_INSUREE_OTHER_NAMES: "Twice",
+                HEADER_INSUREE_DOB: "02/02/1990",
+                HEADER_INSUREE_GENDER: "F",
+                HEADER_FAMILY_LOCATION_CODE: village.code,
+            })
+            rows.append((index, row))
+
+        results, success_count, error_count = process_insuree_import_rows(
+            rows, _get_test_user(), policyholder, cpb, dry_run=True
+        )
+
+        self.assertEqual(results[0]["remarque"], DRY_RUN_VALID)
+        self.assertIn("même nom et la même date de naissance", results[1]["remarque"])
+        self.assertEqual((success_count, error_count), (1, 1))
+
+
+@override_settings(CACHES={
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "import-progress-tests"}
+})
+class ImportProgressReporterTest(TestCase):
+    """
+    Class to check how often the progress of an import is written.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.batch_upload = PolicyHolderInsureeBatchUpload.objects.create(
+            policy_holder=create_test_policy_holder(), input_file_name="import.xlsx", celery_task_id="progress-task"
+        )
+
+    def _written(self):
+        batch_upload = PolicyHolderInsureeBatchUpload.objects.get(id=self.batch_upload.id)
+        return batch_upload.processed_rows, batch_upload.success_count, batch_upload.error_count
+
+    def test_flushes_every_rows(self):
+        reporter = ImportProgressReporter(self.batch_upload, every_rows=3, every_seconds=3600)
+        reporter(1, 1, 0)
+        reporter(2, 1, 1)
+        self.assertEqual(self._written(), (0, 0, 0))
+
+        reporter(3, 2, 1)
+        self.assertEqual(self._written(), (3, 2, 1))
+
+    def test_flushes_every_seconds(self):
+        reporter = ImportProgressReporter(self.batch_upload, every_rows=1000, every_seconds=5)
+        reporter(1, 1, 0)
+        self.assertEqual(self._written(), (0, 0, 0))
+
+        reporter._flushed_at -= 5
+        reporter(2, 2, 0)
+        self.assertEqual(self._written(), (2, 2, 0))
+
+    def test_no_write_inside_a_transaction(self):
+        with patch.object(PolicyholderConfig, "insuree_import_progress_cache", True):
+            reporter = ImportProgressReporter(self.batch_upload, every_rows=1)
+            with transaction.atomic():
+                reporter(1, 1, 0)
+                self.assertEqual(self._written(), (0, 0, 0))
+            # the cache follows every row
+            self.assertEqual(cache.get(progress_cache_key("progress-task", "processed")), 1)
+            reporter(1, 1, 0)
+        self.assertEqual(self._written(), (1, 1, 0))
+
+    def test_chunks_add_to_the_cached_counters(self):
+        with patch.object(PolicyholderConfig, "insuree_import_progress_cache", True):
+            first = ImportProgressReporter(self.batch_upload, incremental=True, every_rows=1000)
+            second = ImportProgressReporter(self.batch_upload, incremental=True, every_rows=1000)
+            first(2, 2, 0)
+            second(3, 1, 2)
+            first(4, 3, 1)
+            first.flush()
+            second.flush()
+
+        cached = [cache.get(progress_cache_key("progress-task", name)) for name in PROGRESS_CACHE_COUNTERS]
+        self.assertEqual(cached, [7, 4, 3])
+        self.assertEqual(self._written(), (7, 4, 3))
+
+    def test_failed_flush_is_retried(self):
+        reporter = ImportProgressReporter(self.batch_upload, every_rows=1000)
+        reporter(2, 1, 1)
+        with patch.object(self.batch_upload, "update_progress", side_effect=DatabaseError("locked")):
+            reporter.flush()
+        self.assertEqual(self._written(), (0, 0, 0))
+
+        # the import failed, its task flushes once more
+        reporter.flush()
+        self.assertEqual(self._written(), (2, 1, 1))
+
+
+@override_settings(CACHES={
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "import-outbox-tests"}
+})
+class ImportOutboxTest(TestCase):
+    """
+    Class to check the delivery and retries of the import side effects.
+    """
+
+    def setUp(self):
+        cache.clear()
+
+    def _entry(self, **values):
+        values.setdefault("available_at", timezone.now())
+        return PolicyHolderInsureeImportOutbox.objects.create(target=OutboxTarget.NOTIFICATION, **values)
+
+    def test_claim_marks_ready_entries_processing(self):
+        ready = self._entry()
+        waiting = self._entry(available_at=timezone.now() + timedelta(hours=1))
+
+        claimed = claim_outbox_entries(OutboxTarget.NOTIFICATION, 10)
+        self.assertEqual([entry.id for entry in claimed], [ready.id])
+        self.assertEqual((claimed[0].status, claimed[0].attempts), (OutboxStatus.PROCESSING, 1))
+        self.assertEqual(claim_outbox_entries(OutboxTarget.NOTIFICATION, 10), [])
+        waiting.refresh_from_db()
+        self.assertEqual(waiting.status, OutboxStatus.PENDING)
+
+    def test_drain_delivers_entries(self):
+        entries = [self._entry() for _ in range(3)]
+        delivered = []
+        with patch.dict(OUTBOX_HANDLERS, {OutboxTarget.NOTIFICATION: delivered.append}):
+            self.assertEqual(drain_outbox_target(OutboxTarget.NOTIFICATION, batch_size=2), (3, 0))
+
+        self.assertEqual(sorted(entry.id for entry in delivered), sorted(entry.id for entry in entries))
+        self.assertFalse(PolicyHolderInsureeImportOutbox.objects.exclude(status=OutboxStatus.DONE).exists())
+
+    def test_failures_back_off_then_fail(self):
+        entry = self._entry()
+
+        def unavailable(entry):
+            raise ConnectionError("CAMU down")
+
+        with patch.dict(OUTBOX_HANDLERS, {OutboxTarget.NOTIFICATION: unavailable}), \
+                patch.object(PolicyholderConfig, "insuree_import_outbox_max_attempts", 3), \
+                patch.object(PolicyholderConfig, "insuree_import_outbox_retry_delay", 60):
+            for attempt, delay in ((1, 60), (2, 120)):
+                started = timezone.now()
+                self.assertEqual(drain_outbox_target(OutboxTarget.NOTIFICATION), (0, 1))
+                entry.refresh_from_db()
+                self.assertEqual((entry.status, entry.attempts), (OutboxStatus.PENDING, attempt))
+                self.assertGreaterEqual(entry.available_at, started + timedelta(seconds=delay))
+                self.assertEqual(get_next_outbox_retry(OutboxTarget.NOTIFICATION), entry.available_at)
+                # not retried before its time
+                self.assertEqual(drain_outbox_target(OutboxTarget.NOTIFICATION), (0, 0))
+                PolicyHolderInsureeImportOutbox.objects.filter(id=entry.id).update(available_at=timezone.now())
+
+            self.assertEqual(drain_outbox_target(OutboxTarget.NOTIFICATION), (0, 1))
+        entry.refresh_from_db()
+        self.assertEqual((entry.status, entry.last_error), (OutboxStatus.FAILED, "CAMU down"))
+
+    def test_one_scheduled_retry_per_target(self):
+        retry_at = timezone.now() + timedelta(minutes=5)
+
+        self.assertTrue(schedule_outbox_retry(OutboxTarget.NOTIFICATION, retry_at))
+        # the other drains of the target leave it to the scheduled one
+        self.assertFalse(schedule_outbox_retry(OutboxTarget.NOTIFICATION, retry_at))
+        self.assertFalse(schedule_outbox_retry(OutboxTarget.NOTIFICATION, retry_at + timedelta(minutes=1)))
+        self.assertTrue(schedule_outbox_retry(OutboxTarget.EMAIL, retry_at))
+        # an earlier retry is not kept waiting
+        self.assertTrue(schedule_outbox_retry(OutboxTarget.NOTIFICATION, retry_at - timedelta(minutes=4)))
+
+        clear_outbox_retry(OutboxTarget.NOTIFICATION)
+        self.assertTrue(schedule_outbox_retry(OutboxTarget.NOTIFICATION, retry_at))
+
+
+class ImportTransactionChunksTest(TestCase):
+    """
+    Class to check that imports commit their rows by chunks.
+    """
+
+    def test_begin_counts_rows_of_the_open_transaction(self):
+        with ImportTransactionChunks(2) as chunks:
+            chunks.begin()
+            self.assertFalse(chunks.full)
+            chunks.begin()
+            self.assertTrue(chunks.full)
+            self.assertTrue(chunks.commit())
+            self.assertFalse(chunks.commit())
+            chunks.begin()
+            self.assertTrue(chunks.active)
+        self.assertFalse(chunks.active)
+
+    def test_size_zero_has_no_row_limit(self):
+        with ImportTransactionChunks(0) as chunks:
+            for _ in range(3):
+                chunks.begin()
+            self.assertTrue(chunks.active)
+            self.assertFalse(chunks.full)
+            self.assertTrue(chunks.commit())
+
+    def test_size_none_keeps_autocommit(self):
+        with ImportTransactionChunks(None) as chunks:
+            chunks.begin()
+            self.assertFalse(chunks.active)
+            self.assertFalse(chunks.commit())
+
+    def test_batch_of_rows_commits_with_its_checkpoint(self):
+        policyholder, cpb, rows = _create_delete_rows(3)
+        batch_upload = PolicyHolderInsureeBatchUpload.objects.create(
+            policy_holder=policyholder, input_file_name="import.xlsx"
+        )
+
+        class CrashingCheckpointer(ImportCheckpointer):
+            def checkpoint(self, end_row, results_data, success_count, error_count):
+                if end_row == 3:
+                    raise RuntimeError("worker lost")
+                super().checkpoint(end_row, results_data, success_count, error_count)
+
+        # no row limit: the lookup batch of the three rows is the transaction
+        with patch.object(PolicyholderConfig, "insuree_import_transaction_rows", 0):
+            with self.assertRaises(RuntimeError):
+                process_insuree_import_rows(
+                    rows, _get_test_user(), policyholder, cpb, sink=CrashingCheckpointer(batch_upload, 0)
+                )
+
+        self.assertEqual(get_pending_row_ranges(batch_upload, 3), [(0, 3)])
+        self.assertFalse(PolicyHolderInsuree.objects.filter(policy_holder=policyholder, is_deleted=True).exists())
+
+    def test_progress_is_written_while_importing(self):
+        policyholder, cpb, rows = _create_delete_rows(3)
+        batch_upload = PolicyHolderInsureeBatchUpload.objects.create(
+            policy_holder=policyholder, input_file_name="import.xlsx"
+        )
+        reporter = ImportProgressReporter(batch_upload, every_rows=1)
+        written = []
+
+        def progress(processed_rows, success_count, error_count):
+            reporter(processed_rows, success_count, error_count)
+            written.append(PolicyHolderInsureeBatchUpload.objects.get(id=batch_upload.id).processed_rows)
+
+        with patch.object(PolicyholderConfig, "insuree_import_transaction_rows", 1):
+            process_insuree_import_rows(rows, _get_test_user(), policyholder, cpb, progress_callback=progress)
+
+        # written between the transactions, not only once the import is over
+        self.assertTrue(any(written[:-1]))
+        self.assertEqual(written[-1], 3)
+
+    def test_crash_rolls_back_rows_with_their_checkpoint(self):
+        policyholder, cpb, rows = _create_delete_rows(3)
+        batch_upload = PolicyHolderInsureeBatchUpload.objects.create(
+            policy_holder=policyholder, input_file_name="import.xlsx"
+        )
+
+        class CrashingCheckpointer(ImportCheckpointer):
+            def checkpoint(self, end_row, results_data, success_count, error_count):
+                if end_row == 2:
+                    raise RuntimeError("worker lost")
+                super().checkpoint(end_row, results_data, success_count, error_count)
+
+        with patch.object(PolicyholderConfig, "insuree_import_transaction_rows", 1):
+            with self.assertRaises(RuntimeError):
+                process_insuree_import_rows(
+                    rows, _get_test_user(), policyholder, cpb, sink=CrashingCheckpointer(batch_upload, 0)
+                )
+
+        # the first row and its checkpoint are committed, the second row went with its checkpoint
+        self.assertEqual(get_pending_row_ranges(batch_upload, 3), [(1, 3)])
+        deleted = PolicyHolderInsuree.objects.filter(
+            policy_holder=policyholder, is_deleted=True
+        ).values_list("insuree__chf_id", flat=True)
+        self.assertEqual(list(deleted), [rows[0][1][HEADER_INSUREE_ID]])
@@ -7,6 +7,8 @@ urlpatterns = [
     path("imports/<str:policyholder_code>/policyholderinsurees/v2", views.import_policyholder_insurees),
     path("active-insuree-task/<str:policyholder_code>", views.check_active_insuree_import_task),
     path("<str:policyholder_code>/insuree-import-report/<str:task_id>/", views.download_insuree_import_report),
+    path("<str:policyholder_code>/insuree-import-results/<str:task_id>/", views.list_insuree_import_results),
+    path("<str:policyholder_code>/insuree-import-progress/<str:task_id>/", views.stream_insuree_import_progress),
     path("export/<policy_holder_code>/policyholderinsurees", views.export_phi),
     path("export/notdeclaredpolicyholder", views.not_declared_policy_holder),
     path("not-declared-ph/", views.not_declared_ph_rest),
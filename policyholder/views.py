@@ -1,12 +1,10 @@
 import calendar
-import io
+import itertools
 import json
 import logging
 import math
 import re
-import hashlib
-import tempfile
-import os
+import uuid
 from datetime import datetime, timedelta
 from decimal import Decimal, InvalidOperation
 
@@ -15,7 +13,7 @@ from django.conf import settings
 from django.contrib.auth.tokens import default_token_generator
 from django.core.mail import EmailMessage
 from django.db.models import Sum
-from django.http import HttpResponse, JsonResponse
+from django.http import FileResponse, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import redirect
 from django.utils import timezone
 from django.utils.dateparse import parse_date
@@ -25,22 +23,20 @@ from graphql import GraphQLError
 
 from contract.models import Contract
 from contract.services import Contract as ContractService
-from contract.utils import map_enrolment_type_to_category
 from contribution_plan.models import ContributionPlan, ContributionPlanBundleDetails
 from core.constants import *
 from core.models import Banks, InteractiveUser, Role
-from core.notification_service import base64_encode, create_camu_notification
+from core.notification_service import base64_encode
 from dateutil.relativedelta import relativedelta
-from insuree.dms_utils import send_mail_to_temp_insuree_with_pdf
 from insuree.models import Gender, Insuree, InsureePolicy
 from location.models import Location
 from payment.models import Payment, PaymentPenaltyAndSanction
 from payment.views import get_payment_product_config
 from policy.models import Policy
-from rest_framework.decorators import api_view, authentication_classes, permission_classes
+from rest_framework.decorators import api_view, authentication_classes, permission_classes, renderer_classes
 from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.renderers import BaseRenderer, JSONRenderer
 from rest_framework.response import Response
-from rest_api.lib.file_bucket import upload_file_to_s3_bucket
 
 from policyholder.apps import PolicyholderConfig
 from policyholder.constants import (
@@ -48,7 +44,6 @@ from policyholder.constants import (
     PH_STATUS_LOCKED,
     TIPL_PAYMENT_METHOD_ID,
 )
-from policyholder.dms_utils import validate_enrolment_type
 from policyholder.models import (
     CategoryChange,
     PolicyHolder,
@@ -56,37 +51,47 @@ from policyholder.models import (
     PolicyHolderInsuree,
     PolicyHolderUser,
     PolicyHolderInsureeBatchUpload,
-    PolicyHolderInsureeUploadedFile
+    PolicyHolderInsureeImportResult,
+)
+from policyholder.tasks import (
+    dispatch_import_outbox_on_commit,
+    schedule_insuree_imports,
+    sync_policyholders_to_erp,
+)
+from policyholder.import_engine import (
+    InlineXlsxReportSink,
+    get_import_contribution_plan_bundle,
+    process_insuree_import_rows,
+)
+from policyholder.import_progress import (
+    PROGRESS_FINAL_STATUSES,
+    get_cached_progress,
+    get_progress_event_id,
+    iter_cached_progress,
+    set_cached_progress_info,
+    wait_for_cached_progress,
+)
+from policyholder.import_scheduler import get_import_lane
+from policyholder.import_report import REPORT_FILE_NAME, get_import_report_file
+from policyholder.import_results import (
+    IMPORT_RESULTS_MAX_PAGE_SIZE,
+    get_import_results_page,
+    has_import_results,
+)
+from policyholder.import_handoff import build_import_file_handoff, release_import_file_handoff
+from policyholder.import_storage import (
+    find_completed_import,
+    install_hashing_upload_handler,
+    spooled_upload,
+    store_import_file,
 )
-from policyholder.tasks import sync_policyholders_to_erp, import_policyholder_insurees_async
 
 from policyholder.import_utils import (
-    clean_line,
-    get_village_from_line,
-    get_or_create_family_from_line,
-    get_or_create_insuree_from_line,
-    validating_insuree_on_name_dob,
-    soft_delete_insuree,
     check_for_category_change_request,
     get_policy_holder_from_code,
     mapping_marital_status,
-    HEADER_INSUREE_CAMU_NO,
-    HEADER_FAMILY_LOCATION_CODE,
-    HEADER_INSUREE_OTHER_NAMES,
-    HEADER_INSUREE_LAST_NAME,
-    HEADER_INSUREE_DOB,
-    HEADER_BIRTH_LOCATION_CODE,
-    HEADER_INSUREE_GENDER,
-    HEADER_CIVILITY,
-    HEADER_PHONE,
-    HEADER_ADDRESS,
-    HEADER_INSUREE_ID,
-    HEADER_EMAIL,
-    HEADER_INCOME,
-    HEADER_EMPLOYER_NUMBER,
-    HEADER_DELETE,
-    MINIMUM_AGE_LIMIT,
-    MINIMUM_AGE_LIMIT_FOR_STUDENTS
+    iter_import_rows,
+    read_import_columns,
 )
 
 logger = logging.getLogger(__name__)
@@ -135,10 +140,14 @@ def validate_line(line):
     ]
 )
 def import_phi(request, policy_holder_code):
+    """
+    Synchronous import answering with the xlsx report of the rows.
+    Files of more than insuree_import_sync_max_rows rows are handed over to the
+    asynchronous import instead (202, same answer as the v2 upload endpoint).
+    With ``dry_run`` the rows are only validated, nothing is imported.
+    """
     file = request.FILES["file"]
     user_id = request.user.id_for_audit
-    core_user_id = request.user.id
-    user_obj = request.user 
 
     logger.info("User (audit id %s) requested import of PolicyHolderInsurees", user_id)
 
@@ -146,317 +155,54 @@ def import_phi(request, policy_holder_code):
     if not policy_holder:
         return JsonResponse({"errors": f"Unknown policy holder ({policy_holder_code})"})
 
-    total_lines = 0
-    total_insurees_created = 0
-    total_families_created = 0
-    total_phi_created = 0
-    total_phi_updated = 0
-    total_locations_not_found = 0
-    total_contribution_plan_not_found = 0
-    total_validation_errors = 0
-
-    df = pd.read_excel(file)
-    df.columns = [col.strip() for col in df.columns]
-    org_columns = df.columns
-    # Renaming the headers
-    rename_columns = {
-        "Numéro CAMU": HEADER_INSUREE_CAMU_NO,
-        "Prénom": HEADER_INSUREE_OTHER_NAMES,
-        "Nom": HEADER_INSUREE_LAST_NAME,
-        "Numéro CAMU temporaire": HEADER_INSUREE_ID,
-        "Date de naissance": HEADER_INSUREE_DOB,
-        "Lieu de naissance": HEADER_BIRTH_LOCATION_CODE,
-        "Sexe": HEADER_INSUREE_GENDER,
-        "Civilité": HEADER_CIVILITY,
-        "Téléphone": HEADER_PHONE,
-        "Adresse": HEADER_ADDRESS,
-        "Village": HEADER_FAMILY_LOCATION_CODE,
-        "Email": HEADER_EMAIL,
-        "Supprimé": HEADER_DELETE,
-    }
-
-    df.rename(columns=rename_columns, inplace=True)
-    errors = []
-    logger.debug("Importing %s lines", len(df))
-
-    # For output excel with error and success message
-    output = io.BytesIO()
-    writer = pd.ExcelWriter(output, engine="xlsxwriter")
-    processed_data = pd.DataFrame()
-
-    for index, line in df.iterrows():  # for each line in the Excel file
-        total_lines += 1
-        clean_line(line)
-        # List of possible date formats to try
-        date_formats = [
-            "%Y-%m-%d",
-            "%m/%d/%Y",
-            "%d/%m/%Y",
-        ]  # Add more formats as needed
-
-        dob_value = line[HEADER_INSUREE_DOB]
-
-        ph_cpb = PolicyHolderContributionPlan.objects.filter(
-            policy_holder=policy_holder, is_deleted=False
-        ).first()
-
-        if not ph_cpb:
-            error = f"Pas de plans de cotisation avec ({policy_holder.trade_name})"
-            errors.append(error)
-            total_contribution_plan_not_found += 1
-
-            # Adding error in output excel
-            row_data = line.tolist()
-            row_data.extend(["Échec", error])
-            processed_data = processed_data.append(
-                pd.Series(row_data), ignore_index=True
-            )
-            continue
-
-        cpb = ph_cpb.contribution_plan_bundle
-
-        if not cpb:
-            error = f"Contribution plan inconnu - {ph_cpb.contribution_plan_bundle}"
-            errors.append(error)
-            total_locations_not_found += 1
-
-            # Adding error in output excel
-            row_data = line.tolist()
-            row_data.extend(["Échec", error])
-            processed_data = processed_data.append(
-                pd.Series(row_data), ignore_index=True
+    dry_run = get_import_flag(request, "dry_run")
+    # only counted up to the threshold
+    max_rows = PolicyholderConfig.insuree_import_sync_max_rows
+    if sum(1 for _ in itertools.islice(iter_import_rows(file), max_rows + 1)) > max_rows:
+        with spooled_upload(file) as (file_path, file_hash):
+            batch_upload, queued = queue_insuree_import(
+                request.user, policy_holder, policy_holder_code, file, file_path, file_hash, dry_run=dry_run
             )
-            continue
-
-        enrolment_type = cpb.name
-
-        print(f"====> enrolment_type {enrolment_type} {cpb.code}")
-
-        # Set minimum age limit based on enrolment type
-        current_minimum_age = MINIMUM_AGE_LIMIT  # Default to global value
-        if cpb.code == "PSC05" or enrolment_type == "Etudiants":
-            current_minimum_age = MINIMUM_AGE_LIMIT_FOR_STUDENTS
-
-        # if not line.get(HEADER_INSUREE_ID) and line.get(HEADER_FAMILY_HEAD):
-        if not line.get(HEADER_INSUREE_ID) and not line.get(HEADER_INSUREE_CAMU_NO):
-            if isinstance(dob_value, datetime):
-                dob = dob_value
-            else:
-                dob = None
-                for date_format in date_formats:
-                    try:
-                        dob = datetime.strptime(dob_value, date_format)
-                        break  # If parsing succeeds, break out of the loop
-                    except ValueError:
-                        continue  # If parsing fails, try the next format
-
-                if dob is None:
-                    # If none of the formats match, handle the error
-                    error = f"Format de date invalide pour la date de naissance : {dob_value}"
-                    errors.append(error)
-                    total_validation_errors += 1
-                    # Adding error in output excel
-                    row_data = line.tolist()
-                    row_data.extend(["Échec", error])
-                    processed_data = processed_data.append(
-                        pd.Series(row_data), ignore_index=True
-                    )
-                    continue
-
-            age = (datetime.now().date() - dob.date()) // timedelta(
-                days=365.25
-            )  # Calculate age in years
-            if age < current_minimum_age:
-                error = f"L'assuré doit être âgé d'au moins {current_minimum_age} ans."
-                errors.append(error)
-                total_validation_errors += 1
-                row_data = line.tolist()
-                row_data.extend(["Échec", error])
-                processed_data = processed_data.append(
-                    pd.Series(row_data), ignore_index=True
-                )
-                continue
-
-            # Check if insuree with the same name and DOB already exists
-            insuree = validating_insuree_on_name_dob(line, policy_holder)
-            if insuree:
-                # Generate an error message instructing to add insuree forcibly
-                error = "Un assuré ayant le même nom et la même date de naissance existe déjà, veuillez ajouter son numéro CAMU ou numéro temporaire."
-                errors.append(error)
-                # Adding error in output excel
-                row_data = line.tolist()
-                row_data.extend(["Échec", error])
-                processed_data = processed_data.append(
-                    pd.Series(row_data), ignore_index=True
-                )
-                continue
-
-        if line[HEADER_DELETE] and line[HEADER_DELETE].lower() == "yes":
-            is_deleted = soft_delete_insuree(line, policy_holder_code, user_id)
-            if is_deleted:
-                continue
-
-        village = get_village_from_line(line)
-        if not village:
-            error = f"Village inconnu - {line[HEADER_FAMILY_LOCATION_CODE]}"
-            errors.append(error)
-            total_locations_not_found += 1
-            # Adding error in output excel
-            row_data = line.tolist()
-            row_data.extend(["Échec", error])
-            processed_data = processed_data.append(
-                pd.Series(row_data), ignore_index=True
-            )
-            continue
-
-        is_valid_enrolment = validate_enrolment_type(line, enrolment_type)
-        if not is_valid_enrolment:
-            error = "Le type d'enrôlement doit être différent de 'étudiant."
-            row_data = line.tolist()
-            row_data.extend(["Échec", error])
-            processed_data = processed_data.append(
-                pd.Series(row_data), ignore_index=True
-            )
-            continue
-
-        insuree, error = get_or_create_insuree_from_line(
-            line,
-            village,
-            user_id,
-            user_obj, 
-            core_user_id,
-            enrolment_type,
-        )
-        logger.debug("insuree_created: %s", insuree)
-
-        if error:
-            row_data = line.tolist()
-            row_data.extend(["Échec", error])
-            processed_data = processed_data.append(
-                pd.Series(row_data), ignore_index=True
-            )
-            continue
-
-        total_insurees_created += 1
-
-        family, family_created = get_or_create_family_from_line(
-            line, user_id, enrolment_type, insuree, village
+        logger.info(
+            f"Policyholder insuree import of more than {max_rows} rows handed over to the async import: "
+            f"batch_upload_id={batch_upload.id}"
         )
-
-        if not family:
-            # Adding error in output excel
-            error = "Impossible de créer ou de trouver la famille."
-            row_data = line.tolist()
-            row_data.extend(["Échec", error])
-            processed_data = processed_data.append(
-                pd.Series(row_data), ignore_index=True
-            )
-            continue
-
-        print(f"====> family {family.id} {family.uuid}")
-
-        check_for_category_change_request(
-            request.user, line, policy_holder, enrolment_type
+        return JsonResponse(
+            {
+                "success": True,
+                "message": "Import queued" if queued else "Import started",
+                "task_id": batch_upload.celery_task_id,
+                "batch_upload_id": str(batch_upload.id),
+                "queued": queued,
+                "dry_run": dry_run,
+                "progress_url": f"/api/policyholder/{policy_holder_code}/insuree-import-progress/"
+                f"{batch_upload.celery_task_id}/",
+            },
+            status=202,
         )
-        # if is_cc_request:
-        #     row_data = line.tolist()
-        #     row_data.extend(["Réussite", "Demande de changement de catégorie Créé."])
-        #     processed_data = processed_data.append(
-        #         pd.Series(row_data), ignore_index=True
-        #     )
-
-        total_families_created += 1
-
-        phi_json_ext = {}
-
-        employer_number = None
-
-        phi = PolicyHolderInsuree.objects.filter(
-            insuree=insuree, policy_holder=policy_holder
-        ).first()
-
-        if phi:
-            print(
-                f"====> already policyHolder insuree {insuree.id} {policy_holder.id} exists"
-            )
-            phi._state.adding = True
-            if (
-                phi.contribution_plan_bundle != cpb
-                or phi.employer_number != employer_number
-                or phi.json_ext != phi_json_ext
-            ):
-                phi.contribution_plan_bundle = cpb
-                phi.employer_number = employer_number
-                phi.json_ext = phi_json_ext
-                phi.save(username=request.user.username)
-                total_phi_updated += 1
-        else:
-            phi = PolicyHolderInsuree(
-                insuree=insuree,
-                policy_holder=policy_holder,
-                contribution_plan_bundle=cpb,
-                json_ext=phi_json_ext,
-                employer_number=employer_number,
-            )
-            total_phi_created += 1
-            phi.save(username=request.user.username)
-
-            print(f"=====> create policyHolder insuree {insuree.id} {policy_holder.id}")
 
-            # row_data = line.tolist()
-            # row_data.extend(
-            #     ["Réussite", "L'assuré a été bien rattaché au souscripteur"]
-            # )
-            # processed_data = processed_data.append(
-            #     pd.Series(row_data), ignore_index=True
-            # )
-
-        try:
-            create_camu_notification(INS_ADDED_NT, phi)
-
-        except Exception as e:
-            logger.error(
-                f"Failed to create CAMU notification with with INS_ADDED_NT : {e}"
-            )
-
-        # Adding success entry in output Excel
-        row_data = line.tolist()
-        row_data.extend(["Réussite", "L'assuré a été bien rattaché au souscripteur"])
-        processed_data = processed_data.append(pd.Series(row_data), ignore_index=True)
-
-        try:
-            logger.info("---------------   if insuree have email   -------------------")
-            if insuree.email:
-                insuree_enrolment_type = insuree.json_ext[
-                    "insureeEnrolmentType"
-                ].lower()
-                send_mail_to_temp_insuree_with_pdf(insuree, insuree_enrolment_type)
-                logger.info("---------------  email is sent   -------------------")
-        except Exception as e:
-            logger.error(f"Fail to send auto mail : {e}")
-
-    # Set the appropriate status code based on the type of errors encountered
-    status_code = 200  # Default success status
-
-    if total_locations_not_found > 0:
-        status_code = 417  # Expectation Failed for unknown village
-    elif total_contribution_plan_not_found > 0:
-        status_code = 404  # Not Found for contribution plan issues
-    elif total_validation_errors > 0:
-        status_code = 422  # Unprocessable Entity for general validation errors
-
-    # Generate output Excel
-    output_headers = list(org_columns) + ["Status", "Reason"]
-    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-        processed_data.to_excel(
-            writer, sheet_name="Processed Data", index=False, header=output_headers
+    try:
+        cpb = get_import_contribution_plan_bundle(policy_holder)
+    except Exception:
+        return JsonResponse(
+            {"errors": f"Pas de plans de cotisation avec ({policy_holder.trade_name})"}, status=404
         )
+    if not cpb:
+        return JsonResponse({"errors": "Contribution plan inconnu"}, status=404)
+
+    logger.debug("Importing lines of %s", file.name)
+    # Rows are streamed from the workbook, columns keep the sheet order for the output
+    report = InlineXlsxReportSink(read_import_columns(file))
+    process_insuree_import_rows(
+        iter_import_rows(file), request.user, policy_holder, cpb, sink=report, dry_run=dry_run
+    )
+    if not dry_run:
+        dispatch_import_outbox_on_commit()
 
-    output.seek(0)
     response = HttpResponse(
-        output.getvalue(),
+        report.render(),
         content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        status=status_code,
+        status=report.get_status_code(),
     )
     response["Content-Disposition"] = "attachment; filename=import_results.xlsx"
     return response
@@ -872,25 +618,6 @@ class LocationEncoder(json.JSONEncoder):
 #         return None
 
 
-def mapping_marital_status(marital, value=None):
-    mapping = {
-        "Veuf\/veuve": "W",
-        "Célibataire": "S",
-        "Divorcé": "D",
-        "Marié": "M",
-    }
-    if value and marital is None:
-        logger.info(
-            "mapping_marital_status passing value : ",
-            list(mapping.keys())[list(mapping.values()).index(value)],
-        )
-        return list(mapping.keys())[list(mapping.values()).index(value)]
-    elif marital in mapping:
-        return mapping[marital]
-    else:
-        """"""
-
-
 def get_city(location_id):
     try:
         location = Location.objects.get(id=location_id)
@@ -1191,95 +918,6 @@ def create_dependent_category_change(
     )
 
 
-def check_for_category_change_request(user, line, policy_holder, enrolment_type):
-    try:
-        insuree_id = line.get(HEADER_INSUREE_ID, "")
-        camu_num = line.get(HEADER_INSUREE_CAMU_NO, "")
-        income = line.get(HEADER_INCOME, "")
-        employer_number = line.get(HEADER_EMPLOYER_NUMBER, "")
-        insuree = None
-
-        if insuree_id:
-            insuree = Insuree.objects.filter(
-                validity_to__isnull=True, chf_id=insuree_id
-            ).first()
-
-        if not insuree and camu_num:
-            insuree = Insuree.objects.filter(
-                validity_to__isnull=True, camu_number=camu_num
-            ).first()
-
-        if insuree:
-            new_category = map_enrolment_type_to_category(enrolment_type)
-            code = request_number_cc()
-            old_category = insuree.json_ext.get("insureeEnrolmentType", "")
-            if code:
-                if insuree.family:
-                    if insuree.head:
-                        if new_category != old_category:
-                            # Check if there's an existing category change request
-                            existing_request = CategoryChange.objects.filter(
-                                insuree=insuree,
-                                status__in=[
-                                    CC_PENDING,
-                                    CC_WAITING_FOR_DOCUMENT,
-                                    CC_PROCESSING,
-                                    CC_WAITING_FOR_APPROVAL,
-                                ],
-                            ).first()
-
-                            if not existing_request:
-                                create_dependent_category_change(
-                                    user,
-                                    code,
-                                    insuree,
-                                    old_category,
-                                    new_category,
-                                    policy_holder,
-                                    "SELF_HEAD_REQ",
-                                    CC_WAITING_FOR_DOCUMENT,
-                                    income,
-                                    employer_number,
-                                )
-                            return True
-                        else:
-                            return False
-                    else:
-                        create_dependent_category_change(
-                            user,
-                            code,
-                            insuree,
-                            old_category,
-                            new_category,
-                            policy_holder,
-                            "DEPENDENT_REQ",
-                            CC_WAITING_FOR_DOCUMENT,
-                            income,
-                            employer_number,
-                        )
-                        if new_category == "students":
-                            send_notification_to_head(insuree)
-                        return True
-                else:
-                    create_dependent_category_change(
-                        user,
-                        code,
-                        insuree,
-                        old_category,
-                        new_category,
-                        policy_holder,
-                        "INDIVIDUAL_REQ",
-                        CC_WAITING_FOR_DOCUMENT,
-                        income,
-                        employer_number,
-                    )
-                    return True
-        return False
-    except Exception as e:
-        logger.info("Error in check_for_category_change_request:", e)
-        return False
-
-
 def manuall_check_for_category_change_request(
     user, insuree_id, policyholder_id, income, employer_number
 ):
@@ -2095,6 +1733,62 @@ def verify_user_and_update_password(request):
     return JsonResponse({"message": "Policyholders sync started"}, status=200)
 
 
+def get_import_flag(request, name):
+    """Boolean form field or query parameter of an import request (1, true or yes)."""
+    value = request.data.get(name) or request.GET.get(name) or ""
+    return str(value).lower() in ("1", "true", "yes")
+
+
+def queue_insuree_import(user, policyholder, policyholder_code, uploaded_file, file_path, file_hash, dry_run=False):
+    """
+    Store the upload spooled at ``file_path`` and queue its asynchronous import,
+    only validating the rows with ``dry_run``.
+    Returns (batch upload, whether it waits behind another import).
+    """
+    uploaded_file_record = store_import_file(policyholder, file_path, uploaded_file.name, file_hash)
+    # lets the worker read the file without fetching it from the storage
+    file_handoff = build_import_file_handoff(file_path, uploaded_file.name, uploaded_file.size)
+
+    # the task id is known before the import leaves the queue
+    task_id = str(uuid.uuid4())
+    batch_upload = PolicyHolderInsureeBatchUpload.objects.create(
+        policy_holder=policyholder,
+        input_file_name=uploaded_file.name,
+        status=PolicyHolderInsureeBatchUpload.Status.PENDING,
+        created_by=user,
+        uploaded_file=uploaded_file_record,
+        celery_task_id=task_id,
+        lane=get_import_lane(uploaded_file.size),
+        dry_run=dry_run,
+    )
+    # progress streams can follow the import before the worker picks it up
+    set_cached_progress_info(
+        task_id,
+        status=batch_upload.status,
+        total=0,
+        policyholder_code=policyholder_code,
+        created_at=batch_upload.created_at.isoformat(),
+        dry_run=dry_run,
+    )
+
+    logger.info(
+        f"Policyholder insuree import started: policyholder_code={policyholder_code}, batch_upload_id={batch_upload.id}"
+    )
+
+    # waits while another import of the policyholder is running, see import_scheduler
+    dispatched = schedule_insuree_imports({str(batch_upload.id): file_handoff})
+    queued = str(batch_upload.id) not in dispatched
+    if queued:
+        # read from the storage once its turn comes
+        release_import_file_handoff(file_handoff)
+
+    logger.info(
+        f"Policyholder insuree import {'queued' if queued else 'dispatched'}: "
+        f"task_id={task_id}, batch_upload_id={batch_upload.id}"
+    )
+    return batch_upload, queued
+
+
 @api_view(["POST"])
 @permission_classes(
     [
@@ -2107,6 +1801,8 @@ def import_policyholder_insurees(request, policyholder_code):
     """
     Async upload endpoint for policyholder insuree import.
     """
+    # before request.FILES is parsed
+    hashing_handler = install_hashing_upload_handler(request._request)
 
     try:
         policyholder = get_policy_holder_from_code(policyholder_code)
@@ -2131,75 +1827,46 @@ def import_policyholder_insurees(request, policyholder_code):
                 status=400,
             )
 
-        file_data = uploaded_file.read()
-        file_hash = hashlib.sha256(file_data).hexdigest()
-
-        app_env = os.environ.get("APP_ENV", "dev")
-        object_key = f"{app_env}/{policyholder.uuid}/{uploaded_file.name}"
-        uploaded_file_record = PolicyHolderInsureeUploadedFile.objects.filter(
-            file_name_hash=file_hash, policy_holder=policyholder
-        ).first()
-
-        if uploaded_file_record:
-            PolicyHolderInsureeUploadedFile.objects.filter(
-                id=uploaded_file_record.id
-            ).update(
-                policy_holder=policyholder,
-                file_name_hash=file_hash,
-                file_path=object_key,
-            )
-        else:
-            uploaded_file_record = PolicyHolderInsureeUploadedFile.objects.create(
-                policy_holder=policyholder, file_name_hash=file_hash, file_path=object_key
-            )
-
-        with tempfile.NamedTemporaryFile(
-            delete=False, suffix=os.path.splitext(uploaded_file.name)[1]
-        ) as temp_file:
-            temp_file.write(file_data)
-            temp_file_path = temp_file.name
+        # hashed while received when the handler could be installed, never read in memory
+        file_hash = hashing_handler.hashes.get("file") if hashing_handler else None
+        with spooled_upload(uploaded_file, file_hash) as (file_path, file_hash):
+            # the same file was already imported: answer with its report
+            dry_run = get_import_flag(request, "dry_run")
+            reimport = dry_run or get_import_flag(request, "reimport")
+            completed_import = find_completed_import(policyholder, file_hash, reimport=reimport)
+            if completed_import:
+                logger.info(
+                    f"Policyholder insuree import skipped, file already imported: "
+                    f"policyholder_code={policyholder_code}, batch_upload_id={completed_import.id}"
+                )
+                return JsonResponse(
+                    {
+                        "success": True,
+                        "message": "File already imported",
+                        "already_imported": True,
+                        "task_id": completed_import.celery_task_id,
+                        "batch_upload_id": str(completed_import.id),
+                        "completed_at": completed_import.completed_at.isoformat()
+                        if completed_import.completed_at else None,
+                        "success_count": completed_import.success_count,
+                        "error_count": completed_import.error_count,
+                        "download_url": f"/api/policyholder/{policyholder_code}/insuree-import-report/"
+                        f"{completed_import.celery_task_id}/",
+                    }
+                )
 
-        try:
-            upload_file_to_s3_bucket(
-                file_path=temp_file_path,
-                object_key=object_key,
-                key_prefix="policyholder",
+            batch_upload, queued = queue_insuree_import(
+                request.user, policyholder, policyholder_code, uploaded_file, file_path, file_hash, dry_run=dry_run
             )
-        finally:
-            if os.path.exists(temp_file_path):
-                os.unlink(temp_file_path)
-
-        batch_upload = PolicyHolderInsureeBatchUpload.objects.create(
-            policy_holder=policyholder,
-            input_file_name=uploaded_file.name,
-            status=PolicyHolderInsureeBatchUpload.Status.PENDING,
-            created_by=request.user,
-        )
-
-        logger.info(
-            f"Policyholder insuree import started: policyholder_code={policyholder_code}, batch_upload_id={batch_upload.id}"
-        )
-
-        task = import_policyholder_insurees_async.delay(
-            user_id=request.user.id,
-            policyholder_code=policyholder_code,
-            batch_upload_id=str(batch_upload.id),
-            uploaded_file_record_id=str(uploaded_file_record.id),
-        )
-
-        batch_upload.celery_task_id = task.id
-        batch_upload.save(update_fields=["celery_task_id"])
-
-        logger.info(
-            f"Policyholder insuree import started: task_id={task.id}, batch_upload_id={batch_upload.id}"
-        )
 
         return JsonResponse(
             {
                 "success": True,
-                "message": "Import started",
-                "task_id": task.id,
+                "message": "Import queued" if queued else "Import started",
+                "task_id": batch_upload.celery_task_id,
                 "batch_upload_id": str(batch_upload.id),
+                "queued": queued,
+                "dry_run": dry_run,
             }
         )
 
@@ -2210,6 +1877,50 @@ def import_policyholder_insurees(request, policyholder_code):
         )
 
 
+def build_response_data_from_cached_progress(progress, task_id, policyholder_code=None):
+    total = progress.get("total") or 0
+    ready = progress.get("status") in PROGRESS_FINAL_STATUSES
+    response_data = {
+        "has_active_task": not ready,
+        "task_id": task_id,
+        "status": progress.get("status"),
+        "total": total,
+        "processed": progress["processed"],
+        "percent": int((progress["processed"] / total) * 100) if total else 0,
+        "success_count": progress["success_count"],
+        "error_count": progress["error_count"],
+        "ready": ready,
+        "successful": progress.get("status") == PolicyHolderInsureeBatchUpload.Status.COMPLETED,
+        "error_message": progress.get("error_message"),
+        "created_at": progress.get("created_at"),
+        "started_at": progress.get("started_at"),
+        "stage_timings": progress.get("stage_timings"),
+        "dry_run": progress.get("dry_run", False),
+    }
+
+    if progress.get("completed_at"):
+        response_data["completed_at"] = progress["completed_at"]
+
+    # every processed row has a result
+    if ready and progress["processed"] and policyholder_code:
+        response_data["download_url"] = (
+            f"/api/policyholder/{policyholder_code}/insuree-import-report/{task_id}/"
+        )
+        response_data["results_url"] = (
+            f"/api/policyholder/{policyholder_code}/insuree-import-results/{task_id}/"
+        )
+
+    return response_data
+
+
+def get_cached_import_progress(policyholder_code, task_id):
+    """Cached progress of the import ``task_id`` of the policyholder, None when not cached."""
+    progress = get_cached_progress(task_id)
+    if progress and progress.get("policyholder_code") == policyholder_code:
+        return progress
+    return None
+
+
 def build_response_data_check_active_insuree_task(task, is_active, policyholder_code, task_id):
     if is_active is False and not task_id:
         return {
@@ -2232,15 +1943,20 @@ def build_response_data_check_active_insuree_task(task, is_active, policyholder_
         "error_message": task.error_message,
         "created_at": task.created_at.isoformat(),
         "started_at": task.started_at.isoformat() if task.started_at else None,
+        "stage_timings": task.stage_timings,
+        "dry_run": task.dry_run,
     }
 
     if task.completed_at:
         response_data["completed_at"] = task.completed_at.isoformat()
 
-    if task.results and task.results.get("results"):
+    if task.is_complete and has_import_results(task):
         response_data["download_url"] = (
             f"/api/policyholder/{policyholder_code}/insuree-import-report/{task.celery_task_id}/"
         )
+        response_data["results_url"] = (
+            f"/api/policyholder/{policyholder_code}/insuree-import-results/{task.celery_task_id}/"
+        )
 
     return response_data
 
@@ -2256,6 +1972,13 @@ def check_active_insuree_import_task(request, policyholder_code):
                 {"success": False, "message": "Policy holder not found"}, status=404
             )
 
+        # Imports are answered from the cached live counters and outcome when available
+        cached_progress = get_cached_import_progress(policyholder_code, task_id)
+        if cached_progress:
+            return JsonResponse(
+                build_response_data_from_cached_progress(cached_progress, task_id, policyholder_code)
+            )
+
         if task_id:
             specific_task = PolicyHolderInsureeBatchUpload.objects.filter(
                 policy_holder=policyholder,
@@ -2321,50 +2044,169 @@ def download_insuree_import_report(request, policyholder_code, task_id):
                 status=404,
             )
 
-        if not batch_upload.results or not batch_upload.results.get("results"):
+        # rendered once when the import finished, see import_report
+        report_path = get_import_report_file(batch_upload)
+        if not report_path:
             return JsonResponse(
                 {"success": False, "message": "Results not generated"}, status=404
             )
 
-        results_data = batch_upload.results["results"]
-
-        df = pd.DataFrame(results_data)
+        return FileResponse(
+            open(report_path, "rb"),
+            as_attachment=True,
+            filename=REPORT_FILE_NAME,
+            content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        )
 
-        column_order = ["ligne", "numero_camu", "nom", "prenom", "Etat", "remarque"]
-        french_column_names = {
-            "ligne": "Ligne",
-            "numero_camu": "Numéro CAMU",
-            "nom": "Nom",
-            "prenom": "Prénom",
-            "Etat": "État",
-            "remarque": "Remarque",
-        }
+    except Exception as e:
+        logger.error(f"Error in download_insuree_import_report: {str(e)}", exc_info=True)
+        return JsonResponse(
+            {"success": False, "message": f"Error downloading file: {str(e)}"},
+            status=500,
+        )
 
-        # SAFETY PATCH: Ensure all columns exist before selecting
-        for col in column_order:
-            if col not in df.columns:
-                df[col] = ""
+@api_view(["GET"])
+def list_insuree_import_results(request, policyholder_code, task_id):
+    """
+    One page of the row results of an import, in sheet order.
+    ``status`` (OK or KO) keeps only those rows, ``page`` and ``page_size`` paginate.
+    """
+    try:
+        policyholder = get_policy_holder_from_code(policyholder_code)
+        if not policyholder:
+            return JsonResponse(
+                {"success": False, "message": "Policy holder not found"}, status=404
+            )
 
-        df = df[column_order]
-        df = df.rename(columns=french_column_names)
+        batch_upload = PolicyHolderInsureeBatchUpload.objects.filter(
+            policy_holder=policyholder, celery_task_id=task_id
+        ).first()
+        if not batch_upload:
+            return JsonResponse(
+                {"success": False, "message": "Import not found"}, status=404
+            )
 
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-            df.to_excel(writer, index=False, sheet_name="Résultats")
-        output.seek(0)
+        status = request.GET.get("status") or None
+        if status and status not in PolicyHolderInsureeImportResult.Status.values:
+            return JsonResponse(
+                {"success": False, "message": "Invalid status, expected OK or KO"}, status=400
+            )
+        try:
+            page = max(1, int(request.GET.get("page", 1)))
+            page_size = max(1, min(int(request.GET.get("page_size", 100)), IMPORT_RESULTS_MAX_PAGE_SIZE))
+        except ValueError:
+            return JsonResponse(
+                {"success": False, "message": "Invalid page or page_size"}, status=400
+            )
 
-        response = HttpResponse(
-            output.getvalue(),
-            content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        results, count = get_import_results_page(batch_upload, status=status, page=page, page_size=page_size)
+        return JsonResponse(
+            {
+                "success": True,
+                "task_id": task_id,
+                "status": batch_upload.status,
+                "count": count,
+                "page": page,
+                "page_size": page_size,
+                "results": results,
+            }
         )
-        response["Content-Disposition"] = (
-            'attachment; filename="Rapport d\'importation des assurés.xlsx"'
+
+    except Exception as e:
+        logger.error(f"Error in list_insuree_import_results: {str(e)}", exc_info=True)
+        return JsonResponse(
+            {"success": False, "message": f"Error: {str(e)}"}, status=500
         )
-        return response
+
+
+class EventStreamRenderer(BaseRenderer):
+    """Lets DRF accept ``Accept: text/event-stream``, the events are streamed by the view."""
+
+    media_type = "text/event-stream"
+    format = "event-stream"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return data
+
+
+def format_progress_event(response_data, event_id):
+    return f"id: {event_id}\nevent: progress\ndata: {json.dumps(response_data)}\n\n"
+
+
+@api_view(["GET"])
+@renderer_classes([JSONRenderer, EventStreamRenderer])
+def stream_insuree_import_progress(request, policyholder_code, task_id):
+    """
+    Push channel of the progress of an import, fed by the counters the import
+    task's progress reporter caches (insuree_import_progress_cache).
+    With ``Accept: text/event-stream`` every change is sent as a Server-Sent
+    Event until the import finishes. Otherwise the request is a long poll,
+    answered as soon as the progress differs from ``last_event_id`` or after
+    ``wait`` seconds. Both hold the request, and a worker with the sync server,
+    for at most insuree_import_progress_stream_timeout seconds.
+    Imports without cached progress are answered once from the database.
+    """
+    try:
+        last_event_id = request.META.get("HTTP_LAST_EVENT_ID") or request.GET.get("last_event_id")
+        event_stream = "text/event-stream" in request.META.get("HTTP_ACCEPT", "")
+        timeout = PolicyholderConfig.insuree_import_progress_stream_timeout
+
+        policyholder = get_policy_holder_from_code(policyholder_code)
+        if not policyholder:
+            return JsonResponse(
+                {"success": False, "message": "Policy holder not found"}, status=404
+            )
+
+        cached_progress = get_cached_import_progress(policyholder_code, task_id)
+        if not cached_progress:
+            batch_upload = PolicyHolderInsureeBatchUpload.objects.filter(
+                policy_holder=policyholder, celery_task_id=task_id
+            ).first()
+            if not batch_upload:
+                return JsonResponse(
+                    {"success": False, "message": "Import not found"}, status=404
+                )
+            response_data = build_response_data_check_active_insuree_task(
+                task=batch_upload,
+                is_active=batch_upload.is_in_progress,
+                policyholder_code=policyholder_code,
+                task_id=task_id,
+            )
+            if event_stream:
+                return StreamingHttpResponse(
+                    iter([format_progress_event(response_data, "")]), content_type="text/event-stream"
+                )
+            return JsonResponse(response_data)
+
+        if event_stream:
+            def events():
+                # browsers reconnect after the timeout and send Last-Event-ID
+                yield f"retry: {int(PolicyholderConfig.insuree_import_progress_stream_interval * 1000)}\n\n"
+                for progress in iter_cached_progress(task_id, last_event_id, timeout):
+                    yield format_progress_event(
+                        build_response_data_from_cached_progress(progress, task_id, policyholder_code),
+                        get_progress_event_id(progress),
+                    )
+
+            response = StreamingHttpResponse(events(), content_type="text/event-stream")
+            response["Cache-Control"] = "no-cache"
+            # no buffering by nginx
+            response["X-Accel-Buffering"] = "no"
+            return response
+
+        try:
+            wait = max(0.0, min(float(request.GET.get("wait", timeout)), timeout))
+        except ValueError:
+            return JsonResponse(
+                {"success": False, "message": "Invalid wait"}, status=400
+            )
+        progress = wait_for_cached_progress(task_id, last_event_id, wait) or cached_progress
+        response_data = build_response_data_from_cached_progress(progress, task_id, policyholder_code)
+        response_data["event_id"] = get_progress_event_id(progress)
+        return JsonResponse(response_data)
 
     except Exception as e:
-        logger.error(f"Error in download_insuree_import_report: {str(e)}", exc_info=True)
+        logger.error(f"Error in stream_insuree_import_progress: {str(e)}", exc_info=True)
         return JsonResponse(
-            {"success": False, "message": f"Error downloading file: {str(e)}"},
-            status=500,
-        )
\ No newline at end of file
+            {"success": False, "message": f"Error: {str(e)}"}, status=500
+        )
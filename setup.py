@@ -30,7 +30,9 @@ setup(
         'openimis-be-policy',
         'openimis-be-insuree',
         'openimis-be-contribution_plan',
-        'pandas'
+        'pandas',
+        'openpyxl',
+        'xlsxwriter'
     ],
     classifiers=[
         'Environment :: Web Environment',